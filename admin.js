@@ -62,7 +62,9 @@ document.addEventListener('DOMContentLoaded', () => {
     const newCategoryContainer = document.getElementById('new-product-category-container');
     const editCategoryContainer = document.getElementById('edit-product-category-container');
 
-    let allProducts = [], allCategories = [], salesData = [], sessionData = [], cookingTimeData = {};
+    let allProducts = [], allCategories = [], salesData = null, salesSummaryData = [], sessionData = [], cookingTimeData = {};
+    // 明細行は件数が多いため、時間順・テーブル順の表示を開いた時に初めて取得する
+    let salesRange = null;
     let currentSort = 'time';
 
     async function authenticatedAPIFetch(url, options = {}) {
@@ -220,6 +222,25 @@ document.addEventListener('DOMContentLoaded', () => {
         });
     }
     
+    // アップロード画像はサーバー側で非同期に変換されるため、ジョブが終わるまで状態を確認してから表示を更新する
+    async function waitForImageJobs(jobIds, onFinished) {
+        const ids = (jobIds || []).filter(Boolean);
+        if (ids.length === 0) return;
+        try {
+            for (let i = 0; i < 60; i++) {
+                await new Promise(resolve => setTimeout(resolve, 1000));
+                const response = await authenticatedAPIFetch(`${API_BASE_URL}/admin/image_jobs?ids=${ids.join(',')}`);
+                const jobs = await response.json();
+                if (jobs.every(job => job.status === 'done' || job.status === 'failed')) {
+                    const failed = jobs.filter(job => job.status === 'failed');
+                    if (failed.length > 0) alert(`画像の処理に失敗しました: ${failed.map(job => job.error).join(' / ')}`);
+                    break;
+                }
+            }
+        } catch (error) { console.error('画像処理状況の確認エラー:', error); }
+        onFinished();
+    }
+
     async function loadOpeningSettings() {
         try {
             const response = await fetch(`${API_BASE_URL}/get_opening_settings`);
@@ -258,7 +279,23 @@ document.addEventListener('DOMContentLoaded', () => {
         } catch (error) { console.error('店舗情報読み込みエラー:', error); }
     }
     
-    function renderSalesData() {
+    // 明細一覧はサーバー側で並べ替えたものをページ単位で取得し、「さらに表示」で続きを読み込む
+    async function loadSalesLines(more = false) {
+        if (!salesRange || (!more && salesData !== null && salesData.sort === currentSort)) return;
+        const offset = more ? salesData.nextOffset : 0;
+        const response = await authenticatedAPIFetch(`${API_BASE_URL}/admin/get_sales_data?start_date=${salesRange.startDate}&end_date=${salesRange.endDate}&lines=1&sort=${currentSort}&offset=${offset}`);
+        const page = await response.json();
+        salesData = { sort: currentSort, lines: (more ? salesData.lines : []).concat(page.lines), nextOffset: page.nextOffset };
+    }
+
+    async function renderSalesData() {
+        if (currentSort === 'time' || currentSort === 'table') {
+            try {
+                await loadSalesLines();
+            } catch (error) {
+                return alert(`データ取得エラー: ${error.message}`);
+            }
+        }
         salesTableBody.innerHTML = '';
         salesSummaryTableBody.innerHTML = '';
         sessionDurationTableBody.innerHTML = '';
@@ -269,24 +306,16 @@ document.addEventListener('DOMContentLoaded', () => {
 
         if (currentSort === 'product') {
             salesSummaryTable.classList.remove('hidden');
-            if(Object.keys(salesData).length === 0) {
+            if(salesSummaryData.length === 0) {
                 return salesSummaryTableBody.innerHTML = '<tr><td colspan="4">対象期間の売上データはありません。</td></tr>';
             }
-            const productSummary = salesData.reduce((acc, item) => {
-                if (!acc[item.item_name]) {
-                    acc[item.item_name] = { quantity: 0, total: 0 };
-                }
-                acc[item.item_name].quantity += item.quantity;
-                acc[item.item_name].total += item.price * item.quantity;
-                return acc;
-            }, {});
-            const sortedSummary = Object.entries(productSummary).map(([name, data]) => ({ name, ...data })).sort((a, b) => b.total - a.total);
-            sortedSummary.forEach(item => {
+            // 商品別の集計はサーバー側で済ませてある (売上の多い順)
+            salesSummaryData.forEach(item => {
                 const tr = salesSummaryTableBody.insertRow();
-                tr.insertCell().textContent = item.name;
+                tr.insertCell().textContent = item.item_name;
                 tr.insertCell().textContent = item.quantity;
                 tr.insertCell().textContent = item.total.toLocaleString();
-                tr.insertCell().textContent = cookingTimeData[item.name] ? `${cookingTimeData[item.name]}分` : 'N/A';
+                tr.insertCell().textContent = cookingTimeData[item.item_name] ? `${cookingTimeData[item.item_name]}分` : 'N/A';
             });
         } else if (currentSort === 'duration') {
             sessionDurationTable.classList.remove('hidden');
@@ -303,14 +332,10 @@ document.addEventListener('DOMContentLoaded', () => {
             });
         } else {
             salesTable.classList.remove('hidden');
-             if(salesData.length === 0) {
+             if(!salesData || salesData.lines.length === 0) {
                 return salesTableBody.innerHTML = '<tr><td colspan="6">対象期間の売上データはありません。</td></tr>';
             }
-            const sortedData = [...salesData].sort((a, b) => {
-                if (currentSort === 'table') return a.table_id - b.table_id || a.created_at - b.created_at;
-                return a.created_at - b.created_at;
-            });
-            sortedData.forEach(item => {
+            salesData.lines.forEach(item => {
                 const tr = salesTableBody.insertRow();
                 tr.insertCell().textContent = new Date(item.created_at * 1000).toLocaleString('ja-JP');
                 tr.insertCell().textContent = item.table_id;
@@ -319,8 +344,23 @@ document.addEventListener('DOMContentLoaded', () => {
                 tr.insertCell().textContent = item.price.toLocaleString();
                 tr.insertCell().textContent = (item.price * item.quantity).toLocaleString();
             });
+            if (salesData.nextOffset !== null) {
+                const cell = salesTableBody.insertRow().insertCell();
+                cell.colSpan = 6;
+                const moreBtn = document.createElement('button');
+                moreBtn.textContent = 'さらに表示';
+                moreBtn.addEventListener('click', async () => {
+                    try {
+                        await loadSalesLines(true);
+                    } catch (error) {
+                        return alert(`データ取得エラー: ${error.message}`);
+                    }
+                    renderSalesData();
+                });
+                cell.appendChild(moreBtn);
+            }
         }
-        const totalSales = salesData.reduce((sum, item) => sum + (item.price * item.quantity), 0);
+        const totalSales = salesSummaryData.reduce((sum, item) => sum + item.total, 0);
         if (totalSales > 0) {
             salesSummaryDiv.innerHTML = `<span>合計売上: ${totalSales.toLocaleString()}円</span>`;
         }
@@ -395,11 +435,13 @@ document.addEventListener('DOMContentLoaded', () => {
         formData.append('description_en', document.getElementById('new-description-en').value);
         formData.append('category_ids', selectedCategoryIds.join(','));
         try {
-            await authenticatedAPIFetch(`${API_BASE_URL}/admin/add_product`, { method: 'POST', body: formData });
+            const response = await authenticatedAPIFetch(`${API_BASE_URL}/admin/add_product`, { method: 'POST', body: formData });
+            const result = await response.json();
             alert('メニューを追加しました。');
             addProductForm.reset();
             newCategoryContainer.querySelectorAll('input:checked').forEach(cb => cb.checked = false);
             loadProducts();
+            waitForImageJobs([result.imageJobId], loadProducts);
         } catch (error) {
             alert(`追加に失敗: ${error.message}`);
         }
@@ -443,10 +485,12 @@ document.addEventListener('DOMContentLoaded', () => {
             category_ids: selectedCategoryIds
         };
         try {
-            await authenticatedAPIFetch(`${API_BASE_URL}/admin/update_product/${productId}`, { method: 'POST', body: JSON.stringify(updatedProduct) });
+            const response = await authenticatedAPIFetch(`${API_BASE_URL}/admin/update_product/${productId}`, { method: 'POST', body: JSON.stringify(updatedProduct) });
+            const result = await response.json();
             alert('メニュー情報を更新しました。');
             closeEditModal();
             loadProducts();
+            waitForImageJobs(result.imageJobIds, loadProducts);
         } catch (error) {
             alert(`更新に失敗: ${error.message}`);
         }
@@ -489,6 +533,7 @@ document.addEventListener('DOMContentLoaded', () => {
             alert(result.message);
             init();
             menuFileInput.value = '';
+            waitForImageJobs(result.imageJobIds, loadProducts);
         } catch (error) {
             alert(`アップロードに失敗: ${error.message}`);
         }
@@ -499,14 +544,16 @@ document.addEventListener('DOMContentLoaded', () => {
         if (!startDate || !endDate) return alert('開始日と終了日を両方指定してください。');
         try {
             const [salesRes, durationRes, cookingTimeRes] = await Promise.all([
-                authenticatedAPIFetch(`${API_BASE_URL}/admin/get_sales_data?start_date=${startDate}&end_date=${endDate}`),
+                authenticatedAPIFetch(`${API_BASE_URL}/admin/get_sales_data?start_date=${startDate}&end_date=${endDate}&group_by=product`),
                 authenticatedAPIFetch(`${API_BASE_URL}/admin/get_session_durations?start_date=${startDate}&end_date=${endDate}`),
                 authenticatedAPIFetch(`${API_BASE_URL}/admin/get_cooking_times?start_date=${startDate}&end_date=${endDate}`)
             ]);
-            salesData = await salesRes.json();
+            salesSummaryData = await salesRes.json();
             sessionData = await durationRes.json();
             cookingTimeData = await cookingTimeRes.json();
-            renderSalesData();
+            salesData = null;
+            salesRange = { startDate, endDate };
+            await renderSalesData();
         } catch (error) {
             alert(`データ取得エラー: ${error.message}`);
         }
@@ -538,9 +585,11 @@ document.addEventListener('DOMContentLoaded', () => {
         e.preventDefault();
         const formData = new FormData(openingSettingsForm);
         try {
-            await authenticatedAPIFetch(`${API_BASE_URL}/admin/update_opening`, { method: 'POST', body: formData });
+            const response = await authenticatedAPIFetch(`${API_BASE_URL}/admin/update_opening`, { method: 'POST', body: formData });
+            const result = await response.json();
             alert('オープニング設定を更新しました。');
             loadOpeningSettings();
+            waitForImageJobs(result.imageJobIds, loadOpeningSettings);
         } catch (error) {
             alert(`設定更新に失敗: ${error.message}`);
         }
@@ -549,10 +598,12 @@ document.addEventListener('DOMContentLoaded', () => {
         e.preventDefault();
         const formData = new FormData(storeInfoForm);
         try {
-            await authenticatedAPIFetch(`${API_BASE_URL}/admin/update_store_info`, { method: 'POST', body: formData });
+            const response = await authenticatedAPIFetch(`${API_BASE_URL}/admin/update_store_info`, { method: 'POST', body: formData });
+            const result = await response.json();
             alert('店舗情報を更新しました。');
             storeQrCodeFileInput.value = '';
             loadStoreInfo();
+            waitForImageJobs(result.imageJobIds, loadStoreInfo);
         } catch (error) {
             alert(`店舗情報更新に失敗: ${error.message}`);
         }
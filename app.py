@@ -1,19 +1,40 @@
 # --- app.py (PostgreSQL対応・最終完全版) ---
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2 import pool
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from psycopg2.extras import RealDictCursor, execute_values
 import secrets
 import os
 import re
-from flask import Flask, jsonify, request, g, send_file, url_for, send_from_directory
+import shutil
+import csv
+import zlib
+import bisect
+import hashlib
+import json
+import mimetypes
+import queue
+import select
+import tempfile
+import threading
+import time
+from flask import Flask, Response, jsonify, request, g, send_file, url_for, stream_with_context, has_app_context, has_request_context
 from flask_cors import CORS
 from datetime import datetime, timezone, timedelta
 import openpyxl
+import click
 from functools import wraps
+from collections import OrderedDict, deque
 import io
-from PIL import Image
+from PIL import Image, ImageOps
+from werkzeug.security import safe_join
 from werkzeug.utils import secure_filename
 from flask_bcrypt import Bcrypt
 import jwt 
+try:
+    import brotli  # requirements.txtに含まれる。インストールされていない環境ではgzipだけで圧縮する
+except ImportError:
+    brotli = None
 
 # --- 定数 ---
 UPLOAD_FOLDER = 'uploads'
@@ -31,39 +52,115 @@ os.makedirs(IMAGES_FOLDER, exist_ok=True)
 app = Flask(__name__, static_folder='images', static_url_path='/images')
 
 ALLOWED_ORIGINS = os.environ.get("FRONTEND_URL", "http://127.0.0.1:5000")
-CORS(app, resources={r"/api/*": {"origins": ALLOWED_ORIGINS}}) 
+CORS(app, resources={r"/api/*": {"origins": ALLOWED_ORIGINS}}, expose_headers=['ETag']) 
 
 app.config['JSON_AS_ASCII'] = False
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['IMAGES_FOLDER'] = IMAGES_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+# asgi.py から起動した場合にTrueになる。SSEなど接続を長時間保持する機能はこの場合だけ有効にする
+app.config['ASYNC_SERVING'] = False
 bcrypt = Bcrypt(app)
 
 # --- データベースのマイグレーション ---
+# (バージョン, 説明, SQL文) を古い順に並べる。適用済みのバージョンはschema_versionに記録され、
+# 未適用のものだけが1件ずつトランザクション内で実行される。SQLは再実行しても安全なように書くこと。
+# SQL文の代わりに関数 (cursorを受け取る) を書くと、同じトランザクション内で呼び出される。
+MIGRATION_LOCK_ID = 7305000
+MIGRATIONS = [
+    (1, "既存テーブルへの追加カラム", [
+        "ALTER TABLE calls ADD COLUMN IF NOT EXISTS call_type TEXT NOT NULL DEFAULT 'normal'",
+        "ALTER TABLE calls ADD COLUMN IF NOT EXISTS status TEXT NOT NULL DEFAULT 'new'",
+        "ALTER TABLE categories ADD COLUMN IF NOT EXISTS display_order INTEGER NOT NULL DEFAULT 99",
+        "ALTER TABLE orders ADD COLUMN IF NOT EXISTS paid_at REAL",
+        "ALTER TABLE orders ADD COLUMN IF NOT EXISTS printed_at REAL",
+        "ALTER TABLE order_items ADD COLUMN IF NOT EXISTS ready_at REAL",
+        "ALTER TABLE products ADD COLUMN IF NOT EXISTS name_en TEXT",
+        "ALTER TABLE products ADD COLUMN IF NOT EXISTS description_en TEXT",
+    ]),
+    (2, "差分取得用の変更履歴テーブル", [
+        "CREATE TABLE IF NOT EXISTS change_log (revision BIGSERIAL PRIMARY KEY, table_id INTEGER, order_id INTEGER, created_at REAL NOT NULL)",
+    ]),
+    (3, "同時注文対策の一意インデックス", [
+        # 既存データに重複があるとインデックスを作れないため、先にまとめる
+        # 同じテーブルの未会計の注文は、最も古い注文に明細を移して1件にする
+        "UPDATE orders o SET created_at = d.created_at FROM (SELECT table_id, MIN(created_at) AS created_at FROM orders WHERE status = 'active' GROUP BY table_id HAVING COUNT(*) > 1) d WHERE o.status = 'active' AND o.table_id = d.table_id",
+        "UPDATE order_items oi SET order_id = k.keep_id FROM (SELECT id, MIN(id) OVER (PARTITION BY table_id) AS keep_id FROM orders WHERE status = 'active' AND table_id IS NOT NULL) k WHERE oi.order_id = k.id AND k.id <> k.keep_id",
+        "DELETE FROM orders o USING orders k WHERE o.status = 'active' AND k.status = 'active' AND k.table_id = o.table_id AND k.id < o.id",
+        # 未会計の注文で調理中の同一商品は、数量を合計して1行にする
+        "UPDATE order_items oi SET quantity = d.quantity FROM (SELECT MIN(oi.id) AS id, SUM(oi.quantity) AS quantity FROM order_items oi JOIN orders o ON o.id = oi.order_id WHERE o.status = 'active' AND oi.item_status = 'cooking' GROUP BY oi.order_id, oi.item_name HAVING COUNT(*) > 1) d WHERE oi.id = d.id",
+        "DELETE FROM order_items oi USING order_items k, orders o WHERE o.id = oi.order_id AND o.status = 'active' AND oi.item_status = 'cooking' AND k.item_status = 'cooking' AND k.order_id = oi.order_id AND k.item_name = oi.item_name AND k.id < oi.id",
+        # 会計済みの注文に調理中のまま残った重複行は、明細と金額を変えないよう提供済みにする
+        "UPDATE order_items oi SET item_status = 'served' FROM order_items k, orders o WHERE o.id = oi.order_id AND o.status <> 'active' AND oi.item_status = 'cooking' AND k.item_status = 'cooking' AND k.order_id = oi.order_id AND k.item_name = oi.item_name AND k.id < oi.id",
+        # まとめた未会計の注文の合計金額を明細から計算し直す
+        "UPDATE orders o SET total_price = COALESCE((SELECT SUM(oi.price * oi.quantity) FROM order_items oi WHERE oi.order_id = o.id), 0) WHERE o.status = 'active'",
+        # 1テーブルにつき未会計の注文は1件のみ
+        "CREATE UNIQUE INDEX IF NOT EXISTS orders_active_table_idx ON orders (table_id) WHERE status = 'active'",
+        # 調理中の同一商品は1行にまとめる (receive_orderのON CONFLICTで数量を加算)
+        "CREATE UNIQUE INDEX IF NOT EXISTS order_items_cooking_name_idx ON order_items (order_id, item_name) WHERE item_status = 'cooking'",
+    ]),
+    (4, "主要な検索条件のインデックス", [
+        "CREATE INDEX IF NOT EXISTS orders_table_status_idx ON orders (table_id, status)",
+        "CREATE INDEX IF NOT EXISTS orders_status_paid_at_idx ON orders (status, paid_at)",
+        "CREATE INDEX IF NOT EXISTS order_items_order_name_status_idx ON order_items (order_id, item_name, item_status)",
+        "CREATE INDEX IF NOT EXISTS table_sessions_table_token_status_idx ON table_sessions (table_id, access_token, status)",
+    ]),
+    (5, "売上分析用の集計テーブル", [
+        "CREATE TABLE IF NOT EXISTS sales_daily_product (day DATE NOT NULL, item_name TEXT NOT NULL, quantity BIGINT NOT NULL, revenue DOUBLE PRECISION NOT NULL, PRIMARY KEY (day, item_name))",
+        "CREATE TABLE IF NOT EXISTS sales_hourly (day DATE NOT NULL, hour SMALLINT NOT NULL, revenue DOUBLE PRECISION NOT NULL, order_count BIGINT NOT NULL, PRIMARY KEY (day, hour))",
+        "CREATE TABLE IF NOT EXISTS cooking_time_daily (day DATE NOT NULL, item_name TEXT NOT NULL, duration_sum DOUBLE PRECISION NOT NULL, duration_count BIGINT NOT NULL, PRIMARY KEY (day, item_name))",
+        "CREATE TABLE IF NOT EXISTS session_durations (order_id INTEGER PRIMARY KEY, table_id INTEGER NOT NULL, day DATE NOT NULL, start_time REAL NOT NULL, end_time REAL NOT NULL, total_price REAL)",
+        "CREATE INDEX IF NOT EXISTS session_durations_end_time_idx ON session_durations (end_time)",
+        # 既存の支払済み注文から集計しておく (空のままだと過去の期間の分析が表示されない)
+        lambda cursor: rebuild_rollups(cursor),
+    ]),
+    (6, "滞在開始時刻の検索用インデックス", [
+        "CREATE INDEX IF NOT EXISTS table_sessions_table_created_idx ON table_sessions (table_id, created_at)",
+    ]),
+    (7, "調理時間のパーセンタイル用ヒストグラム", [
+        "CREATE TABLE IF NOT EXISTS cooking_time_histogram (day DATE NOT NULL, item_name TEXT NOT NULL, hour SMALLINT NOT NULL, bucket SMALLINT NOT NULL, count BIGINT NOT NULL, PRIMARY KEY (day, item_name, hour, bucket))",
+    ]),
+    (8, "画像処理ジョブ", [
+        "CREATE TABLE IF NOT EXISTS image_jobs (id SERIAL PRIMARY KEY, source_path TEXT NOT NULL, filename TEXT NOT NULL, target_kind TEXT NOT NULL, target_key TEXT NOT NULL, variants BOOLEAN NOT NULL DEFAULT TRUE, status TEXT NOT NULL DEFAULT 'queued', attempts INTEGER NOT NULL DEFAULT 0, error TEXT, created_at REAL NOT NULL, started_at REAL, finished_at REAL)",
+        "CREATE INDEX IF NOT EXISTS image_jobs_pending_idx ON image_jobs (id) WHERE status IN ('queued', 'running')",
+    ]),
+    (9, "変更履歴に書き込んだトランザクションのIDを記録", [
+        # 既存の行には、このマイグレーションのトランザクションIDが入る
+        "ALTER TABLE change_log ADD COLUMN IF NOT EXISTS xid BIGINT NOT NULL DEFAULT (pg_current_xact_id()::text::bigint)",
+        "CREATE INDEX IF NOT EXISTS change_log_xid_idx ON change_log (xid)",
+    ]),
+]
+
 def migrate_db():
     with app.app_context():
         db = get_db()
         cursor = db.cursor(cursor_factory=RealDictCursor)
-        
-        migrations = [
-            "ALTER TABLE calls ADD COLUMN call_type TEXT NOT NULL DEFAULT 'normal'",
-            "ALTER TABLE calls ADD COLUMN status TEXT NOT NULL DEFAULT 'new'",
-            "ALTER TABLE categories ADD COLUMN display_order INTEGER NOT NULL DEFAULT 99",
-            "ALTER TABLE orders ADD COLUMN paid_at REAL",
-            "ALTER TABLE orders ADD COLUMN printed_at REAL",
-            "ALTER TABLE order_items ADD COLUMN ready_at REAL",
-            "ALTER TABLE products ADD COLUMN name_en TEXT",
-            "ALTER TABLE products ADD COLUMN description_en TEXT",
-        ]
-        
-        for migration in migrations:
-            try:
-                cursor.execute(migration)
-                db.commit()
-                print(f"Migration successful: {migration}")
-            except psycopg2.Error as e:
-                db.rollback()
-                print(f"Skipping migration (already applied or error): {e}")
+        cursor.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, description TEXT, applied_at REAL NOT NULL)")
+        db.commit()
+        # 複数のワーカーが同時に起動しても、マイグレーションは1プロセスだけが実行する
+        cursor.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+        try:
+            cursor.execute("SELECT version FROM schema_version")
+            applied = {row['version'] for row in cursor.fetchall()}
+            for version, description, statements in MIGRATIONS:
+                if version in applied:
+                    continue
+                try:
+                    for statement in statements:
+                        if callable(statement):
+                            statement(cursor)
+                        else:
+                            cursor.execute(statement)
+                    cursor.execute("INSERT INTO schema_version (version, description, applied_at) VALUES (%s, %s, %s)", (version, description, datetime.now(timezone.utc).timestamp()))
+                    db.commit()
+                    print(f"Applied migration {version}: {description}")
+                except psycopg2.Error:
+                    db.rollback()
+                    print(f"Migration {version} failed: {description}")
+                    raise
+        finally:
+            cursor.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+            db.commit()
 
 # --- データベース初期化 ---
 def init_db():
@@ -85,7 +182,7 @@ def init_db():
             'opening_message': 'ご来店ありがとうございます！', 'opening_image_path': '', 'opening_image_path_2': '',
             'opening_writing_mode': 'horizontal-tb', 'opening_effect': 'fade', 'opening_duration': '5',
             'store_name': '', 'store_address': '', 'store_tel': '', 'store_receipt_note': '',
-            'store_qr_code_path': ''
+            'store_qr_code_path': '', 'menu_version': '0'
         }
         for key, value in default_settings.items():
             cursor.execute("INSERT INTO settings (key, value) VALUES (%s, %s) ON CONFLICT (key) DO NOTHING", (key, value))
@@ -102,35 +199,349 @@ def init_db():
         
         db.commit()
 
+# --- データベース接続プール ---
+# gunicornのワーカーはfork後に独自のプールを持つ (PIDが変わったら作り直す)
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", 1))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", 10))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 10))
+
+_db_pool = None
+_db_pool_pid = None
+_db_pool_slots = None
+_db_pool_lock = threading.Lock()
+_inherited_db_pools = []
+db_pool_stats = {"checkouts": 0, "wait_seconds_total": 0.0, "wait_seconds_max": 0.0, "timeouts": 0, "discarded": 0}
+
+def _get_db_pool():
+    global _db_pool, _db_pool_pid, _db_pool_slots
+    if _db_pool is not None and _db_pool_pid == os.getpid():
+        return _db_pool
+    with _db_pool_lock:
+        if _db_pool is None or _db_pool_pid != os.getpid():
+            db_url = os.environ.get("DATABASE_URL")
+            if not db_url:
+                raise ValueError("DATABASE_URL environment variable is not set")
+            # 親プロセスから引き継いだ接続はソケットを共有しているため、閉じずに参照だけ残す
+            if _db_pool is not None:
+                _inherited_db_pools.append(_db_pool)
+            _db_pool = pool.ThreadedConnectionPool(DB_POOL_MIN, DB_POOL_MAX, db_url, connection_factory=InstrumentedConnection)
+            _db_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+            _db_pool_pid = os.getpid()
+    return _db_pool
+
+def _is_connection_healthy(conn):
+    if conn.closed:
+        return False
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def get_db_pool_stats():
+    db_pool = _db_pool if _db_pool_pid == os.getpid() else None
+    stats = dict(db_pool_stats, pid=os.getpid(), min_size=DB_POOL_MIN, max_size=DB_POOL_MAX)
+    if db_pool is not None:
+        stats["in_use"] = len(db_pool._used)
+        stats["idle"] = len(db_pool._pool)
+    return stats
+
 # --- データベース接続ヘルパー ---
 def get_db():
     if 'db' not in g:
-        db_url = os.environ.get("DATABASE_URL")
-        if not db_url:
-            raise ValueError("DATABASE_URL environment variable is not set")
-        g.db = psycopg2.connect(db_url)
+        db_pool = _get_db_pool()
+        started = time.monotonic()
+        if not _db_pool_slots.acquire(timeout=DB_POOL_TIMEOUT):
+            db_pool_stats["timeouts"] += 1
+            raise pool.PoolError("Timed out waiting for a database connection")
+        try:
+            conn = db_pool.getconn()
+            if not _is_connection_healthy(conn):
+                db_pool_stats["discarded"] += 1
+                db_pool.putconn(conn, close=True)
+                conn = db_pool.getconn()
+        except Exception:
+            _db_pool_slots.release()
+            raise
+        waited = time.monotonic() - started
+        db_pool_stats["checkouts"] += 1
+        db_pool_stats["wait_seconds_total"] += waited
+        db_pool_stats["wait_seconds_max"] = max(db_pool_stats["wait_seconds_max"], waited)
+        g.db = conn
     return g.db
 
 @app.teardown_appcontext
 def close_db(exception):
     db = g.pop('db', None)
-    if db is not None:
-        db.close()
+    if db is None:
+        return
+    db_pool = _get_db_pool()
+    try:
+        if not db.closed:
+            # 未コミットのトランザクションを残したままプールに返さない
+            db.rollback()
+        db_pool.putconn(db, close=bool(db.closed))
+    except psycopg2.Error:
+        db_pool_stats["discarded"] += 1
+        db_pool.putconn(db, close=True)
+    finally:
+        _db_pool_slots.release()
+
+# --- リアルタイム通知 (LISTEN/NOTIFY + Server-Sent Events) ---
+# 各ワーカーが1本のLISTEN専用接続を持ち、受け取った通知を接続中のSSEクライアントへ配信する
+EVENT_CHANNEL = 'order_events'
+EVENT_HEARTBEAT_SECONDS = 15
+EVENT_QUEUE_SIZE = 100
+# EventSourceはヘッダーを付けられずトークンがURL (アクセスログ) に残るため、スタッフのJWTではなく接続専用の短命トークンを使う
+EVENT_STREAM_TOKEN_SCOPE = 'events'
+EVENT_STREAM_TOKEN_SECONDS = 60
+
+_event_subscribers = set()
+_event_handlers = []
+_event_lock = threading.Lock()
+_event_listener_pid = None
+_event_listener_connected = False
+
+def notify_event(cursor, event_type, **data):
+    """トランザクション内でイベントを発行します (コミット時に全ワーカーへ配信されます)。"""
+    data['type'] = event_type
+    cursor.execute("SELECT pg_notify(%s, %s)", (EVENT_CHANNEL, json.dumps(data)))
+
+def on_event(handler):
+    """ワーカー内のキャッシュ無効化などのため、受信した全イベントを受け取る関数を登録します。"""
+    _event_handlers.append(handler)
+    return handler
+
+EVENT_RECONNECT_MAX_SECONDS = 30
+
+def _dispatch_to_handlers(event):
+    # ハンドラの例外でLISTENスレッドが止まると、キャッシュ無効化や画像ワーカーの起床も止まってしまう
+    for handler in _event_handlers:
+        try:
+            handler(event)
+        except Exception:
+            app.logger.exception("event handler %s failed for %s", getattr(handler, '__name__', handler), event.get('type'))
+
+def _publish_event(payload):
+    try:
+        event = json.loads(payload)
+    except ValueError:
+        app.logger.warning("ignored malformed event payload: %r", payload[:200])
+        return
+    _dispatch_to_handlers(event)
+    with _event_lock:
+        subscribers = list(_event_subscribers)
+    for subscriber in subscribers:
+        try:
+            subscriber.put_nowait(payload)
+        except queue.Full:
+            pass
+
+def _event_listener_loop():
+    global _event_listener_connected, _event_listener_pid
+    backoff = 1
+    try:
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(os.environ["DATABASE_URL"])
+                conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cursor:
+                    cursor.execute(f"LISTEN {EVENT_CHANNEL}")
+                # 切断中に届かなかった通知があり得るため、接続のたびにキャッシュを破棄させる
+                _dispatch_to_handlers({'type': 'listener_reset'})
+                _event_listener_connected = True
+                backoff = 1
+                next_prune = time.monotonic()
+                while True:
+                    if time.monotonic() >= next_prune:
+                        # 変更履歴の削除はリクエストのトランザクションでは行わず、ここでまとめて行う
+                        with conn.cursor() as cursor:
+                            prune_change_log(cursor)
+                        next_prune = time.monotonic() + CHANGE_LOG_PRUNE_INTERVAL_SECONDS
+                    if select.select([conn], [], [], EVENT_HEARTBEAT_SECONDS) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        _publish_event(conn.notifies.pop(0).payload)
+            except Exception as e:
+                app.logger.warning("event listener error (retrying in %ss): %s", backoff, e)
+            finally:
+                _event_listener_connected = False
+                if conn is not None and not conn.closed:
+                    conn.close()
+            time.sleep(backoff)
+            backoff = min(backoff * 2, EVENT_RECONNECT_MAX_SECONDS)
+    finally:
+        # 想定外の終了でも、次の購読時にスレッドを起動し直せるようにする
+        _event_listener_pid = None
+
+def _ensure_event_listener():
+    global _event_listener_pid
+    if _event_listener_pid == os.getpid():
+        return
+    with _event_lock:
+        if _event_listener_pid != os.getpid():
+            threading.Thread(target=_event_listener_loop, daemon=True).start()
+            _event_listener_pid = os.getpid()
+
+def is_event_listener_connected():
+    return _event_listener_connected
+
+def subscribe_events(subscriber=None):
+    """イベントの配信先を登録します。put_nowait()を持つオブジェクトを渡せます (省略時はqueue.Queue)。"""
+    _ensure_event_listener()
+    if subscriber is None:
+        subscriber = queue.Queue(maxsize=EVENT_QUEUE_SIZE)
+    with _event_lock:
+        _event_subscribers.add(subscriber)
+    return subscriber
+
+def unsubscribe_events(subscriber):
+    with _event_lock:
+        _event_subscribers.discard(subscriber)
+
+def format_event(payload):
+    """通知のペイロードをSSEの1イベント分の文字列にします。"""
+    event_type = json.loads(payload).get('type', 'message')
+    return f"event: {event_type}\ndata: {payload}\n\n"
+
+# --- ロングポーリング (?wait=秒) ---
+# EventSourceを使えない端末向け。If-None-Matchと同じ内容の間は、関係する通知が届くまで応答を保留する。
+# 待機はasgi.pyがイベントループ上で行う (同期ワーカーでは接続1本がワーカーを占有するため、waitは無視して即座に返す)
+LONG_POLL_MAX_SECONDS = 25
+LONG_POLL_FALLBACK_SECONDS = 3  # LISTEN接続が切れている間は、この間隔でDBを確認し直す
+CALL_EVENTS = {'call_raised', 'call_resolved', 'table_checked_out'}
+TABLE_HISTORY_EVENTS = {'order_item_added', 'item_status_changed', 'item_quantity_changed', 'item_cancelled', 'table_checked_out', 'table_session_expired'}
+
+def is_call_event(event):
+    return event.get('type') in CALL_EVENTS
+
+def table_history_event_filter(table_id):
+    return lambda event: event.get('type') in TABLE_HISTORY_EVENTS and event.get('table_id') == table_id
+
+def _etag_matches(etag):
+    # 圧縮されたレスポンスのETagには "-gzip" などが付く
+    return any(tag == etag or tag.startswith(f"{etag}-") for tag in request.if_none_match.as_set())
+
+def etag_response(build):
+    """build()のレスポンスに内容から計算したETagを付けて返します (If-None-Matchと一致すれば304)。"""
+    response = app.make_response(build())
+    if response.status_code != 200:
+        return response
+    etag = hashlib.sha1(response.get_data()).hexdigest()[:16]
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    if _etag_matches(etag):
+        return app.response_class(status=304, headers={'ETag': response.headers['ETag'], 'Cache-Control': 'no-cache'})
+    return response
+
+# --- テーブルセッション検証キャッシュ ---
+# 有効と確認できたトークンだけを短時間キャッシュする。トークン再発行・会計時の通知で各ワーカーから削除され、
+# 通知を受け取れない間 (LISTEN接続が切れている間) はキャッシュを使わず毎回DBで確認する
+SESSION_CACHE_SIZE = 512
+SESSION_CACHE_TTL_SECONDS = 60
+
+_session_cache = OrderedDict()
+_session_cache_lock = threading.Lock()
+_session_cache_generation = 0
+
+def table_session_is_active(cursor, table_id, access_token):
+    """キャッシュを使わずにテーブルセッションが有効か確認する"""
+    cursor.execute("SELECT id FROM table_sessions WHERE table_id = %s AND access_token = %s AND status = 'active'", (table_id, access_token))
+    return cursor.fetchone() is not None
+
+def is_valid_table_session(cursor, table_id, access_token):
+    _ensure_event_listener()
+    key = (str(table_id), access_token)
+    now = time.monotonic()
+    with _session_cache_lock:
+        expires_at = _session_cache.get(key)
+        if expires_at is not None and expires_at > now and _event_listener_connected:
+            _session_cache.move_to_end(key)
+            return True
+        _session_cache.pop(key, None)
+        generation = _session_cache_generation
+    if not table_session_is_active(cursor, table_id, access_token):
+        return False
+    with _session_cache_lock:
+        # 問い合わせ中に無効化が起きていたら、古い結果をキャッシュしない
+        if _event_listener_connected and generation == _session_cache_generation:
+            _session_cache[key] = now + SESSION_CACHE_TTL_SECONDS
+            while len(_session_cache) > SESSION_CACHE_SIZE:
+                _session_cache.popitem(last=False)
+    return True
+
+@on_event
+def _invalidate_table_sessions(event):
+    global _session_cache_generation
+    if event.get('type') not in ('table_session_expired', 'table_checked_out', 'listener_reset'):
+        return
+    with _session_cache_lock:
+        _session_cache_generation += 1
+        if event.get('table_id') is None:
+            _session_cache.clear()
+        else:
+            for key in [k for k in _session_cache if k[0] == str(event['table_id'])]:
+                del _session_cache[key]
 
 # --- 認証デコレータ ---
+# 検証済みのJWTはトークンのハッシュをキーに、有効期限(exp)までキャッシュする
+TOKEN_CACHE_SIZE = 256
+
+_token_cache = OrderedDict()
+_token_cache_lock = threading.Lock()
+auth_stats = {"cache_hits": 0, "cache_misses": 0, "seconds_total": 0.0}
+
+def verify_stream_token(token):
+    """/api/events/token で発行したSSE接続用トークンを検証します (スタッフAPIのトークンとしては使えません)。"""
+    try:
+        payload = jwt.decode(token, JWT_SECRET_KEY, algorithms=["HS256"])
+    except (jwt.ExpiredSignatureError, jwt.InvalidTokenError):
+        return None
+    return payload if payload.get('scope') == EVENT_STREAM_TOKEN_SCOPE else None
+
+def verify_staff_token(token):
+    key = hashlib.sha256(token.encode('utf-8')).digest()
+    now = time.time()
+    with _token_cache_lock:
+        cached = _token_cache.get(key)
+        if cached is not None:
+            if cached['exp'] > now:
+                _token_cache.move_to_end(key)
+                auth_stats["cache_hits"] += 1
+                return cached['payload']
+            del _token_cache[key]
+    auth_stats["cache_misses"] += 1
+    try:
+        payload = jwt.decode(token, JWT_SECRET_KEY, algorithms=["HS256"])
+    except (jwt.ExpiredSignatureError, jwt.InvalidTokenError):
+        return None
+    if payload.get('scope') is not None:
+        return None
+    if payload.get('exp'):
+        with _token_cache_lock:
+            _token_cache[key] = {'payload': payload, 'exp': payload['exp']}
+            while len(_token_cache) > TOKEN_CACHE_SIZE:
+                _token_cache.popitem(last=False)
+    return payload
+
 def staff_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         auth_header = request.headers.get('Authorization')
         if not auth_header or not auth_header.startswith('Bearer '):
             return jsonify({"status": "error", "message": "Authorization header missing or invalid"}), 401
-        token = auth_header.split(' ')[1]
-        try:
-            payload = jwt.decode(token, JWT_SECRET_KEY, algorithms=["HS256"])
-            g.user_username = payload.get('username')
-            g.user_role = payload.get('role')
-        except (jwt.ExpiredSignatureError, jwt.InvalidTokenError):
+        started = time.perf_counter()
+        payload = verify_staff_token(auth_header.split(' ')[1])
+        g.auth_seconds = time.perf_counter() - started
+        auth_stats["seconds_total"] += g.auth_seconds
+        if payload is None:
             return jsonify({"status": "error", "message": "Invalid or expired token"}), 401
+        g.user_username = payload.get('username')
+        g.user_role = payload.get('role')
         return f(*args, **kwargs)
     return decorated_function
 
@@ -143,6 +554,260 @@ def admin_role_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+# --- 計測 (メトリクス) ---
+# ルートごとの処理時間ヒストグラムと、get_dbの接続で実行したクエリの件数・時間を集計し、
+# /metrics (Prometheus形式) と /api/admin/metrics (JSON) で参照できるようにする。
+# 値はワーカープロセスごとの累計なので、gunicornで複数ワーカーを動かす場合はpidごとに見ること
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+# 認証なしで /metrics を公開する場合だけ METRICS_PUBLIC=1 を設定する
+METRICS_PUBLIC = os.environ.get("METRICS_PUBLIC", "").lower() in ("1", "true", "yes")
+SLOW_QUERY_SECONDS = float(os.environ.get("SLOW_QUERY_SECONDS", 0.2))
+SLOW_QUERY_LOG_SIZE = 50
+LATENCY_BUCKET_BOUNDS = (0, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+_SQL_LITERAL_PATTERN = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+route_stats = {}
+query_stats = {"queries": 0, "seconds_total": 0.0, "slow": 0}
+slow_queries = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+_metrics_lock = threading.Lock()
+
+def redact_sql(query):
+    """ログに残すため、SQL中の文字列・数値リテラルを ? に置き換える (execute_valuesは値を埋め込んだSQLを実行するため)"""
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    return _SQL_LITERAL_PATTERN.sub('?', ' '.join(str(query).split()))
+
+def record_query(query, seconds):
+    with _metrics_lock:
+        query_stats["queries"] += 1
+        query_stats["seconds_total"] += seconds
+    if has_app_context():
+        g.db_queries = g.get('db_queries', 0) + 1
+        g.db_seconds = g.get('db_seconds', 0.0) + seconds
+    if seconds >= SLOW_QUERY_SECONDS:
+        route = request.url_rule.rule if has_request_context() and request.url_rule else None
+        entry = {"at": time.time(), "seconds": round(seconds, 4), "route": route, "query": redact_sql(query)[:1000]}
+        with _metrics_lock:
+            query_stats["slow"] += 1
+            slow_queries.append(entry)
+        app.logger.warning("slow query (%.3fs) on %s: %s", seconds, route, entry["query"])
+
+class _QueryTimingCursorMixin:
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            record_query(query, time.perf_counter() - started)
+
+    def executemany(self, query, vars_list):
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            record_query(query, time.perf_counter() - started)
+
+_instrumented_cursor_classes = {}
+
+def _instrumented_cursor_class(base):
+    cls = _instrumented_cursor_classes.get(base)
+    if cls is None:
+        cls = _instrumented_cursor_classes[base] = type(f"Instrumented{base.__name__}", (_QueryTimingCursorMixin, base), {})
+    return cls
+
+class InstrumentedConnection(psycopg2.extensions.connection):
+    """接続プールが作る接続。cursor_factoryに関わらず、作られたカーソルのexecuteを計測する。
+    また、トランザクションがロールバックされたときに消すファイルを登録できる (remove_on_rollback)"""
+    def cursor(self, *args, **kwargs):
+        base = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs['cursor_factory'] = _instrumented_cursor_class(base)
+        return super().cursor(*args, **kwargs)
+
+    def remove_on_rollback(self, path):
+        self.__dict__.setdefault('rollback_files', []).append(path)
+
+    def commit(self):
+        super().commit()
+        self.__dict__.pop('rollback_files', None)
+
+    def rollback(self):
+        try:
+            super().rollback()
+        finally:
+            for path in self.__dict__.pop('rollback_files', []):
+                if os.path.exists(path):
+                    os.remove(path)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    # after_requestは登録と逆の順に実行される。圧縮などの後処理も含めるため、CORS以外のafter_requestより先に登録している
+    # (CORSはアプリ作成時に登録されるので、この後に実行されるのはCORSのヘッダー付与だけ)
+    started = g.get('request_started')
+    if started is None:
+        return response
+    seconds = time.perf_counter() - started
+    queries, db_seconds = g.get('db_queries', 0), g.get('db_seconds', 0.0)
+    key = (request.method, request.url_rule.rule if request.url_rule else 'unmatched')
+    with _metrics_lock:
+        stats = route_stats.get(key)
+        if stats is None:
+            stats = route_stats[key] = {"count": 0, "seconds_total": 0.0, "buckets": [0] * (len(LATENCY_BUCKET_BOUNDS) + 1),
+                                        "db_queries_total": 0, "db_seconds_total": 0.0, "statuses": {}}
+        stats["count"] += 1
+        stats["seconds_total"] += seconds
+        stats["buckets"][bisect.bisect_right(LATENCY_BUCKET_BOUNDS, seconds)] += 1
+        stats["db_queries_total"] += queries
+        stats["db_seconds_total"] += db_seconds
+        stats["statuses"][response.status_code] = stats["statuses"].get(response.status_code, 0) + 1
+    response.headers.add('Server-Timing', f'db;dur={db_seconds * 1000:.3f};desc="{queries} queries"')
+    return response
+
+@app.after_request
+def add_auth_timing_header(response):
+    if 'auth_seconds' in g:
+        response.headers.add('Server-Timing', f"auth;dur={g.auth_seconds * 1000:.3f}")
+    return response
+
+def _prometheus_labels(**labels):
+    escaped = []
+    for key, value in labels.items():
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+        escaped.append(f'{key}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+def _snapshot_route_stats():
+    with _metrics_lock:
+        routes = {key: dict(stats, buckets=list(stats["buckets"]), statuses=dict(stats["statuses"])) for key, stats in route_stats.items()}
+        return sorted(routes.items()), dict(query_stats), list(slow_queries)
+
+def render_prometheus_metrics():
+    lines = []
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(f"{name}{labels} {value}" for labels, value in samples)
+
+    routes, queries, _ = _snapshot_route_stats()
+    histogram = []
+    for (method, route), stats in routes:
+        # バケット0 (0秒未満) は使われないため、le=LATENCY_BUCKET_BOUNDS[1] から累積する
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKET_BOUNDS[1:] + ('+Inf',), stats["buckets"][1:]):
+            cumulative += count
+            histogram.append((f"_bucket{_prometheus_labels(method=method, route=route, le=bound)}", cumulative))
+        histogram.append((f"_sum{_prometheus_labels(method=method, route=route)}", stats["seconds_total"]))
+        histogram.append((f"_count{_prometheus_labels(method=method, route=route)}", stats["count"]))
+    metric("order_link_http_request_duration_seconds", "histogram", "Request latency by route.", histogram)
+    metric("order_link_http_responses_total", "counter", "Responses by route and status code.",
+           [(_prometheus_labels(method=method, route=route, status=status), count)
+            for (method, route), stats in routes for status, count in sorted(stats["statuses"].items())])
+    metric("order_link_db_queries_total", "counter", "Database queries executed while handling each route.",
+           [(_prometheus_labels(method=method, route=route), stats["db_queries_total"]) for (method, route), stats in routes])
+    metric("order_link_db_query_seconds_total", "counter", "Time spent in database queries while handling each route.",
+           [(_prometheus_labels(method=method, route=route), stats["db_seconds_total"]) for (method, route), stats in routes])
+    metric("order_link_db_slow_queries_total", "counter", f"Queries slower than {SLOW_QUERY_SECONDS}s.", [("", queries["slow"])])
+    pool_stats = get_db_pool_stats()
+    metric("order_link_db_pool_checkouts_total", "counter", "Connections checked out of the pool.", [("", pool_stats["checkouts"])])
+    metric("order_link_db_pool_wait_seconds_total", "counter", "Time spent waiting for a pooled connection.", [("", pool_stats["wait_seconds_total"])])
+    metric("order_link_db_pool_timeouts_total", "counter", "Pool checkouts that timed out.", [("", pool_stats["timeouts"])])
+    metric("order_link_db_pool_connections", "gauge", "Pooled connections by state.",
+           [(_prometheus_labels(state=state), pool_stats[state]) for state in ("in_use", "idle") if state in pool_stats])
+    metric("order_link_auth_cache_hits_total", "counter", "Staff token verifications served from the cache.", [("", auth_stats["cache_hits"])])
+    metric("order_link_auth_cache_misses_total", "counter", "Staff token verifications that decoded the JWT.", [("", auth_stats["cache_misses"])])
+    compression = get_compression_stats()
+    metric("order_link_compression_bytes_in_total", "counter", "Response bytes before compression.", [("", compression["bytes_in"])])
+    metric("order_link_compression_bytes_out_total", "counter", "Response bytes after compression.", [("", compression["bytes_out"])])
+    metric("order_link_process_info", "gauge", "Worker process that served this scrape.", [(_prometheus_labels(pid=os.getpid()), 1)])
+    return "\n".join(lines) + "\n"
+
+def _prometheus_metrics_response():
+    return Response(render_prometheus_metrics(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/metrics')
+def prometheus_metrics():
+    # Authorization: Bearer <METRICS_TOKEN> か管理者のトークンを要求する (METRICS_PUBLIC=1 のときは認証なし)
+    if METRICS_PUBLIC or (METRICS_TOKEN and secrets.compare_digest(request.headers.get('Authorization', ''), f"Bearer {METRICS_TOKEN}")):
+        return _prometheus_metrics_response()
+    return admin_role_required(_prometheus_metrics_response)()
+
+@app.route('/api/admin/metrics', methods=['GET'])
+@admin_role_required
+def get_metrics():
+    routes, queries, recent_slow_queries = _snapshot_route_stats()
+    route_summaries = []
+    for (method, route), stats in routes:
+        p50, p95, p99 = estimate_quantiles({i: c for i, c in enumerate(stats["buckets"]) if c}, [0.5, 0.95, 0.99], LATENCY_BUCKET_BOUNDS)
+        route_summaries.append({
+            "method": method, "route": route, "count": stats["count"], "statuses": stats["statuses"],
+            "avg_ms": round(stats["seconds_total"] / stats["count"] * 1000, 2),
+            "p50_ms": round(p50 * 1000, 2), "p95_ms": round(p95 * 1000, 2), "p99_ms": round(p99 * 1000, 2),
+            "db_queries_per_request": round(stats["db_queries_total"] / stats["count"], 2),
+            "db_ms_per_request": round(stats["db_seconds_total"] / stats["count"] * 1000, 2),
+        })
+    route_summaries.sort(key=lambda r: r["avg_ms"] * r["count"], reverse=True)
+    return jsonify({"pid": os.getpid(), "routes": route_summaries, "queries": queries, "slow_queries": recent_slow_queries[::-1],
+                    "db_pool": get_db_pool_stats(), "auth": auth_stats, "compression": get_compression_stats()})
+
+# --- レスポンス圧縮 ---
+# 一定サイズ以上のJSONは Accept-Encoding に応じて圧縮する。毎回圧縮するレスポンスは遅延を抑えるため低めのレベル、
+# メニューのスナップショットのようにキャッシュするものは最大レベルで一度だけ圧縮して使い回す
+API_COMPRESS_MIN_BYTES = 1024
+API_GZIP_LEVEL = 5
+API_BROTLI_QUALITY = 4
+compression_stats = {"responses": 0, "cache_hits": 0, "bytes_in": 0, "bytes_out": 0, "seconds_total": 0.0}
+
+def negotiate_encoding():
+    """Accept-Encodingから使用する圧縮方式 ('br' / 'gzip' / None) を決める"""
+    if brotli is not None and request.accept_encodings['br']:
+        return 'br'
+    if request.accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+def compress_body(body, encoding, level=None):
+    if encoding == 'br':
+        return brotli.compress(body, quality=11 if level is None else level)
+    return b''.join(gzip_chunks([body], level=9 if level is None else level))
+
+def _record_compression(bytes_in, bytes_out, seconds=0.0, cache_hit=False):
+    compression_stats["responses"] += 1
+    compression_stats["bytes_in"] += bytes_in
+    compression_stats["bytes_out"] += bytes_out
+    compression_stats["seconds_total"] += seconds
+    if cache_hit:
+        compression_stats["cache_hits"] += 1
+
+def get_compression_stats():
+    stats = dict(compression_stats)
+    stats["bytes_saved"] = stats["bytes_in"] - stats["bytes_out"]
+    stats["ratio"] = round(stats["bytes_out"] / stats["bytes_in"], 3) if stats["bytes_in"] else None
+    return stats
+
+@app.after_request
+def compress_api_response(response):
+    if not request.path.startswith('/api/') or response.direct_passthrough or response.is_streamed:
+        return response
+    if response.status_code != 200 or response.mimetype != 'application/json' or 'Content-Encoding' in response.headers:
+        return response
+    response.vary.add('Accept-Encoding')
+    body = response.get_data()
+    encoding = negotiate_encoding() if len(body) >= API_COMPRESS_MIN_BYTES else None
+    if not encoding:
+        return response
+    started = time.perf_counter()
+    compressed = compress_body(body, encoding, API_BROTLI_QUALITY if encoding == 'br' else API_GZIP_LEVEL)
+    _record_compression(len(body), len(compressed), time.perf_counter() - started)
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(f"{etag}-{encoding}", weak)
+    return response
+
 # --- ログインAPI ---
 @app.route('/api/login', methods=['POST'])
 def login():
@@ -161,6 +826,287 @@ def login():
     else:
         return jsonify({"status": "error", "message": "Invalid username or password"}), 401
 
+# --- 画像処理 ---
+# アップロード画像はメタデータを除いて保存し、images/variants/<ファイル名>/ にサイズ別のWebPとJPEGを作る
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.gif', '.webp'}
+IMAGE_ORIGINAL_MAX_SIZE = 2048
+IMAGE_VARIANTS_DIR = 'variants'
+IMAGE_VARIANTS = OrderedDict([('thumb', 160), ('card', 480), ('full', 1280)])
+IMAGE_VARIANT_FORMATS = OrderedDict([
+    ('webp', ('WEBP', {'quality': 80, 'method': 4})),
+    ('jpg', ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True})),
+])
+
+def _image_variant_dir(filename):
+    # image_pathは管理画面から自由に入力できるため、images/ 直下のファイル名以外は扱わない
+    if not filename or os.path.basename(filename) != filename or filename.startswith('.'):
+        return None
+    return os.path.join(app.config['IMAGES_FOLDER'], IMAGE_VARIANTS_DIR, filename)
+
+def _flatten_image(img):
+    """EXIFの向きを反映し、透過部分を白で塗りつぶしたRGB画像を返す"""
+    img = ImageOps.exif_transpose(img)
+    if img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info):
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel('A'))
+        return background
+    return img.convert('RGB')
+
+def save_uploaded_image(source, filename):
+    """アップロード画像 (パスまたはファイルオブジェクト) を長辺IMAGE_ORIGINAL_MAX_SIZEまで縮小し、EXIF等のメタデータを付けずに images/ へ保存する"""
+    ext = os.path.splitext(filename)[1].lower()
+    with Image.open(source) as img:
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((IMAGE_ORIGINAL_MAX_SIZE, IMAGE_ORIGINAL_MAX_SIZE), Image.Resampling.LANCZOS)
+        if ext in ('.jpg', '.jpeg'):
+            img = _flatten_image(img)
+            options = {'quality': 90, 'optimize': True}
+        else:
+            options = {}
+        img.save(os.path.join(app.config['IMAGES_FOLDER'], filename), **options)
+
+def _read_image_manifest(filename):
+    variant_dir = _image_variant_dir(filename)
+    if not variant_dir: return None
+    try:
+        with open(os.path.join(variant_dir, 'manifest.json'), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def generate_image_variants(filename):
+    """images/<filename> からサイズ別の派生画像を作り、最後にmanifest.jsonを書く (manifestがあれば生成完了)"""
+    variant_dir = _image_variant_dir(filename)
+    if not variant_dir: raise ValueError(f"無効な画像ファイル名です: {filename}")
+    os.makedirs(variant_dir, exist_ok=True)
+    with Image.open(os.path.join(app.config['IMAGES_FOLDER'], filename)) as img:
+        base = _flatten_image(img)
+    manifest = {}
+    for variant, size in IMAGE_VARIANTS.items():
+        resized = base.copy()
+        resized.thumbnail((size, size), Image.Resampling.LANCZOS)
+        manifest[variant] = {'width': resized.width, 'height': resized.height, 'hash': {}}
+        for ext, (fmt, options) in IMAGE_VARIANT_FORMATS.items():
+            buffer = io.BytesIO()
+            resized.save(buffer, fmt, **options)
+            # 内容のハッシュをURLに付けて、ブラウザに長期間キャッシュさせる (send_static_assetを参照)
+            manifest[variant]['hash'][ext] = hashlib.sha256(buffer.getvalue()).hexdigest()[:STATIC_HASH_LENGTH]
+            # 配信中のファイルを壊さないよう、一時ファイルに書いてから置き換える
+            path = os.path.join(variant_dir, f"{variant}.{ext}")
+            with open(path + '.tmp', 'wb') as f:
+                f.write(buffer.getvalue())
+            os.replace(path + '.tmp', path)
+    with open(os.path.join(variant_dir, 'manifest.json.tmp'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    os.replace(os.path.join(variant_dir, 'manifest.json.tmp'), os.path.join(variant_dir, 'manifest.json'))
+    return manifest
+
+def remove_image_variants(filename):
+    variant_dir = _image_variant_dir(filename)
+    if variant_dir: shutil.rmtree(variant_dir, ignore_errors=True)
+
+def image_variants(filename, external=False):
+    """派生画像のURLとsrcsetを返す。まだ生成されていなければNone"""
+    manifest = _read_image_manifest(filename)
+    if not manifest: return None
+    result = {'sizes': {}, 'srcset': {}}
+    for variant in IMAGE_VARIANTS:
+        if variant not in manifest: return None
+        entry = {'width': manifest[variant]['width'], 'height': manifest[variant]['height']}
+        hashes = manifest[variant].get('hash', {})
+        for ext in IMAGE_VARIANT_FORMATS:
+            version = {'v': hashes[ext]} if ext in hashes else {}
+            entry[ext] = url_for('static', filename=f"{IMAGE_VARIANTS_DIR}/{filename}/{variant}.{ext}", _external=external, **version)
+        result['sizes'][variant] = entry
+    for ext in IMAGE_VARIANT_FORMATS:
+        result['srcset'][ext] = ", ".join(f"{entry[ext]} {entry['width']}w" for entry in result['sizes'].values())
+    return result
+
+# --- 画像処理ジョブ ---
+# アップロードされたファイルはデコードせずに uploads/image_jobs/ へ保存してジョブを登録し、すぐにレスポンスを返す。
+# 変換はワーカー (既定はWebプロセス内のスレッド、IMAGE_WORKER_MODE=external なら `flask image-worker`) が行い、
+# 完了時に商品やオープニング設定の画像パスを書き換える。ワーカーは FOR UPDATE SKIP LOCKED で1件ずつ取り出すため、
+# 複数プロセスで動かしても同じジョブを二重に処理しない。
+IMAGE_JOB_FOLDER = os.path.join(UPLOAD_FOLDER, 'image_jobs')
+IMAGE_WORKER_MODE = os.environ.get('IMAGE_WORKER_MODE', 'thread')
+IMAGE_WORKER_POLL_SECONDS = 30
+IMAGE_JOB_TIMEOUT_SECONDS = 300
+IMAGE_JOB_MAX_ATTEMPTS = 3
+IMAGE_JOB_RETENTION_SECONDS = 7 * 24 * 3600
+IMAGE_JOB_TARGETS = {
+    'product': "UPDATE products SET image_path = %(filename)s WHERE id = %(target_key)s::integer",
+    'setting': "UPDATE settings SET value = %(filename)s WHERE key = %(target_key)s",
+    # images/ に既にある画像の派生画像だけを作る (メニューのExcel取り込み・商品編集で画像名が指定された場合)
+    'variants': None,
+}
+# 完了時にメニューのキャッシュを作り直させるジョブの種類
+IMAGE_JOB_MENU_KINDS = ('product', 'variants')
+
+_image_worker_wakeup = threading.Event()
+_image_worker_lock = threading.Lock()
+_image_worker_pid = None
+
+def enqueue_image_job(cursor, file_storage, filename, target_kind, target_key, variants=True):
+    """アップロードされたファイルをそのまま保存して画像処理ジョブを登録し、ジョブIDを返す (コミット時にワーカーへ通知)。
+    ジョブが登録されずに終わったとき (ロールバック時) は保存したファイルを削除する"""
+    # ヘッダーだけ読んで画像であることを確認する (デコードはしない)
+    with Image.open(file_storage.stream):
+        pass
+    file_storage.stream.seek(0)
+    os.makedirs(IMAGE_JOB_FOLDER, exist_ok=True)
+    source_path = os.path.join(IMAGE_JOB_FOLDER, f"{secrets.token_hex(8)}{os.path.splitext(filename)[1].lower()}")
+    file_storage.save(source_path)
+    cursor.connection.remove_on_rollback(source_path)
+    cursor.execute("""
+        INSERT INTO image_jobs (source_path, filename, target_kind, target_key, variants, created_at)
+        VALUES (%s, %s, %s, %s, %s, %s) RETURNING id
+    """, (source_path, filename, target_kind, str(target_key), variants, time.time()))
+    job_id = cursor.fetchone()['id']
+    notify_event(cursor, 'image_job_queued', job_id=job_id)
+    return job_id
+
+def enqueue_image_variant_jobs(cursor, filenames):
+    """images/ にある画像のうち、派生画像が無いものについて派生画像を作るジョブを登録し、ジョブIDのリストを返す"""
+    targets = []
+    for filename in sorted(set(filter(None, filenames))):
+        if _read_image_manifest(filename) is not None or not _image_variant_dir(filename): continue
+        if os.path.isfile(os.path.join(app.config['IMAGES_FOLDER'], filename)):
+            targets.append(filename)
+    if not targets:
+        return []
+    # 同じ画像のジョブが待機中・処理中なら重ねて登録しない (source_pathが空のジョブは元画像の保存を行わない)
+    cursor.execute("""
+        INSERT INTO image_jobs (source_path, filename, target_kind, target_key, variants, created_at)
+        SELECT '', f, 'variants', f, TRUE, %s FROM unnest(%s::text[]) AS f
+        WHERE NOT EXISTS (SELECT 1 FROM image_jobs j WHERE j.target_kind = 'variants' AND j.filename = f AND j.status IN ('queued', 'running'))
+        RETURNING id
+    """, (time.time(), targets))
+    job_ids = [row['id'] for row in cursor.fetchall()]
+    if job_ids:
+        notify_event(cursor, 'image_job_queued', job_id=job_ids[0])
+    return job_ids
+
+def claim_image_job(cursor):
+    """待機中のジョブ (または処理中のまま止まったジョブ) を1件取り出して処理中にする"""
+    now = time.time()
+    cursor.execute("""
+        UPDATE image_jobs SET status = 'running', started_at = %s, attempts = attempts + 1
+        WHERE id = (
+            SELECT id FROM image_jobs
+            WHERE status = 'queued' OR (status = 'running' AND started_at < %s AND attempts < %s)
+            ORDER BY id LIMIT 1 FOR UPDATE SKIP LOCKED
+        )
+        RETURNING *
+    """, (now, now - IMAGE_JOB_TIMEOUT_SECONDS, IMAGE_JOB_MAX_ATTEMPTS))
+    return cursor.fetchone()
+
+def fail_stalled_image_jobs(cursor):
+    """処理中のまま止まり、再試行回数を使い切ったジョブを失敗にして、元ファイルのパスのリストを返す"""
+    now = time.time()
+    cursor.execute("""
+        UPDATE image_jobs SET status = 'failed', error = 'timed out', finished_at = %s
+        WHERE status = 'running' AND started_at < %s AND attempts >= %s
+        RETURNING id, source_path
+    """, (now, now - IMAGE_JOB_TIMEOUT_SECONDS, IMAGE_JOB_MAX_ATTEMPTS))
+    jobs = cursor.fetchall()
+    for job in jobs:
+        notify_event(cursor, 'image_job_finished', job_id=job['id'], status='failed')
+    return [job['source_path'] for job in jobs if job['source_path']]
+
+def run_image_job(db, job):
+    """ジョブを1件処理する。失敗した場合はIMAGE_JOB_MAX_ATTEMPTS回まで再試行のため待機中に戻す"""
+    cursor = db.cursor(cursor_factory=RealDictCursor)
+    try:
+        if job['source_path']:
+            save_uploaded_image(job['source_path'], job['filename'])
+        if job['variants']:
+            generate_image_variants(job['filename'])
+        if IMAGE_JOB_TARGETS[job['target_kind']]:
+            cursor.execute(IMAGE_JOB_TARGETS[job['target_kind']], {'filename': job['filename'], 'target_key': job['target_key']})
+        if job['target_kind'] in IMAGE_JOB_MENU_KINDS:
+            bump_menu_version(cursor)
+        cursor.execute("UPDATE image_jobs SET status = 'done', error = NULL, finished_at = %s WHERE id = %s", (time.time(), job['id']))
+        notify_event(cursor, 'image_job_finished', job_id=job['id'], status='done')
+        db.commit()
+        finished = True
+    except Exception as e:
+        db.rollback()
+        finished = job['attempts'] >= IMAGE_JOB_MAX_ATTEMPTS
+        status = 'failed' if finished else 'queued'
+        app.logger.warning("image job %s failed (attempt %s): %s", job['id'], job['attempts'], e)
+        cursor.execute("UPDATE image_jobs SET status = %s, error = %s, finished_at = %s WHERE id = %s", (status, str(e), time.time(), job['id']))
+        if finished:
+            notify_event(cursor, 'image_job_finished', job_id=job['id'], status=status)
+        db.commit()
+    if finished and job['source_path'] and os.path.exists(job['source_path']):
+        os.remove(job['source_path'])
+
+def process_image_jobs(db, limit=None):
+    """待機中のジョブが無くなる (またはlimit件処理する) まで処理し、処理した件数を返す"""
+    cursor = db.cursor(cursor_factory=RealDictCursor)
+    stalled_paths = fail_stalled_image_jobs(cursor)
+    db.commit()
+    for path in stalled_paths:
+        if os.path.exists(path):
+            os.remove(path)
+    processed = 0
+    while limit is None or processed < limit:
+        job = claim_image_job(cursor)
+        db.commit()
+        if job is None:
+            break
+        run_image_job(db, job)
+        processed += 1
+    if processed:
+        cursor.execute("DELETE FROM image_jobs WHERE status IN ('done', 'failed') AND finished_at < %s", (time.time() - IMAGE_JOB_RETENTION_SECONDS,))
+        db.commit()
+    return processed
+
+@on_event
+def _wake_image_worker(event):
+    if event.get('type') in ('image_job_queued', 'listener_reset'):
+        _image_worker_wakeup.set()
+
+def _image_worker_loop():
+    while True:
+        _image_worker_wakeup.wait(IMAGE_WORKER_POLL_SECONDS)
+        _image_worker_wakeup.clear()
+        try:
+            with app.app_context():
+                process_image_jobs(get_db())
+        except Exception as e:
+            app.logger.warning("image worker error: %s", e)
+            time.sleep(3)
+
+def _ensure_image_worker():
+    """IMAGE_WORKER_MODE=thread のとき、このプロセスの画像処理スレッドを起動する"""
+    global _image_worker_pid
+    if IMAGE_WORKER_MODE != 'thread' or _image_worker_pid == os.getpid():
+        return
+    with _image_worker_lock:
+        if _image_worker_pid != os.getpid():
+            _ensure_event_listener()
+            threading.Thread(target=_image_worker_loop, daemon=True).start()
+            _image_worker_pid = os.getpid()
+
+@app.route('/api/admin/image_jobs', methods=['GET'])
+@admin_role_required
+def get_image_jobs():
+    _ensure_image_worker()
+    cursor = get_db().cursor(cursor_factory=RealDictCursor)
+    columns = "id, filename, target_kind, target_key, status, attempts, error, created_at, started_at, finished_at"
+    ids = request.args.get('ids')
+    if ids:
+        try:
+            job_ids = [int(i) for i in ids.split(',') if i]
+        except ValueError:
+            return jsonify({"status": "error", "message": "無効なジョブIDです"}), 400
+        cursor.execute(f"SELECT {columns} FROM image_jobs WHERE id = ANY(%s) ORDER BY id", (job_ids,))
+    else:
+        cursor.execute(f"SELECT {columns} FROM image_jobs ORDER BY id DESC LIMIT 20")
+    return jsonify(cursor.fetchall())
+
 # --- API: 顧客向け ---
 
 @app.route('/api/get_opening_settings')
@@ -170,8 +1116,10 @@ def get_opening_settings():
     settings = {row['key']: row['value'] for row in cursor.fetchall()}
     if settings.get('opening_image_path'):
         settings['opening_image_url'] = url_for('static', filename=settings['opening_image_path'], _external=True)
+        settings['opening_image_variants'] = image_variants(settings['opening_image_path'], external=True)
     if settings.get('opening_image_path_2'):
         settings['opening_image_url_2'] = url_for('static', filename=settings['opening_image_path_2'], _external=True)
+        settings['opening_image_variants_2'] = image_variants(settings['opening_image_path_2'], external=True)
     
     # ★★★ クレジット情報に加えて、メッセージも確実に渡すように修正 ★★★
     cursor.execute("SELECT value FROM settings WHERE key = 'opening_message'")
@@ -190,10 +1138,52 @@ def get_public_store_info():
     store_name = store_name_row['value'] if store_name_row and store_name_row['value'] else 'レストラン「My Order LINK」'
     return jsonify({"store_name": store_name})
 
-@app.route('/api/get_products')
-def get_products():
-    db = get_db()
-    cursor = db.cursor(cursor_factory=RealDictCursor)
+# --- メニューキャッシュ ---
+# メニュー変更時にsettingsの'menu_version'を上げ、各ワーカーはバージョンが変わった時だけ再構築する
+_menu_cache = {}
+_menu_cache_lock = threading.Lock()
+
+def bump_menu_version(cursor):
+    cursor.execute("INSERT INTO settings (key, value) VALUES ('menu_version', '1') ON CONFLICT (key) DO UPDATE SET value = (settings.value::bigint + 1)::text")
+
+def get_menu_version(cursor):
+    cursor.execute("SELECT value FROM settings WHERE key = 'menu_version'")
+    row = cursor.fetchone()
+    return row['value'] if row else '0'
+
+def menu_snapshot_response(key, build):
+    """メニューのJSONをバージョン単位でキャッシュし、ETag付きで返します (If-None-Match一致時は304)。"""
+    cursor = get_db().cursor(cursor_factory=RealDictCursor)
+    version = get_menu_version(cursor)
+    cached = _menu_cache.get(key)
+    if cached is None or cached['version'] != version:
+        body = json.dumps(build(cursor), ensure_ascii=False).encode('utf-8')
+        cached = {"version": version, "body": body, "etag": f"{key}-{version}-{hashlib.sha1(body).hexdigest()[:12]}", "encoded": {}}
+        with _menu_cache_lock:
+            _menu_cache[key] = cached
+    body, etag = cached['body'], cached['etag']
+    encoding = negotiate_encoding() if len(body) >= API_COMPRESS_MIN_BYTES else None
+    if encoding:
+        # 圧縮後のバイト列もバージョン単位でキャッシュする (ETagは圧縮方式ごとに分ける)
+        encoded = cached['encoded'].get(encoding)
+        compress_seconds = 0.0
+        if encoded is None:
+            started = time.perf_counter()
+            encoded = cached['encoded'][encoding] = compress_body(body, encoding)
+            compress_seconds = time.perf_counter() - started
+        body, etag = encoded, f"{etag}-{encoding}"
+    response = app.response_class(body, mimetype='application/json')
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    response = response.make_conditional(request)
+    if encoding and response.status_code == 200:
+        _record_compression(len(cached['body']), len(body), compress_seconds, cache_hit=not compress_seconds)
+    return response
+
+def _build_products(cursor):
     cursor.execute("SELECT id, name_jp, name_en FROM categories")
     categories_map = {c['id']: c for c in cursor.fetchall()}
     cursor.execute("SELECT * FROM product_categories")
@@ -209,22 +1199,33 @@ def get_products():
         cat_ids = product_to_cats.get(p_row['id'], [])
         p_row['categories'] = [categories_map[cid] for cid in cat_ids if cid in categories_map]
         p_row['category'] = " ".join([cat['name_jp'] for cat in p_row['categories']])
+        p_row['image_variants'] = image_variants(p_row['image_path'])
         products.append(p_row)
-    return jsonify(products)
+    return products
+
+@app.route('/api/get_products')
+def get_products():
+    return menu_snapshot_response('products', _build_products)
 
 @app.route('/api/get_order_history/<int:table_id>', methods=['GET'])
 def get_order_history(table_id):
     access_token = request.args.get('token')
     if not access_token: return jsonify({"status": "error", "message": "Access token is missing."}), 403
-    db = get_db()
-    cursor = db.cursor(cursor_factory=RealDictCursor)
-    cursor.execute("SELECT id FROM table_sessions WHERE table_id = %s AND access_token = %s AND status = 'active'", (table_id, access_token))
-    if not cursor.fetchone(): return jsonify({"status": "error", "message": "Invalid or expired access token."}), 403
-    cursor.execute("SELECT o.id as order_id, o.created_at, oi.item_name, oi.quantity, oi.price, oi.item_status FROM orders o JOIN order_items oi ON o.id = oi.order_id WHERE o.table_id = %s AND o.status = 'active' ORDER BY o.created_at ASC, oi.id ASC", (table_id,))
-    history_items = cursor.fetchall()
-    history = {"items": history_items}
-    history["total_price"] = sum(item['price'] * item['quantity'] for item in history['items'])
-    return jsonify(history)
+
+    def build():
+        cursor = get_db().cursor(cursor_factory=RealDictCursor)
+        if not is_valid_table_session(cursor, table_id, access_token): return jsonify({"status": "error", "message": "Invalid or expired access token."}), 403
+        cursor.execute("SELECT o.id as order_id, o.created_at, o.total_price as order_total, oi.item_name, oi.quantity, oi.price, oi.item_status FROM orders o JOIN order_items oi ON o.id = oi.order_id WHERE o.table_id = %s AND o.status = 'active' ORDER BY o.created_at ASC, oi.id ASC", (table_id,))
+        history_items = cursor.fetchall()
+        # 合計は明細から計算せず、注文ごとに保存されている合計金額を使う (レジ画面と同じ値)
+        order_totals = {item['order_id']: item.pop('order_total') for item in history_items}
+        return jsonify({"items": history_items, "total_price": sum(order_totals.values())})
+
+    return etag_response(build)
+
+ORDER_LOCK_NAMESPACE = 7305002
+# 合計金額は明細の追加・変更・取消のたびに差分で更新する。check-totals で明細との一致を確認できる
+TOTAL_PRICE_TOLERANCE = 0.005
 
 @app.route('/api/order', methods=['POST'])
 def receive_order():
@@ -233,31 +1234,47 @@ def receive_order():
     order_data = request.get_json()
     table_id, access_token = order_data.get('tableId'), order_data.get('accessToken')
     if not access_token: return jsonify({"status": "error", "message": "Access token is missing."}), 403
-    cursor.execute("SELECT id FROM table_sessions WHERE table_id = %s AND access_token = %s AND status = 'active'", (table_id, access_token))
-    if not cursor.fetchone(): return jsonify({"status": "error", "message": "Invalid or expired access token."}), 403
+    if not is_valid_table_session(cursor, table_id, access_token): return jsonify({"status": "error", "message": "Invalid or expired access token."}), 403
     try:
-        cursor.execute("SELECT id FROM orders WHERE table_id = %s AND status = 'active'", (table_id,))
-        active_order = cursor.fetchone()
-        order_id = active_order['id'] if active_order else None
-        if not order_id:
-            cursor.execute("INSERT INTO orders (table_id, total_price, status, created_at) VALUES (%s, %s, %s, %s) RETURNING id", (table_id, 0, 'active', datetime.now(timezone.utc).timestamp()))
+        # 同じテーブルからの同時注文はテーブル単位のロックで直列化する
+        cursor.execute("SELECT pg_advisory_xact_lock(%s, %s)", (ORDER_LOCK_NAMESPACE, table_id))
+        # キャッシュで確認した後、LISTENで無効化が届く前に会計されている場合があるため、ロックを取ってからDBで確認し直す
+        # (会計も同じロックを取るので、ここで有効なら注文を登録し終えるまで会計されない)
+        if not table_session_is_active(cursor, table_id, access_token):
+            db.rollback()
+            return jsonify({"status": "error", "message": "Invalid or expired access token."}), 403
+        cursor.execute("""
+            INSERT INTO orders (table_id, total_price, status, created_at) VALUES (%s, 0, 'active', %s)
+            ON CONFLICT (table_id) WHERE status = 'active' DO NOTHING RETURNING id
+        """, (table_id, datetime.now(timezone.utc).timestamp()))
+        created_order = cursor.fetchone()
+        if created_order:
+            order_id = created_order['id']
+        else:
+            cursor.execute("SELECT id FROM orders WHERE table_id = %s AND status = 'active'", (table_id,))
             order_id = cursor.fetchone()['id']
+        # カート内の同一商品をまとめ、販売可否と価格は1回のクエリで確認する
+        quantities = {}
         for item in order_data.get('items', []):
-            cursor.execute("SELECT price FROM products WHERE name = %s AND is_sold_out = 0", (item['name'],))
-            db_item = cursor.fetchone()
-            if not db_item:
+            quantities[item['name']] = quantities.get(item['name'], 0) + item['quantity']
+        cursor.execute("SELECT name, price FROM products WHERE name = ANY(%s) AND is_sold_out = 0", (list(quantities),))
+        prices = {row['name']: row['price'] for row in cursor.fetchall()}
+        for name in quantities:
+            if name not in prices:
                 db.rollback()
-                return jsonify({"status": "error", "message": f"「{item['name']}」は現在注文できません。"}), 400
-            cursor.execute("SELECT id, quantity FROM order_items WHERE order_id = %s AND item_name = %s AND item_status = 'cooking'", (order_id, item['name']))
-            existing_item = cursor.fetchone()
-            if existing_item:
-                new_quantity = existing_item['quantity'] + item['quantity']
-                cursor.execute("UPDATE order_items SET quantity = %s WHERE id = %s", (new_quantity, existing_item['id']))
-            else:
-                cursor.execute("INSERT INTO order_items (order_id, item_name, quantity, price, item_status) VALUES (%s, %s, %s, %s, %s)", (order_id, item['name'], item['quantity'], db_item['price'], 'cooking'))
-        cursor.execute("SELECT SUM(price * quantity) FROM order_items WHERE order_id = %s", (order_id,))
-        new_total = cursor.fetchone()['sum'] or 0
-        cursor.execute("UPDATE orders SET total_price = %s WHERE id = %s", (new_total, order_id))
+                return jsonify({"status": "error", "message": f"「{name}」は現在注文できません。"}), 400
+        if quantities:
+            # 調理中の行に数量を加算した場合、その行の単価は登録時のまま残るため、合計の加算額は保存された単価で計算する
+            rows = execute_values(cursor, """
+                INSERT INTO order_items (order_id, item_name, quantity, price, item_status) VALUES %s
+                ON CONFLICT (order_id, item_name) WHERE item_status = 'cooking'
+                DO UPDATE SET quantity = order_items.quantity + EXCLUDED.quantity
+                RETURNING item_name, price
+            """, [(order_id, name, quantity, prices[name], 'cooking') for name, quantity in quantities.items()], fetch=True)
+            added_total = sum(row['price'] * quantities[row['item_name']] for row in rows)
+            cursor.execute("UPDATE orders SET total_price = total_price + %s WHERE id = %s", (added_total, order_id))
+        record_change(cursor, table_id, order_id)
+        notify_event(cursor, 'order_item_added', table_id=table_id, order_id=order_id)
         db.commit()
         return jsonify({"status": "success", "orderId": order_id})
     except Exception as e:
@@ -271,14 +1288,15 @@ def handle_call():
     if call_type not in ['normal', 'checkout']: call_type = 'normal'
     db = get_db()
     cursor = db.cursor(cursor_factory=RealDictCursor)
-    cursor.execute("SELECT id FROM table_sessions WHERE table_id = %s AND access_token = %s AND status = 'active'", (table_id, access_token))
-    if not cursor.fetchone(): return jsonify({"status": "error", "message": "無効なアクセスです"}), 403
+    if not is_valid_table_session(cursor, table_id, access_token): return jsonify({"status": "error", "message": "無効なアクセスです"}), 403
     cursor.execute("""
         INSERT INTO calls (table_id, call_time, call_type, status) 
         VALUES (%s, %s, %s, 'new') 
         ON CONFLICT (table_id) 
         DO UPDATE SET call_time = EXCLUDED.call_time, call_type = EXCLUDED.call_type, status = 'new'
     """, (table_id, datetime.now(timezone.utc).timestamp(), call_type))
+    record_change(cursor, table_id)
+    notify_event(cursor, 'call_raised', table_id=table_id, call_type=call_type)
     db.commit()
     return jsonify({"status": "success"})
 
@@ -291,15 +1309,35 @@ def generate_table_token(table_id):
     cursor.execute("UPDATE table_sessions SET status = 'expired' WHERE table_id = %s AND status = 'active'", (table_id,))
     token = secrets.token_urlsafe(16)
     cursor.execute("INSERT INTO table_sessions (table_id, access_token, status, created_at) VALUES (%s, %s, %s, %s)", (table_id, token, 'active', datetime.now(timezone.utc).timestamp()))
+    notify_event(cursor, 'table_session_expired', table_id=table_id)
     db.commit()
     return jsonify({"status": "success", "accessToken": token, "tableId": table_id})
 
 @app.route('/api/get_calls')
 @staff_required
 def get_calls():
-    cursor = get_db().cursor(cursor_factory=RealDictCursor)
-    cursor.execute("SELECT table_id, call_time, call_type FROM calls WHERE status = 'new' ORDER BY call_time ASC")
-    return jsonify(cursor.fetchall())
+    def build():
+        cursor = get_db().cursor(cursor_factory=RealDictCursor)
+        cursor.execute("SELECT table_id, call_time, call_type FROM calls WHERE status = 'new' ORDER BY call_time ASC")
+        return jsonify(cursor.fetchall())
+
+    return etag_response(build)
+
+@app.route('/api/server_features')
+def get_server_features():
+    """画面側が更新方法を選ぶための情報。ロングポーリング (?wait=) はasgi.pyで起動している場合だけ有効です。"""
+    return jsonify({"longPoll": app.config['ASYNC_SERVING'], "longPollMaxSeconds": LONG_POLL_MAX_SECONDS if app.config['ASYNC_SERVING'] else 0})
+
+@app.route('/api/events/token', methods=['POST'])
+@staff_required
+def issue_event_stream_token():
+    """SSE (/api/events) 接続用の短命トークンを発行します。プッシュ配信はasgi.pyで起動している場合だけ有効です。"""
+    if not app.config['ASYNC_SERVING']:
+        # 同期ワーカーでは接続1本がワーカーを占有するため、画面は従来のポーリングを続ける
+        return jsonify({"status": "success", "push": False})
+    payload = {'username': g.user_username, 'scope': EVENT_STREAM_TOKEN_SCOPE,
+               'exp': datetime.now(timezone.utc) + timedelta(seconds=EVENT_STREAM_TOKEN_SECONDS)}
+    return jsonify({"status": "success", "push": True, "streamToken": jwt.encode(payload, JWT_SECRET_KEY, algorithm="HS256")})
 
 @app.route('/api/resolve_call/<int:table_id>', methods=['POST'])
 @staff_required
@@ -314,19 +1352,102 @@ def resolve_call(table_id):
         cursor.execute("UPDATE calls SET status = 'acknowledged' WHERE table_id = %s", (table_id,))
     else:
         cursor.execute("DELETE FROM calls WHERE table_id = %s", (table_id,))
+    record_change(cursor, table_id)
+    notify_event(cursor, 'call_resolved', table_id=table_id)
     db.commit()
     return jsonify({"status": "success"})
 
+# --- 変更履歴 (差分取得用のリビジョン) ---
+# 変更のたびにchange_logへ1行記録し、書き込んだトランザクションのID (xid) を残す。
+# 差分取得のカーソル (revision) には、読み取り時のスナップショットのxmin (これより古いトランザクションはすべて終了済み) を使う。
+# 次回は xid >= 前回のxmin の行を返すので、前回の時点で実行中だった変更も、後からコミットされた時点で必ず返る
+# (同じ行を2回返すことはあるが、差分は変更のあったテーブル・注文を読み直すだけなので問題ない)。
+# これにより、全テーブル共通のロックで記録を直列化しなくても、コミット順の入れ替わりで変更を読み飛ばさない。
+# 古い履歴の削除はリクエストの外で行う (prune_change_log。LISTENスレッドが定期的に実行するほか、change-log-prune コマンドでも実行できる)
+CHANGE_LOG_RETENTION_SECONDS = 24 * 60 * 60
+CHANGE_LOG_PRUNE_INTERVAL_SECONDS = 60 * 60
+# 以前のBIGSERIALのリビジョンを持ったままのクライアントと区別するため、カーソルはxminにこの値を足して返す
+# (これより小さいsinceは全件取得にする。2**52まではJavaScriptの数値でも正確に扱える)
+CHANGE_LOG_CURSOR_BASE = 2 ** 52
+
+def record_change(cursor, table_id, order_id=None):
+    cursor.execute("INSERT INTO change_log (table_id, order_id, created_at) VALUES (%s, %s, %s)", (table_id, order_id, datetime.now(timezone.utc).timestamp()))
+
+def record_order_change(cursor, order_id):
+    """変更履歴を記録し、注文のテーブル番号を返します。"""
+    cursor.execute("INSERT INTO change_log (table_id, order_id, created_at) SELECT table_id, id, %s FROM orders WHERE id = %s RETURNING table_id", (datetime.now(timezone.utc).timestamp(), order_id))
+    row = cursor.fetchone()
+    return row['table_id'] if row else None
+
+def record_item_change(cursor, item_id):
+    """変更履歴を記録し、商品が属するテーブル番号を返します。"""
+    cursor.execute("INSERT INTO change_log (table_id, order_id, created_at) SELECT o.table_id, o.id, %s FROM order_items oi JOIN orders o ON o.id = oi.order_id WHERE oi.id = %s RETURNING table_id", (datetime.now(timezone.utc).timestamp(), item_id))
+    row = cursor.fetchone()
+    return row['table_id'] if row else None
+
+def record_table_checkout(cursor, table_id, order_ids):
+    now = datetime.now(timezone.utc).timestamp()
+    cursor.execute("INSERT INTO change_log (table_id, order_id, created_at) SELECT %s, unnest(%s::integer[]), %s", (table_id, order_ids, now))
+    cursor.execute("INSERT INTO change_log (table_id, order_id, created_at) VALUES (%s, NULL, %s)", (table_id, now))
+
+def prune_change_log(cursor):
+    """保持期間を過ぎた変更履歴を削除し、削除件数を返します。
+    削除はxidの境界で行い、境界のトランザクションの行は残す (これより古いカーソルは全件取得になる)。"""
+    cutoff = datetime.now(timezone.utc).timestamp() - CHANGE_LOG_RETENTION_SECONDS
+    cursor.execute("DELETE FROM change_log WHERE xid < (SELECT MAX(xid) FROM change_log WHERE created_at < %s)", (cutoff,))
+    return cursor.rowcount
+
+def get_changes_since(cursor, since):
+    """(現在のリビジョン, 全件取得が必要か, 変更のあった行) を返します。"""
+    # カーソルは変更を読むより前のスナップショットで決める (後で決めると、その間にコミットされた変更を読み飛ばす)
+    cursor.execute("SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint AS horizon, MIN(xid) AS oldest FROM change_log")
+    row = cursor.fetchone()
+    current = CHANGE_LOG_CURSOR_BASE + row['horizon']
+    if since < CHANGE_LOG_CURSOR_BASE or since > current or (row['oldest'] is not None and since - CHANGE_LOG_CURSOR_BASE < row['oldest']):
+        return current, True, []
+    cursor.execute("SELECT DISTINCT table_id, order_id FROM change_log WHERE xid >= %s", (since - CHANGE_LOG_CURSOR_BASE,))
+    return current, False, cursor.fetchall()
+
+def parse_since_param():
+    since = request.args.get('since')
+    if since is None:
+        return None
+    try:
+        return int(since)
+    except ValueError:
+        return 0
+
+def fetch_active_orders(cursor):
+    cursor.execute("SELECT * FROM orders WHERE status = 'active' ORDER BY created_at ASC")
+    return attach_order_items(cursor, cursor.fetchall())
+
+def attach_order_items(cursor, orders):
+    """注文ごとの明細を1回のクエリでまとめて取得し、各注文の'items'に格納します。"""
+    items_by_order = {order['id']: [] for order in orders}
+    for order in orders:
+        order['items'] = items_by_order[order['id']]
+    if not items_by_order:
+        return orders
+    cursor.execute("SELECT * FROM order_items WHERE order_id = ANY(%s) ORDER BY order_id, id", (list(items_by_order),))
+    for item in cursor.fetchall():
+        items_by_order[item['order_id']].append(item)
+    return orders
+
 @app.route('/api/get_all_active_orders')
 @staff_required
 def get_all_active_orders():
     cursor = get_db().cursor(cursor_factory=RealDictCursor)
-    cursor.execute("SELECT * FROM orders WHERE status != 'paid' ORDER BY created_at ASC")
-    orders = cursor.fetchall()
-    for order in orders:
-        cursor.execute("SELECT * FROM order_items WHERE order_id = %s", (order['id'],))
-        order['items'] = cursor.fetchall()
-    return jsonify(orders)
+    since = parse_since_param()
+    if since is None:
+        return jsonify(fetch_active_orders(cursor))
+    revision, full, changes = get_changes_since(cursor, since)
+    if full:
+        return jsonify({"revision": revision, "full": True, "orders": fetch_active_orders(cursor), "removed_order_ids": []})
+    changed_ids = list({row['order_id'] for row in changes if row['order_id'] is not None})
+    cursor.execute("SELECT * FROM orders WHERE id = ANY(%s) AND status = 'active' ORDER BY created_at ASC", (changed_ids,))
+    orders = attach_order_items(cursor, cursor.fetchall())
+    active_ids = {order['id'] for order in orders}
+    return jsonify({"revision": revision, "full": False, "orders": orders, "removed_order_ids": [oid for oid in changed_ids if oid not in active_ids]})
 
 @app.route('/api/update_item_status/<int:item_id>', methods=['POST'])
 @staff_required
@@ -338,6 +1459,8 @@ def update_item_status(item_id):
         cursor.execute("UPDATE order_items SET item_status = %s, ready_at = %s WHERE id = %s", (new_status, datetime.now(timezone.utc).timestamp(), item_id))
     else:
         cursor.execute("UPDATE order_items SET item_status = %s WHERE id = %s", (new_status, item_id))
+    table_id = record_item_change(cursor, item_id)
+    notify_event(cursor, 'item_status_changed', table_id=table_id, item_id=item_id, status=new_status)
     db.commit()
     return jsonify({"status": "success"})
 
@@ -348,14 +1471,17 @@ def update_item_quantity(item_id):
     cursor = db.cursor(cursor_factory=RealDictCursor)
     new_quantity = request.get_json().get('quantity')
     if not isinstance(new_quantity, int) or new_quantity <= 0: return jsonify({"status": "error", "message": "Invalid quantity"}), 400
-    cursor.execute("SELECT order_id FROM order_items WHERE id = %s", (item_id,))
+    # 明細を合計し直さず、数量の差分だけを注文の合計金額に加える (同じ文の中で行う)
+    cursor.execute("""
+        WITH old AS (SELECT id, quantity FROM order_items WHERE id = %s FOR UPDATE),
+        item AS (UPDATE order_items oi SET quantity = %s FROM old WHERE oi.id = old.id RETURNING oi.order_id, oi.price * (oi.quantity - old.quantity) AS delta)
+        UPDATE orders o SET total_price = o.total_price + item.delta FROM item WHERE o.id = item.order_id RETURNING o.id
+    """, (item_id, new_quantity))
     res = cursor.fetchone()
     if not res: return jsonify({"status": "error", "message": "Item not found"}), 404
-    order_id = res['order_id']
-    cursor.execute("UPDATE order_items SET quantity = %s WHERE id = %s", (new_quantity, item_id))
-    cursor.execute("SELECT SUM(price * quantity) FROM order_items WHERE order_id = %s", (order_id,))
-    new_total = cursor.fetchone()['sum'] or 0
-    cursor.execute("UPDATE orders SET total_price = %s WHERE id = %s", (new_total, order_id))
+    order_id = res['id']
+    table_id = record_order_change(cursor, order_id)
+    notify_event(cursor, 'item_quantity_changed', table_id=table_id, item_id=item_id, order_id=order_id, quantity=new_quantity)
     db.commit()
     return jsonify({"status": "success"})
 
@@ -364,16 +1490,16 @@ def update_item_quantity(item_id):
 def cancel_item(item_id):
     db = get_db()
     cursor = db.cursor(cursor_factory=RealDictCursor)
-    cursor.execute("SELECT order_id FROM order_items WHERE id = %s", (item_id,))
+    cursor.execute("""
+        WITH item AS (DELETE FROM order_items WHERE id = %s RETURNING order_id, price * quantity AS amount)
+        UPDATE orders o SET total_price = o.total_price - item.amount FROM item WHERE o.id = item.order_id RETURNING o.id, o.table_id
+    """, (item_id,))
     result = cursor.fetchone()
     if not result: return jsonify({"status": "error", "message": "Item not found"}), 404
-    order_id = result['order_id']
-    cursor.execute("DELETE FROM order_items WHERE id = %s", (item_id,))
-    cursor.execute("SELECT SUM(price * quantity) FROM order_items WHERE order_id = %s", (order_id,))
-    new_total = cursor.fetchone()['sum'] or 0
-    cursor.execute("UPDATE orders SET total_price = %s WHERE id = %s", (new_total, order_id))
-    cursor.execute("SELECT COUNT(*) FROM order_items WHERE order_id = %s", (order_id,))
-    if cursor.fetchone()['count'] == 0: cursor.execute("DELETE FROM orders WHERE id = %s", (order_id,))
+    order_id = result['id']
+    cursor.execute("DELETE FROM orders WHERE id = %s AND NOT EXISTS (SELECT 1 FROM order_items WHERE order_id = %s)", (order_id, order_id))
+    record_change(cursor, result['table_id'], order_id)
+    notify_event(cursor, 'item_cancelled', table_id=result['table_id'], item_id=item_id, order_id=order_id)
     db.commit()
     return jsonify({"status": "success"})
 
@@ -381,29 +1507,53 @@ def cancel_item(item_id):
 @staff_required
 def get_table_summary():
     cursor = get_db().cursor(cursor_factory=RealDictCursor)
-    cursor.execute("SELECT table_id, call_type FROM calls")
+    since = parse_since_param()
+    if since is None:
+        return jsonify(build_table_summary(cursor))
+    revision, full, changes = get_changes_since(cursor, since)
+    if full:
+        return jsonify({"revision": revision, "full": True, "tables": build_table_summary(cursor), "removed_table_ids": []})
+    changed_table_ids = list({row['table_id'] for row in changes if row['table_id'] is not None})
+    tables = build_table_summary(cursor, changed_table_ids) if changed_table_ids else []
+    active_table_ids = {table['table_id'] for table in tables}
+    return jsonify({"revision": revision, "full": False, "tables": tables, "removed_table_ids": [tid for tid in changed_table_ids if tid not in active_table_ids]})
+
+def build_table_summary(cursor, table_ids=None):
+    if table_ids is None:
+        cursor.execute("SELECT table_id, call_type FROM calls")
+    else:
+        cursor.execute("SELECT table_id, call_type FROM calls WHERE table_id = ANY(%s)", (table_ids,))
     calls_map = {row['table_id']: row['call_type'] for row in cursor.fetchall()}
-    cursor.execute("SELECT * FROM orders WHERE status != 'paid' ORDER BY table_id, created_at ASC")
+    if table_ids is None:
+        cursor.execute("SELECT * FROM orders WHERE status = 'active' ORDER BY table_id, created_at ASC")
+    else:
+        cursor.execute("SELECT * FROM orders WHERE status = 'active' AND table_id = ANY(%s) ORDER BY table_id, created_at ASC", (table_ids,))
+    orders = cursor.fetchall()
+    attach_order_items(cursor, orders)
     table_summary = {}
-    for order_row in cursor.fetchall():
+    for order_row in orders:
         table_id = order_row['table_id']
         if table_id not in table_summary: 
             table_summary[table_id] = {"table_id": table_id, "orders": [], "grand_total": 0, "call_type": calls_map.get(table_id, None)}
-        
-        cursor.execute("SELECT * FROM order_items WHERE order_id = %s", (order_row['id'],))
-        order_row['items'] = cursor.fetchall()
         table_summary[table_id]['orders'].append(order_row)
         table_summary[table_id]['grand_total'] += order_row.get('total_price', 0)
-    return jsonify(list(table_summary.values()))
+    return list(table_summary.values())
 
 @app.route('/api/checkout_table/<int:table_id>', methods=['POST'])
 @staff_required
 def checkout_table(table_id):
     db = get_db()
     cursor = db.cursor(cursor_factory=RealDictCursor)
-    cursor.execute("UPDATE orders SET status = 'paid', paid_at = %s WHERE table_id = %s AND status != 'paid'", (datetime.now(timezone.utc).timestamp(), table_id))
+    # 注文の追加と会計が同時に走らないよう、receive_orderと同じテーブル単位のロックを取る
+    cursor.execute("SELECT pg_advisory_xact_lock(%s, %s)", (ORDER_LOCK_NAMESPACE, table_id))
+    cursor.execute("UPDATE orders SET status = 'paid', paid_at = %s WHERE table_id = %s AND status = 'active' RETURNING id", (datetime.now(timezone.utc).timestamp(), table_id))
+    paid_order_ids = [row['id'] for row in cursor.fetchall()]
     cursor.execute("UPDATE table_sessions SET status = 'expired' WHERE table_id = %s AND status = 'active'", (table_id,))
     cursor.execute("DELETE FROM calls WHERE table_id = %s", (table_id,))
+    if paid_order_ids:
+        apply_rollups(cursor, "o.id = ANY(%(order_ids)s)", {"order_ids": paid_order_ids})
+    record_table_checkout(cursor, table_id, paid_order_ids)
+    notify_event(cursor, 'table_checked_out', table_id=table_id)
     db.commit()
     return jsonify({"status": "success"})
 
@@ -433,11 +1583,13 @@ def get_order_for_print(order_id):
     return jsonify({"order": order, "items": items, "store_info": store_info})
 
 # --- API: 顧客・管理者向け ---
+def _build_categories(cursor):
+    cursor.execute("SELECT id, name_jp, name_en, display_order FROM categories ORDER BY display_order, id")
+    return cursor.fetchall()
+
 @app.route('/api/get_categories')
 def get_categories():
-    cursor = get_db().cursor(cursor_factory=RealDictCursor)
-    cursor.execute("SELECT id, name_jp, name_en, display_order FROM categories ORDER BY display_order, id")
-    return jsonify(cursor.fetchall())
+    return menu_snapshot_response('categories', _build_categories)
 
     # --- 管理者向けAPI ---
 @app.route('/api/admin/get_categories')
@@ -456,6 +1608,7 @@ def add_category():
     try:
         cursor.execute("INSERT INTO categories (name_jp, name_en) VALUES (%s, %s) RETURNING id", (data['name_jp'], data['name_en']))
         new_id = cursor.fetchone()['id']
+        bump_menu_version(cursor)
         db.commit()
         return jsonify({"status": "success", "id": new_id})
     except psycopg2.errors.UniqueViolation:
@@ -473,6 +1626,7 @@ def update_category(category_id):
     cursor = db.cursor(cursor_factory=RealDictCursor)
     try:
         cursor.execute("UPDATE categories SET name_jp = %s, name_en = %s WHERE id = %s", (data['name_jp'], data['name_en'], category_id))
+        bump_menu_version(cursor)
         db.commit()
         return jsonify({"status": "success"})
     except psycopg2.errors.UniqueViolation:
@@ -491,6 +1645,7 @@ def delete_category(category_id):
         cursor.execute("SELECT COUNT(*) FROM product_categories WHERE category_id = %s", (category_id,))
         if cursor.fetchone()['count'] > 0: return jsonify({"status": "error", "message": "このカテゴリーを使用しているメニューが存在するため、削除できません。"}), 400
         cursor.execute("DELETE FROM categories WHERE id = %s", (category_id,))
+        bump_menu_version(cursor)
         db.commit()
         return jsonify({"status": "success"})
     except Exception as e:
@@ -511,20 +1666,21 @@ def get_store_info():
 def update_store_info():
     db = get_db()
     cursor = db.cursor(cursor_factory=RealDictCursor)
+    job_ids = []
     try:
         for key in ['store_name', 'store_address', 'store_tel', 'store_receipt_note']:
             if key in request.form:
                 cursor.execute("INSERT INTO settings (key, value) VALUES (%s, %s) ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value", (key, request.form[key]))
         if 'store_qr_code' in request.files and request.files['store_qr_code'].filename != '':
             qr_file = request.files['store_qr_code']
-            img = Image.open(qr_file.stream)
             ext = os.path.splitext(secure_filename(qr_file.filename))[1].lower()
             if ext not in ['.png', '.jpg', '.jpeg', '.gif']: raise IOError("Invalid QR code image format")
             filename = f"qr_code{ext}"
-            img.save(os.path.join(app.config['IMAGES_FOLDER'], filename))
-            cursor.execute("UPDATE settings SET value = %s WHERE key = 'store_qr_code_path'", (filename,))
+            # QRコードは読み取りに影響するため派生画像は作らず、メタデータの除去だけ行う
+            job_ids.append(enqueue_image_job(cursor, qr_file, filename, 'setting', 'store_qr_code_path', variants=False))
         db.commit()
-        return jsonify({"status": "success", "message": "店舗情報を更新しました。"})
+        _ensure_image_worker()
+        return jsonify({"status": "success", "message": "店舗情報を更新しました。", "imageJobIds": job_ids})
     except Exception as e:
         db.rollback()
         return jsonify({"status": "error", "message": str(e)}), 500
@@ -552,6 +1708,7 @@ def delete_qr_code():
 def update_opening():
     db = get_db()
     cursor = db.cursor(cursor_factory=RealDictCursor)
+    job_ids = []
     try:
         key_map = {'opening_message': 'opening_message', 'writing_mode': 'opening_writing_mode', 'opening_effect': 'opening_effect', 'opening_duration': 'opening_duration'}
         for form_key, db_key in key_map.items():
@@ -559,14 +1716,13 @@ def update_opening():
                 cursor.execute("UPDATE settings SET value = %s WHERE key = %s", (request.form.get(form_key), db_key))
         for db_key, file in [('opening_image_path', request.files.get('opening_image_1')), ('opening_image_path_2', request.files.get('opening_image_2'))]:
             if file and file.filename != '':
-                img = Image.open(file.stream)
                 ext = os.path.splitext(secure_filename(file.filename))[1].lower()
-                if ext not in ['.png', '.jpg', '.jpeg', '.gif', '.webp']: raise IOError("Invalid image format")
+                if ext not in IMAGE_EXTENSIONS: raise IOError("Invalid image format")
                 filename = f"{db_key.replace('_path', '')}{ext}"
-                img.save(os.path.join(app.config['IMAGES_FOLDER'], filename))
-                cursor.execute("UPDATE settings SET value = %s WHERE key = %s", (filename, db_key))
+                job_ids.append(enqueue_image_job(cursor, file, filename, 'setting', db_key))
         db.commit()
-        return jsonify({"status": "success"})
+        _ensure_image_worker()
+        return jsonify({"status": "success", "imageJobIds": job_ids})
     except Exception as e:
         db.rollback()
         return jsonify({"status": "error", "message": str(e)}), 500
@@ -584,6 +1740,7 @@ def delete_opening_image(image_number):
         if result and result['value']:
             filepath = os.path.join(app.config['IMAGES_FOLDER'], result['value'])
             if os.path.exists(filepath): os.remove(filepath)
+            remove_image_variants(result['value'])
         cursor.execute("UPDATE settings SET value = '' WHERE key = %s", (db_key,))
         db.commit()
         return jsonify({"status": "success"})
@@ -616,35 +1773,162 @@ def change_password():
         db.rollback()
         return jsonify({"status": "error", "message": str(e)}), 500
 
+# --- 売上分析の集計テーブル (ロールアップ) ---
+# 会計時に支払済み注文を日別・時間帯別に加算しておき、分析APIは集計済みの行だけを読む。
+# 日付・時間帯は既存の期間指定と同じくUTCで区切る。導入時の過去データはマイグレーション5で集計し、
+# 以後に集計方法を変えた場合などは flask rollup-backfill で再集計する
+ROLLUP_DAY = "(to_timestamp(o.paid_at) AT TIME ZONE 'UTC')::date"
+# 調理時間ヒストグラムの区切り (秒)。10分までは30秒刻み、30分までは1分刻み、それ以降は粗くする。
+# 日ごとの件数を足し合わせるだけで任意の期間のパーセンタイルを推定できる。変更したら rollup-backfill が必要
+COOKING_BUCKET_BOUNDS = (
+    list(range(0, 600, 30)) + list(range(600, 1800, 60)) + list(range(1800, 3600, 300))
+    + [3600, 5400, 7200, 10800, 21600, 43200, 86400]
+)
+
+def apply_rollups(cursor, order_filter, params):
+    """order_filterに一致する支払済み注文を各集計テーブルに加算します。"""
+    cursor.execute(f"""
+        INSERT INTO sales_daily_product (day, item_name, quantity, revenue)
+        SELECT {ROLLUP_DAY}, oi.item_name, SUM(oi.quantity), SUM(oi.price * oi.quantity)
+        FROM orders o JOIN order_items oi ON oi.order_id = o.id WHERE {order_filter} GROUP BY 1, 2
+        ON CONFLICT (day, item_name) DO UPDATE SET quantity = sales_daily_product.quantity + EXCLUDED.quantity, revenue = sales_daily_product.revenue + EXCLUDED.revenue
+    """, params)
+    cursor.execute(f"""
+        INSERT INTO sales_hourly (day, hour, revenue, order_count)
+        SELECT {ROLLUP_DAY}, EXTRACT(HOUR FROM to_timestamp(o.paid_at) AT TIME ZONE 'UTC'), SUM(oi.price * oi.quantity), COUNT(DISTINCT o.id)
+        FROM orders o JOIN order_items oi ON oi.order_id = o.id WHERE {order_filter} GROUP BY 1, 2
+        ON CONFLICT (day, hour) DO UPDATE SET revenue = sales_hourly.revenue + EXCLUDED.revenue, order_count = sales_hourly.order_count + EXCLUDED.order_count
+    """, params)
+    cursor.execute(f"""
+        INSERT INTO cooking_time_daily (day, item_name, duration_sum, duration_count)
+        SELECT {ROLLUP_DAY}, oi.item_name, SUM(oi.ready_at - o.created_at), COUNT(*)
+        FROM orders o JOIN order_items oi ON oi.order_id = o.id
+        WHERE {order_filter} AND oi.ready_at IS NOT NULL AND oi.ready_at - o.created_at >= 0 AND oi.ready_at - o.created_at < 86400
+        GROUP BY 1, 2
+        ON CONFLICT (day, item_name) DO UPDATE SET duration_sum = cooking_time_daily.duration_sum + EXCLUDED.duration_sum, duration_count = cooking_time_daily.duration_count + EXCLUDED.duration_count
+    """, params)
+    cursor.execute(f"""
+        INSERT INTO cooking_time_histogram (day, item_name, hour, bucket, count)
+        SELECT {ROLLUP_DAY}, oi.item_name, EXTRACT(HOUR FROM to_timestamp(o.created_at) AT TIME ZONE 'UTC'),
+               width_bucket((oi.ready_at - o.created_at)::float8, %(cooking_bucket_bounds)s::float8[]), COUNT(*)
+        FROM orders o JOIN order_items oi ON oi.order_id = o.id
+        WHERE {order_filter} AND oi.ready_at IS NOT NULL AND oi.ready_at - o.created_at >= 0 AND oi.ready_at - o.created_at < 86400
+        GROUP BY 1, 2, 3, 4
+        ON CONFLICT (day, item_name, hour, bucket) DO UPDATE SET count = cooking_time_histogram.count + EXCLUDED.count
+    """, dict(params, cooking_bucket_bounds=COOKING_BUCKET_BOUNDS))
+    # 滞在開始は会計直前に発行されたテーブルセッション (なければ注文の作成時刻)
+    cursor.execute(f"""
+        INSERT INTO session_durations (order_id, table_id, day, start_time, end_time, total_price)
+        SELECT o.id, o.table_id, {ROLLUP_DAY}, COALESCE(s.created_at, o.created_at), o.paid_at, o.total_price
+        FROM orders o
+        LEFT JOIN LATERAL (SELECT ts.created_at FROM table_sessions ts WHERE ts.table_id = o.table_id AND ts.created_at < o.paid_at ORDER BY ts.created_at DESC LIMIT 1) s ON TRUE
+        WHERE {order_filter}
+        ON CONFLICT (order_id) DO NOTHING
+    """, params)
+
+def rebuild_rollups(cursor, start_date=None, end_date=None):
+    """指定期間 (省略時は全期間) の集計テーブルを削除し、支払済み注文から作り直します。"""
+    rollup_tables = ['sales_daily_product', 'sales_hourly', 'cooking_time_daily', 'cooking_time_histogram', 'session_durations']
+    if start_date is None:
+        for table in rollup_tables:
+            cursor.execute(f"DELETE FROM {table}")
+        apply_rollups(cursor, "o.status = 'paid'", {})
+        return
+    params = {"start_date": start_date, "end_date": end_date}
+    for table in rollup_tables:
+        cursor.execute(f"DELETE FROM {table} WHERE day BETWEEN %(start_date)s AND %(end_date)s", params)
+    apply_rollups(cursor, f"o.status = 'paid' AND {ROLLUP_DAY} BETWEEN %(start_date)s AND %(end_date)s", params)
+
+SALES_GROUPINGS = {
+    'product': "SELECT item_name, SUM(quantity)::bigint AS quantity, SUM(revenue) AS total FROM sales_daily_product WHERE day BETWEEN %s AND %s GROUP BY item_name ORDER BY total DESC",
+    'day': "SELECT day::text AS day, SUM(quantity)::bigint AS quantity, SUM(revenue) AS total FROM sales_daily_product WHERE day BETWEEN %s AND %s GROUP BY day ORDER BY day",
+    'hour': "SELECT hour, SUM(order_count)::bigint AS order_count, SUM(revenue) AS total FROM sales_hourly WHERE day BETWEEN %s AND %s GROUP BY hour ORDER BY hour",
+}
+
+# 明細一覧 (?lines=1) の並び順と1ページの件数
+SALES_LINE_ORDERS = {
+    'time': "o.created_at, oi.id",
+    'table': "o.table_id, o.created_at, oi.id",
+}
+SALES_LINES_PAGE_SIZE = 200
+SALES_LINES_MAX_PAGE_SIZE = 1000
+
 @app.route('/api/admin/get_sales_data', methods=['GET'])
 @admin_role_required
 def get_sales_data():
     start_date_str, end_date_str = request.args.get('start_date'), request.args.get('end_date')
     if not start_date_str or not end_date_str: return jsonify({"status": "error", "message": "日付が指定されていません"}), 400
+    lines = request.args.get('lines') in ('1', 'true')
+    group_by = request.args.get('group_by', 'product')
+    if not lines and group_by not in SALES_GROUPINGS: return jsonify({"status": "error", "message": "無効な集計単位です"}), 400
+    sort = request.args.get('sort', 'time')
+    if lines and sort not in SALES_LINE_ORDERS: return jsonify({"status": "error", "message": "無効な並び順です"}), 400
     try:
         start_ts = datetime.strptime(start_date_str, '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp()
         end_ts = datetime.strptime(end_date_str, '%Y-%m-%d').replace(hour=23, minute=59, second=59, tzinfo=timezone.utc).timestamp()
         cursor = get_db().cursor(cursor_factory=RealDictCursor)
-        cursor.execute("SELECT o.created_at, o.table_id, oi.item_name, oi.quantity, oi.price FROM orders o JOIN order_items oi ON o.id = oi.order_id WHERE o.status = 'paid' AND o.paid_at BETWEEN %s AND %s ORDER BY o.paid_at ASC", (start_ts, end_ts))
-        return jsonify(cursor.fetchall())
+        if not lines:
+            cursor.execute(SALES_GROUPINGS[group_by], (start_date_str, end_date_str))
+            return jsonify(cursor.fetchall())
+        # 明細一覧は ?lines=1 を指定した場合だけ、ページ単位 (limit/offset) で返す
+        limit = min(max(int(request.args.get('limit', SALES_LINES_PAGE_SIZE)), 1), SALES_LINES_MAX_PAGE_SIZE)
+        offset = max(int(request.args.get('offset', 0)), 0)
+        cursor.execute(f"""
+            SELECT o.created_at, o.table_id, oi.item_name, oi.quantity, oi.price FROM orders o JOIN order_items oi ON o.id = oi.order_id
+            WHERE o.status = 'paid' AND o.paid_at BETWEEN %s AND %s ORDER BY {SALES_LINE_ORDERS[sort]} LIMIT %s OFFSET %s
+        """, (start_ts, end_ts, limit + 1, offset))
+        rows = cursor.fetchall()
+        return jsonify({"lines": rows[:limit], "nextOffset": offset + limit if len(rows) > limit else None})
     except Exception as e: return jsonify({"status": "error", "message": str(e)}), 500
 
+def estimate_quantiles(bucket_counts, quantiles, bounds=COOKING_BUCKET_BOUNDS):
+    """ヒストグラム ({バケット番号: 件数}) から各分位点の秒数をバケット内の線形補間で推定します。
+    バケット番号はwidth_bucketと同じく、n番目が bounds[n-1] 以上 bounds[n] 未満を表します。"""
+    total = sum(bucket_counts.values())
+    results = []
+    for q in quantiles:
+        target, cumulative = q * total, 0
+        for bucket in sorted(bucket_counts):
+            count = bucket_counts[bucket]
+            if cumulative + count >= target:
+                lower, upper = bounds[bucket - 1], bounds[min(bucket, len(bounds) - 1)]
+                results.append(lower + (upper - lower) * ((target - cumulative) / count))
+                break
+            cumulative += count
+    return results
+
+COOKING_PERCENTILE_GROUPS = {'product': ['item_name'], 'hour': ['hour'], 'product_hour': ['item_name', 'hour']}
+
+def cooking_time_percentiles(cursor, start_date_str, end_date_str, group_by):
+    group_columns = COOKING_PERCENTILE_GROUPS[group_by]
+    cursor.execute(f"SELECT {', '.join(group_columns)}, bucket, SUM(count)::bigint AS count FROM cooking_time_histogram WHERE day BETWEEN %s AND %s GROUP BY {', '.join(group_columns)}, bucket", (start_date_str, end_date_str))
+    histograms = {}
+    for row in cursor.fetchall():
+        key = tuple(row[column] for column in group_columns)
+        histograms.setdefault(key, {})[row['bucket']] = row['count']
+    results = []
+    for key, bucket_counts in sorted(histograms.items()):
+        p50, p90, p99 = estimate_quantiles(bucket_counts, [0.5, 0.9, 0.99])
+        results.append(dict(zip(group_columns, key), count=sum(bucket_counts.values()), p50_minutes=round(p50 / 60, 1), p90_minutes=round(p90 / 60, 1), p99_minutes=round(p99 / 60, 1)))
+    return results
+
 @app.route('/api/admin/get_cooking_times', methods=['GET'])
 @admin_role_required
 def get_cooking_times():
     start_date_str, end_date_str = request.args.get('start_date'), request.args.get('end_date')
     if not start_date_str or not end_date_str: return jsonify({"status": "error", "message": "日付が指定されていません"}), 400
     try:
-        start_ts = datetime.strptime(start_date_str, '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp()
-        end_ts = datetime.strptime(end_date_str, '%Y-%m-%d').replace(hour=23, minute=59, second=59, tzinfo=timezone.utc).timestamp()
+        datetime.strptime(start_date_str, '%Y-%m-%d'), datetime.strptime(end_date_str, '%Y-%m-%d')
         cursor = get_db().cursor(cursor_factory=RealDictCursor)
-        cursor.execute("SELECT oi.item_name, oi.ready_at - o.created_at AS cooking_duration FROM order_items oi JOIN orders o ON oi.order_id = o.id WHERE o.status = 'paid' AND o.paid_at BETWEEN %s AND %s AND oi.ready_at IS NOT NULL AND o.created_at IS NOT NULL", (start_ts, end_ts))
-        product_times = {}
-        for row in cursor.fetchall():
-            if 0 <= row['cooking_duration'] < 86400:
-                if row['item_name'] not in product_times: product_times[row['item_name']] = []
-                product_times[row['item_name']].append(row['cooking_duration'])
-        avg_cooking_times = {name: round((sum(d) / len(d)) / 60, 1) for name, d in product_times.items() if d}
+        if request.args.get('percentiles') in ('1', 'true'):
+            group_by = request.args.get('group_by', 'product')
+            if group_by not in COOKING_PERCENTILE_GROUPS: return jsonify({"status": "error", "message": "無効な集計単位です"}), 400
+            return jsonify(cooking_time_percentiles(cursor, start_date_str, end_date_str, group_by))
+        if request.args.get('group_by') == 'day':
+            cursor.execute("SELECT day::text AS day, item_name, ROUND((duration_sum / duration_count / 60)::numeric, 1)::float AS avg_minutes, duration_count FROM cooking_time_daily WHERE day BETWEEN %s AND %s ORDER BY day, item_name", (start_date_str, end_date_str))
+            return jsonify(cursor.fetchall())
+        cursor.execute("SELECT item_name, SUM(duration_sum) / SUM(duration_count) AS avg_seconds FROM cooking_time_daily WHERE day BETWEEN %s AND %s GROUP BY item_name", (start_date_str, end_date_str))
+        avg_cooking_times = {row['item_name']: round(row['avg_seconds'] / 60, 1) for row in cursor.fetchall()}
         return jsonify(avg_cooking_times)
     except Exception as e: return jsonify({"status": "error", "message": str(e)}), 500
 
@@ -657,55 +1941,308 @@ def get_session_durations():
         start_ts = datetime.strptime(start_date_str, '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp()
         end_ts = datetime.strptime(end_date_str, '%Y-%m-%d').replace(hour=23, minute=59, second=59, tzinfo=timezone.utc).timestamp()
         cursor = get_db().cursor(cursor_factory=RealDictCursor)
-        cursor.execute("SELECT id, table_id, created_at, paid_at, total_price FROM orders WHERE status = 'paid' AND paid_at BETWEEN %s AND %s", (start_ts, end_ts))
-        paid_orders = cursor.fetchall()
-        session_durations = []
-        for order in paid_orders:
-            cursor.execute("SELECT created_at FROM table_sessions WHERE table_id = %s AND created_at < %s ORDER BY created_at DESC LIMIT 1", (order['table_id'], order['paid_at']))
-            session = cursor.fetchone()
-            start_time = session['created_at'] if session else order['created_at']
-            session_durations.append({"table_id": order['table_id'], "start_time": start_time, "end_time": order['paid_at'], "duration_minutes": round((order['paid_at'] - start_time) / 60), "total_price": order['total_price']})
+        group_by = request.args.get('group_by')
+        if group_by == 'hour':
+            # 来店時間帯ごとの滞在時間 (分) の平均・中央値・90パーセンタイル
+            cursor.execute("""
+                SELECT EXTRACT(HOUR FROM to_timestamp(start_time) AT TIME ZONE 'UTC')::int AS hour, COUNT(*) AS session_count,
+                       ROUND(AVG(end_time - start_time)::numeric / 60)::int AS avg_duration_minutes,
+                       ROUND((percentile_cont(0.5) WITHIN GROUP (ORDER BY end_time - start_time) / 60)::numeric)::int AS p50_duration_minutes,
+                       ROUND((percentile_cont(0.9) WITHIN GROUP (ORDER BY end_time - start_time) / 60)::numeric)::int AS p90_duration_minutes
+                FROM session_durations WHERE end_time BETWEEN %s AND %s GROUP BY 1 ORDER BY 1
+            """, (start_ts, end_ts))
+            return jsonify(cursor.fetchall())
+        if group_by == 'histogram':
+            bucket_minutes = request.args.get('bucket_minutes', 15, type=int)
+            if bucket_minutes <= 0: return jsonify({"status": "error", "message": "bucket_minutesは1以上を指定してください"}), 400
+            cursor.execute("""
+                SELECT (FLOOR((end_time - start_time) / (%s * 60)) * %s)::int AS from_minutes, COUNT(*) AS session_count
+                FROM session_durations WHERE end_time BETWEEN %s AND %s GROUP BY 1 ORDER BY 1
+            """, (bucket_minutes, bucket_minutes, start_ts, end_ts))
+            return jsonify([dict(row, to_minutes=row['from_minutes'] + bucket_minutes) for row in cursor.fetchall()])
+        cursor.execute("SELECT table_id, start_time, end_time, total_price FROM session_durations WHERE end_time BETWEEN %s AND %s", (start_ts, end_ts))
+        session_durations = [dict(row, duration_minutes=round((row['end_time'] - row['start_time']) / 60)) for row in cursor.fetchall()]
         return jsonify(session_durations)
     except Exception as e: return jsonify({"status": "error", "message": str(e)}), 500
 
+# --- 分析データのストリーミング出力 (CSV / NDJSON) ---
+# サーバーサイドカーソルで少しずつ読み出して送るため、期間が長くてもメモリ使用量は一定
+EXPORT_FETCH_SIZE = 2000
+EXPORT_DATASETS = {
+    'sales': (['paid_at', 'created_at', 'table_id', 'item_name', 'quantity', 'price'],
+              "SELECT o.paid_at, o.created_at, o.table_id, oi.item_name, oi.quantity, oi.price FROM orders o JOIN order_items oi ON o.id = oi.order_id WHERE o.status = 'paid' AND o.paid_at BETWEEN %s AND %s ORDER BY o.paid_at, oi.id"),
+    'cooking_times': (['order_id', 'item_name', 'ordered_at', 'ready_at', 'cooking_seconds'],
+                      "SELECT o.id, oi.item_name, o.created_at, oi.ready_at, oi.ready_at - o.created_at FROM orders o JOIN order_items oi ON o.id = oi.order_id WHERE o.status = 'paid' AND o.paid_at BETWEEN %s AND %s AND oi.ready_at IS NOT NULL ORDER BY o.paid_at, oi.id"),
+    'sessions': (['order_id', 'table_id', 'start_time', 'end_time', 'duration_seconds', 'total_price'],
+                 "SELECT order_id, table_id, start_time, end_time, end_time - start_time, total_price FROM session_durations WHERE end_time BETWEEN %s AND %s ORDER BY end_time"),
+}
+
+def iter_query_chunks(sql, params):
+    """名前付き(サーバーサイド)カーソルでEXPORT_FETCH_SIZE行ずつ読み出します。"""
+    db = get_db()
+    cursor = db.cursor(name=f"export_{secrets.token_hex(4)}")
+    cursor.itersize = EXPORT_FETCH_SIZE
+    try:
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(EXPORT_FETCH_SIZE)
+            if not rows:
+                break
+            yield rows
+    finally:
+        cursor.close()
+        db.rollback()
+
+def _export_text_chunks(columns, sql, params, fmt):
+    buffer = io.StringIO()
+    if fmt == 'csv':
+        writer = csv.writer(buffer)
+        buffer.write('\ufeff')  # Excelで文字化けしないようにBOMを付ける
+        writer.writerow(columns)
+    for rows in iter_query_chunks(sql, params):
+        for row in rows:
+            if fmt == 'csv':
+                writer.writerow(row)
+            else:
+                buffer.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + '\n')
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+def gzip_chunks(chunks, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+XLSX_TIMESTAMP_COLUMNS = {'paid_at', 'created_at', 'ordered_at', 'ready_at', 'start_time', 'end_time'}
+XLSX_STREAM_CHUNK_SIZE = 64 * 1024
+
+def iter_query_rows(sql, params):
+    """iter_query_chunks の結果を1行ずつ返します。"""
+    for rows in iter_query_chunks(sql, params):
+        yield from rows
+
+def _xlsx_rows(columns, rows):
+    """UNIX時刻の列をExcelで読める日時 (UTC) に変換します。"""
+    timestamp_indexes = [i for i, column in enumerate(columns) if column in XLSX_TIMESTAMP_COLUMNS]
+    for row in rows:
+        if timestamp_indexes:
+            row = list(row)
+            for i in timestamp_indexes:
+                if row[i] is not None:
+                    row[i] = datetime.fromtimestamp(row[i], timezone.utc).replace(tzinfo=None)
+        yield row
+
+def write_xlsx(sheets):
+    """write_onlyモードでブックを一時ファイルに書き出します。sheets は (シート名, 見出し, 行のイテレータ) のリスト。
+    行はXMLとして逐次ディスクに書かれるため、行数が増えてもメモリ使用量はほぼ一定です。"""
+    workbook = openpyxl.Workbook(write_only=True)
+    for title, header, rows in sheets:
+        sheet = workbook.create_sheet(title=title)
+        sheet.append(header)
+        for row in rows:
+            sheet.append(row)
+    fileobj = tempfile.TemporaryFile()
+    try:
+        workbook.save(fileobj)
+    except Exception:
+        fileobj.close()
+        raise
+    fileobj.seek(0)
+    return fileobj
+
+def xlsx_response(sheets, filename):
+    """write_xlsx で作ったファイルを一定サイズずつクライアントへ送ります。"""
+    fileobj = write_xlsx(sheets)
+    size = os.fstat(fileobj.fileno()).st_size
+    def generate():
+        try:
+            while True:
+                data = fileobj.read(XLSX_STREAM_CHUNK_SIZE)
+                if not data:
+                    break
+                yield data
+        finally:
+            fileobj.close()
+    return Response(generate(), mimetype=XLSX_MIMETYPE, headers={'Content-Disposition': f'attachment; filename="{filename}"', 'Content-Length': str(size)})
+
+@app.route('/api/admin/export/<dataset>', methods=['GET'])
+@admin_role_required
+def export_analytics(dataset):
+    if dataset not in EXPORT_DATASETS: return jsonify({"status": "error", "message": "無効なデータ種別です"}), 404
+    start_date_str, end_date_str = request.args.get('start_date'), request.args.get('end_date')
+    if not start_date_str or not end_date_str: return jsonify({"status": "error", "message": "日付が指定されていません"}), 400
+    fmt = request.args.get('format', 'csv')
+    if fmt not in ('csv', 'ndjson', 'xlsx'): return jsonify({"status": "error", "message": "formatはcsv、ndjson、xlsxのいずれかを指定してください"}), 400
+    try:
+        start_ts = datetime.strptime(start_date_str, '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp()
+        end_ts = datetime.strptime(end_date_str, '%Y-%m-%d').replace(hour=23, minute=59, second=59, tzinfo=timezone.utc).timestamp()
+    except ValueError as e: return jsonify({"status": "error", "message": str(e)}), 400
+    columns, sql = EXPORT_DATASETS[dataset]
+    filename = f"{dataset}_{start_date_str.replace('-', '')}_{end_date_str.replace('-', '')}.{fmt}"
+    if fmt == 'xlsx':
+        sheets = []
+        if dataset == 'sales':
+            # 売上レポートには集計テーブルから商品別の集計シートを先頭に付ける
+            sheets.append(("商品別集計", ['item_name', 'quantity', 'total'], iter_query_rows(SALES_GROUPINGS['product'], (start_date_str, end_date_str))))
+        sheets.append((dataset, columns, _xlsx_rows(columns, iter_query_rows(sql, (start_ts, end_ts)))))
+        try:
+            return xlsx_response(sheets, filename)
+        except Exception as e:
+            return jsonify({"status": "error", "message": f"ファイルの生成に失敗しました: {str(e)}"}), 500
+    chunks = _export_text_chunks(columns, sql, (start_ts, end_ts), fmt)
+    mimetype = 'text/csv; charset=utf-8' if fmt == 'csv' else 'application/x-ndjson'
+    if request.args.get('gzip') in ('1', 'true'):
+        chunks = gzip_chunks(chunks)
+        filename += '.gz'
+        mimetype = 'application/gzip'
+    return Response(stream_with_context(chunks), mimetype=mimetype, headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
 @app.route('/api/admin/download_menu', methods=['GET'])
 @admin_role_required
 def download_menu():
     try:
-        db = get_db()
-        cursor = db.cursor(cursor_factory=RealDictCursor)
-        workbook = openpyxl.Workbook()
-        sheet_cat = workbook.active
-        sheet_cat.title = "カテゴリー設定"
-        sheet_cat.append(['表示順', 'カテゴリー名(日本語)', 'カテゴリー名(English)'])
-        cursor.execute("SELECT display_order, name_jp, name_en FROM categories ORDER BY display_order, id")
-        for cat in cursor.fetchall():
-            sheet_cat.append([cat['display_order'], cat['name_jp'], cat['name_en']])
-        sheet_menu = workbook.create_sheet(title="メニュー")
-        cursor.execute("SELECT id, name_jp FROM categories")
-        cat_map = {row['id']: row['name_jp'] for row in cursor.fetchall()}
-        cursor.execute("SELECT product_id, category_id FROM product_categories")
-        product_cat_map = {}
-        for row in cursor.fetchall():
-            pid, cid = row['product_id'], row['category_id']
-            if pid not in product_cat_map: product_cat_map[pid] = []
-            if cid in cat_map: product_cat_map[pid].append(cat_map[cid])
-        cursor.execute("SELECT * FROM products ORDER BY id")
-        products = cursor.fetchall()
-        headers = ['商品ID', '商品名', '価格', '商品説明', '画像ファイル名', 'カテゴリー', '品切れ', '商品名(英語)', '商品説明(英語)']
-        sheet_menu.append(headers)
-        for product in products:
-            category_names = " ".join(product_cat_map.get(product['id'], []))
-            sheet_menu.append([product['id'], product['name'], product['price'], product['description'], product['image_path'], category_names, product['is_sold_out'], product['name_en'], product['description_en']])
-        file_stream = io.BytesIO()
-        workbook.save(file_stream)
-        file_stream.seek(0)
+        category_names = "COALESCE((SELECT string_agg(c.name_jp, ' ' ORDER BY c.display_order, c.id) FROM product_categories pc JOIN categories c ON c.id = pc.category_id WHERE pc.product_id = p.id), '')"
+        sheets = [
+            ("カテゴリー設定", ['表示順', 'カテゴリー名(日本語)', 'カテゴリー名(English)'],
+             iter_query_rows("SELECT display_order, name_jp, name_en FROM categories ORDER BY display_order, id", None)),
+            ("メニュー", ['商品ID', '商品名', '価格', '商品説明', '画像ファイル名', 'カテゴリー', '品切れ', '商品名(英語)', '商品説明(英語)'],
+             iter_query_rows(f"SELECT p.id, p.name, p.price, p.description, p.image_path, {category_names}, p.is_sold_out, p.name_en, p.description_en FROM products p ORDER BY p.id", None)),
+        ]
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"menu_backup_{timestamp}.xlsx"
-        return send_file(file_stream, as_attachment=True, download_name=filename, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+        return xlsx_response(sheets, f"menu_backup_{timestamp}.xlsx")
     except Exception as e:
         return jsonify({"status": "error", "message": f"ダウンロードファイルの生成に失敗しました: {str(e)}"}), 500
 
+# --- メニュー取り込み (Excel → 差分適用) ---
+MENU_PRODUCT_FIELDS = ('price', 'description', 'image_path', 'is_sold_out', 'name_en', 'description_en')
+
+class MenuSheetError(ValueError):
+    """Excelの特定の行に問題があることを示す例外"""
+    def __init__(self, row_index, message):
+        super().__init__(f"{message} (Excelの {row_index} 行目付近)")
+
+def _parse_menu_price(price):
+    """価格セルの値 ('¥1,200' や 1200.0 など) を整数に変換する"""
+    if isinstance(price, str):
+        cleaned_price = re.sub(r'[^\d]', '', price)
+        return int(cleaned_price) if cleaned_price else 0
+    if isinstance(price, (int, float)):
+        return int(price)
+    return 0
+
+def _menu_text(value):
+    """テキスト列の値を文字列に揃える (数値セルでも差分判定がぶれないように)"""
+    return None if value is None else str(value)
+
+def parse_menu_workbook(filepath):
+    """Excelを読み取り専用モードで読み込み、{名前: 内容} の辞書に変換する (シートが無い場合は None)"""
+    workbook = openpyxl.load_workbook(filepath, read_only=True, data_only=True)
+    try:
+        categories = None
+        if "カテゴリー設定" in workbook.sheetnames:
+            categories = {}
+            for row_index, row in enumerate(workbook["カテゴリー設定"].iter_rows(min_row=2, values_only=True), start=2):
+                if not row or not row[1]: continue
+                order, name_jp, name_en = (tuple(row) + (99, None, None))[:3]
+                try:
+                    categories[str(name_jp).strip()] = {'display_order': int(order or 99), 'name_en': _menu_text(name_en)}
+                except (TypeError, ValueError) as e:
+                    raise MenuSheetError(row_index, f"表示順が不正です: {e}")
+
+        products = None
+        if "メニュー" in workbook.sheetnames:
+            products = {}
+            for row_index, row in enumerate(workbook["メニュー"].iter_rows(min_row=2, values_only=True), start=2):
+                if not row or not row[1]: continue
+                _id, name, price, desc, img, cat_str, sold_out, name_en, desc_en = (tuple(row) + (None,) * 9)[:9]
+                try:
+                    category_names = str(cat_str).replace('　', ' ').split(' ') if cat_str else []
+                    products[str(name)] = {
+                        'price': _parse_menu_price(price),
+                        'description': _menu_text(desc),
+                        'image_path': str(img).lower() if img else img,
+                        'is_sold_out': 1 if sold_out else 0,
+                        'name_en': _menu_text(name_en),
+                        'description_en': _menu_text(desc_en),
+                        'categories': [c.strip() for c in category_names if c.strip()],
+                    }
+                except (TypeError, ValueError) as e:
+                    raise MenuSheetError(row_index, str(e))
+        return categories, products
+    finally:
+        workbook.close()
+
+def apply_menu_diff(cursor, categories, products):
+    """現在のメニューとの差分だけを一括で反映する。既存の商品・カテゴリーのIDは維持される"""
+    stats = {'categories': {'added': 0, 'updated': 0, 'deleted': 0},
+             'products': {'added': 0, 'updated': 0, 'deleted': 0, 'unchanged': 0},
+             'product_categories': {'added': 0, 'deleted': 0}}
+    if categories is not None:
+        cursor.execute("SELECT id, name_jp, name_en, display_order FROM categories")
+        current = {row['name_jp']: row for row in cursor.fetchall()}
+        removed = [row['id'] for name, row in current.items() if name not in categories]
+        added = [(cat['display_order'], name, cat['name_en']) for name, cat in categories.items() if name not in current]
+        changed = [(current[name]['id'], cat['display_order'], cat['name_en']) for name, cat in categories.items()
+                   if name in current and (current[name]['display_order'], current[name]['name_en']) != (cat['display_order'], cat['name_en'])]
+        if removed:
+            cursor.execute("DELETE FROM categories WHERE id = ANY(%s)", (removed,))
+        if added:
+            execute_values(cursor, "INSERT INTO categories (display_order, name_jp, name_en) VALUES %s", added)
+        if changed:
+            execute_values(cursor, """
+                UPDATE categories AS c SET display_order = v.display_order, name_en = v.name_en
+                FROM (VALUES %s) AS v(id, display_order, name_en) WHERE c.id = v.id
+            """, changed, template="(%s::integer, %s::integer, %s::text)")
+        stats['categories'].update(added=len(added), updated=len(changed), deleted=len(removed))
+
+    if products is not None:
+        cursor.execute("SELECT id, name_jp FROM categories")
+        cat_name_to_id_map = {row['name_jp']: row['id'] for row in cursor.fetchall()}
+        cursor.execute(f"SELECT id, name, {', '.join(MENU_PRODUCT_FIELDS)} FROM products")
+        current = {row['name']: row for row in cursor.fetchall()}
+        product_ids = {name: row['id'] for name, row in current.items() if name in products}
+
+        removed = [row['id'] for name, row in current.items() if name not in products]
+        added = [(name,) + tuple(product[f] for f in MENU_PRODUCT_FIELDS) for name, product in products.items() if name not in current]
+        changed = [(current[name]['id'],) + tuple(product[f] for f in MENU_PRODUCT_FIELDS) for name, product in products.items()
+                   if name in current and any(current[name][f] != product[f] for f in MENU_PRODUCT_FIELDS)]
+        if removed:
+            cursor.execute("DELETE FROM products WHERE id = ANY(%s)", (removed,))
+        if added:
+            inserted = execute_values(cursor, f"INSERT INTO products (name, {', '.join(MENU_PRODUCT_FIELDS)}) VALUES %s RETURNING id, name", added, fetch=True)
+            product_ids.update({row['name']: row['id'] for row in inserted})
+        if changed:
+            execute_values(cursor, f"""
+                UPDATE products AS p SET {', '.join(f'{f} = v.{f}' for f in MENU_PRODUCT_FIELDS)}
+                FROM (VALUES %s) AS v(id, {', '.join(MENU_PRODUCT_FIELDS)}) WHERE p.id = v.id
+            """, changed, template="(%s::integer, %s::integer, %s::text, %s::text, %s::integer, %s::text, %s::text)")
+        stats['products'].update(added=len(added), updated=len(changed), deleted=len(removed),
+                                 unchanged=len(products) - len(added) - len(changed))
+
+        # 商品とカテゴリーの紐付けも差分で更新する (削除した商品の紐付けは ON DELETE CASCADE で消える)
+        desired_links = {(product_ids[name], cat_name_to_id_map[cat_name])
+                         for name, product in products.items() for cat_name in product['categories'] if cat_name in cat_name_to_id_map}
+        cursor.execute("SELECT product_id, category_id FROM product_categories")
+        current_links = {(row['product_id'], row['category_id']) for row in cursor.fetchall()}
+        stale_links = list(current_links - desired_links)
+        new_links = list(desired_links - current_links)
+        if stale_links:
+            execute_values(cursor, """
+                DELETE FROM product_categories AS pc USING (VALUES %s) AS v(product_id, category_id)
+                WHERE pc.product_id = v.product_id AND pc.category_id = v.category_id
+            """, stale_links)
+        if new_links:
+            execute_values(cursor, "INSERT INTO product_categories (product_id, category_id) VALUES %s ON CONFLICT DO NOTHING", new_links)
+        stats['product_categories'].update(added=len(new_links), deleted=len(stale_links))
+    return stats
+
 @app.route('/api/admin/upload_menu', methods=['POST'])
 @admin_role_required
 def upload_menu():
@@ -714,97 +2251,71 @@ def upload_menu():
     if file.filename == '' or not file.filename.endswith('.xlsx'): return jsonify({"status": "error", "message": "無効なファイル形式です。"}), 400
     filepath = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(file.filename))
     file.save(filepath)
-    db = get_db()
-    cursor = db.cursor(cursor_factory=RealDictCursor)
+    timings = {}
     try:
-        workbook = openpyxl.load_workbook(filepath)
-        if "カテゴリー設定" in workbook.sheetnames:
-            sheet_cat = workbook["カテゴリー設定"]
-            cursor.execute("DELETE FROM product_categories")
-            cursor.execute("DELETE FROM categories")
-            cursor.execute("ALTER SEQUENCE categories_id_seq RESTART WITH 1")
-            categories_to_insert = []
-            for row in sheet_cat.iter_rows(min_row=2, values_only=True):
-                if not row or not row[1]: continue
-                order, name_jp, name_en = (row + (99, None, None))[:3]
-                categories_to_insert.append((int(order or 99), name_jp, name_en))
-            for cat in categories_to_insert:
-                cursor.execute("INSERT INTO categories (display_order, name_jp, name_en) VALUES (%s, %s, %s)", cat)
+        # Excelの解析はトランザクションの外で行い、テーブルをロックする時間を短くする
+        started = time.perf_counter()
+        try:
+            categories, products = parse_menu_workbook(filepath)
+        except Exception as e:
+            return jsonify({"status": "error", "message": f"Excelの読み込みに失敗しました: {str(e)}"}), 400
+        timings['parse_ms'] = round((time.perf_counter() - started) * 1000, 1)
 
-        count = 0
-        if "メニュー" in workbook.sheetnames:
-            sheet_menu = workbook["メニュー"]
-            cursor.execute("SELECT id, name_jp FROM categories")
-            cat_name_to_id_map = {row['name_jp']: row['id'] for row in cursor.fetchall()}
-            cursor.execute("DELETE FROM products")
-            cursor.execute("ALTER SEQUENCE products_id_seq RESTART WITH 1")
-            
-            for row_index, row in enumerate(sheet_menu.iter_rows(min_row=2, values_only=True), start=2):
-                if not row or not row[1]: continue
-                _id, name, price, desc, img, cat_str, sold_out, name_en, desc_en = (row + (None,) * 9)[:9]
-
-            # ★★★ ここから追記 ★★★
-            # もし画像ファイル名(img)が存在すれば、小文字に変換する
-            if img:
-                img = str(img).lower()
-            # ★★★ ここまで追記 ★★★
-
-
-                price_val = 0
-                if price is not None:
-                    if isinstance(price, str):
-                        cleaned_price = re.sub(r'[^\d]', '', price)
-                        if cleaned_price: price_val = int(cleaned_price)
-                    elif isinstance(price, (int, float)):
-                        price_val = int(price)
-                
-                cursor.execute("INSERT INTO products (name, price, description, image_path, is_sold_out, name_en, description_en) VALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING id", (name, price_val, desc, img, 1 if sold_out else 0, name_en, desc_en))
-                new_product_id = cursor.fetchone()['id']
-                
-                if cat_str:
-                    category_names = cat_str.replace('　', ' ').split(' ')
-                    for cat_name in [c for c in category_names if c]:
-                        cat_id = cat_name_to_id_map.get(cat_name.strip())
-                        if cat_id:
-                            cursor.execute("INSERT INTO product_categories (product_id, category_id) VALUES (%s, %s) ON CONFLICT DO NOTHING", (new_product_id, cat_id))
-                count += 1
-        db.commit()
-        return jsonify({"status": "success", "message": f"{count}件のメニューとカテゴリーを登録/更新しました。"})
-    except Exception as e:
-        db.rollback()
-        error_info = f"エラーが発生しました: {str(e)}"
-        if 'row_index' in locals():
-            error_info += f" (Excelの {row_index} 行目付近)"
-        return jsonify({"status": "error", "message": error_info}), 500
+        db = get_db()
+        cursor = db.cursor(cursor_factory=RealDictCursor)
+        try:
+            started = time.perf_counter()
+            stats = apply_menu_diff(cursor, categories, products)
+            # 派生画像の無い画像はワーカーで作る (完了時にメニューのキャッシュが作り直される)
+            job_ids = enqueue_image_variant_jobs(cursor, (product['image_path'] for product in (products or {}).values()))
+            bump_menu_version(cursor)
+            timings['apply_ms'] = round((time.perf_counter() - started) * 1000, 1)
+            started = time.perf_counter()
+            db.commit()
+            timings['commit_ms'] = round((time.perf_counter() - started) * 1000, 1)
+        except Exception as e:
+            db.rollback()
+            return jsonify({"status": "error", "message": f"エラーが発生しました: {str(e)}"}), 500
+        if job_ids: _ensure_image_worker()
+        count = len(products or {})
+        app.logger.info("menu upload: %s %s", stats, timings)
+        return jsonify({"status": "success", "message": f"{count}件のメニューとカテゴリーを登録/更新しました。", "changes": stats, "timings": timings, "imageJobIds": job_ids})
     finally:
         if os.path.exists(filepath): os.remove(filepath)
 
 @app.route('/api/admin/add_product', methods=['POST'])
 @admin_role_required
 def add_product():
-    # ...
+    db = get_db()
+    cursor = db.cursor(cursor_factory=RealDictCursor)
+    form = request.form
+    category_ids = [int(cid) for cid in form.get('category_ids', '').split(',') if cid.strip()]
     try:
-        # ...
+        cursor.execute("INSERT INTO products (name, price, description, name_en, description_en) VALUES (%s, %s, %s, %s, %s) RETURNING id",
+                       (form['name'], int(form.get('price') or 0), form.get('description'), form.get('name_en'), form.get('description_en')))
+        product_id = cursor.fetchone()['id']
         image_file = request.files.get('image_file')
-        # ...
-        if image_file:
-            img = Image.open(image_file.stream)
+        image_job_id = None
+        if image_file and image_file.filename:
             # ★★★ ここから修正 ★★★
             original_filename = secure_filename(image_file.filename)
             filename_without_ext, ext = os.path.splitext(original_filename)
             # 新しいファイル名を生成し、拡張子も含めて全て小文字に変換する
             new_filename = f"{product_id}{ext}".lower() 
             # ★★★ ここまで修正 ★★★
-            img.save(os.path.join(app.config['IMAGES_FOLDER'], new_filename))
-            cursor.execute("UPDATE products SET image_path = %s WHERE id = %s", (new_filename, product_id))
+            if ext.lower() not in IMAGE_EXTENSIONS: raise IOError("Invalid image format")
+            # 画像の変換はワーカーで行い、完了時にimage_pathが設定される
+            image_job_id = enqueue_image_job(cursor, image_file, new_filename, 'product', product_id)
 
 
         if category_ids:
             for cid in category_ids:
                 cursor.execute("INSERT INTO product_categories (product_id, category_id) VALUES (%s, %s)", (product_id, cid))
 
+        bump_menu_version(cursor)
         db.commit()
-        return jsonify({"status": "success", "productId": product_id})
+        if image_job_id: _ensure_image_worker()
+        return jsonify({"status": "success", "productId": product_id, "imageJobId": image_job_id})
     except psycopg2.errors.UniqueViolation:
         db.rollback()
         return jsonify({"status": "error", "message": "その品名は既に使用されています。"}), 409
@@ -816,9 +2327,10 @@ def add_product():
 @admin_role_required
 def update_product(product_id):
     data = request.get_json()
-    # ...
+    db = get_db()
+    cursor = db.cursor(cursor_factory=RealDictCursor)
+    category_ids = [int(cid) for cid in data.get('category_ids') or []]
     try:
-        # ...
         # ★★★ ここから修正 ★★★
         # image_pathが存在すれば、小文字に変換してからDBに保存する
         image_path = data.get('image_path')
@@ -830,8 +2342,12 @@ def update_product(product_id):
         if category_ids:
             for cid in category_ids:
                 cursor.execute("INSERT INTO product_categories (product_id, category_id) VALUES (%s, %s)", (product_id, cid))
+        # 派生画像が無ければワーカーで作る (完了時にメニューのキャッシュが作り直される)
+        job_ids = enqueue_image_variant_jobs(cursor, [image_path])
+        bump_menu_version(cursor)
         db.commit()
-        return jsonify({"status": "success"})
+        if job_ids: _ensure_image_worker()
+        return jsonify({"status": "success", "imageJobIds": job_ids})
     except psycopg2.errors.UniqueViolation:
         db.rollback()
         return jsonify({"status": "error", "message": "その品名は既に使用されています。"}), 409
@@ -846,6 +2362,7 @@ def update_product_status(product_id):
     db = get_db()
     cursor = db.cursor(cursor_factory=RealDictCursor)
     cursor.execute("UPDATE products SET is_sold_out = %s WHERE id = %s", (data['is_sold_out'], product_id))
+    bump_menu_version(cursor)
     db.commit()
     return jsonify({"status": "success"})
         
@@ -855,14 +2372,106 @@ def delete_product(product_id):
     db = get_db()
     cursor = db.cursor(cursor_factory=RealDictCursor)
     cursor.execute("DELETE FROM products WHERE id = %s", (product_id,))
+    bump_menu_version(cursor)
     db.commit()
     return jsonify({"status": "success"})
 
 
 # --- 静的ファイル配信 ---
+# ファイル内容のハッシュをETagにし、?v=<ハッシュ> 付きで要求されたものは immutable として長期キャッシュさせる。
+# HTML内のJS/CSSへの参照は配信時に ?v=<ハッシュ> 付きに書き換えるため、HTMLだけ再検証すれば済む。
+# テキスト系のファイルは最大圧縮率で一度だけgzip/Brotli圧縮し、更新されるまでメモリに保持する。
+STATIC_HASH_LENGTH = 16
+STATIC_IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+STATIC_COMPRESS_MAX_BYTES = 1024 * 1024
+STATIC_COMPRESSIBLE_TYPES = {'text/html', 'text/css', 'text/javascript', 'application/javascript', 'application/json', 'image/svg+xml', 'text/plain'}
+# アプリのディレクトリ直下から配信してよい拡張子 (app.py や restaurant.db などを配信しないように)
+STATIC_ROOT_EXTENSIONS = {'.html', '.js', '.css', '.png', '.jpg', '.jpeg', '.gif', '.webp', '.svg', '.ico', '.woff', '.woff2', '.mp3', '.wav'}
+STATIC_REFERENCE_PATTERN = re.compile(r'(src|href)="([A-Za-z0-9_\-./]+\.(?:js|css))(?:\?[^"]*)?"')
+
+_static_assets = {}
+
+def _load_static_asset(full_path):
+    """内容のハッシュなどを、ファイルの更新日時・サイズが変わった時だけ計算し直す"""
+    stat = os.stat(full_path)
+    asset = _static_assets.get(full_path)
+    if asset and asset['mtime_ns'] == stat.st_mtime_ns and asset['size'] == stat.st_size:
+        return asset
+    digest = hashlib.sha256()
+    with open(full_path, 'rb') as f:
+        for block in iter(lambda: f.read(64 * 1024), b''):
+            digest.update(block)
+    mimetype = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+    asset = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'mtime': stat.st_mtime, 'mimetype': mimetype,
+             'hash': digest.hexdigest()[:STATIC_HASH_LENGTH], 'body': None, 'encoded': {}}
+    _static_assets[full_path] = asset
+    return asset
+
+def _load_html_asset(full_path):
+    """JS/CSSへの参照を ?v=<ハッシュ> 付きに書き換えたHTML。HTMLか参照先が変わった時だけ作り直す"""
+    stat = os.stat(full_path)
+    asset = _static_assets.get(full_path)
+    if asset and asset['mtime_ns'] == stat.st_mtime_ns and asset['size'] == stat.st_size \
+            and all(_load_static_asset(path)['hash'] == version for path, version in asset['references']):
+        return asset
+    with open(full_path, encoding='utf-8') as f:
+        html = f.read()
+    directory, references = os.path.dirname(full_path), []
+    def versioned(match):
+        reference_path = safe_join(directory, match.group(2))
+        if reference_path is None or not os.path.isfile(reference_path):
+            return match.group(0)
+        version = _load_static_asset(reference_path)['hash']
+        references.append((reference_path, version))
+        return f'{match.group(1)}="{match.group(2)}?v={version}"'
+    body = STATIC_REFERENCE_PATTERN.sub(versioned, html).encode('utf-8')
+    asset = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'mtime': stat.st_mtime, 'mimetype': 'text/html',
+             'hash': hashlib.sha256(body).hexdigest()[:STATIC_HASH_LENGTH], 'body': body, 'encoded': {}, 'references': references}
+    _static_assets[full_path] = asset
+    return asset
+
+def send_static_asset(directory, path):
+    full_path = safe_join(os.path.abspath(directory), path)
+    if full_path is None or not os.path.isfile(full_path): return "Not Found", 404
+    if full_path.endswith('.html'):
+        asset = _load_html_asset(full_path)
+    else:
+        asset = _load_static_asset(full_path)
+    compressible = asset['mimetype'] in STATIC_COMPRESSIBLE_TYPES and asset['size'] <= STATIC_COMPRESS_MAX_BYTES
+    encoding = negotiate_encoding() if compressible else None
+    if asset['body'] is not None or encoding:
+        if asset['body'] is None:
+            with open(full_path, 'rb') as f:
+                asset['body'] = f.read()
+        body = asset['body']
+        if encoding:
+            if encoding not in asset['encoded']:
+                asset['encoded'][encoding] = compress_body(asset['body'], encoding)
+            body = asset['encoded'][encoding]
+        response = app.response_class(body, mimetype=asset['mimetype'])
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.set_etag(f"{asset['hash']}-{encoding}" if encoding else asset['hash'])
+        response.last_modified = asset['mtime']
+    else:
+        response = send_file(full_path, mimetype=asset['mimetype'], etag=asset['hash'], last_modified=asset['mtime'], conditional=True)
+    if compressible:
+        response.vary.add('Accept-Encoding')
+    if request.args.get('v') == asset['hash']:
+        response.headers['Cache-Control'] = f'public, max-age={STATIC_IMMUTABLE_MAX_AGE}, immutable'
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request) if response.status_code == 200 else response
+
+def serve_image_file(filename):
+    return send_static_asset(app.static_folder, filename)
+
+# Flaskの /images (url_for('static', ...)) も同じ仕組みで配信する
+app.view_functions['static'] = serve_image_file
+
 @app.route('/')
 def serve_root():
-    return send_from_directory('.', 'login.html')
+    return send_static_asset('.', 'login.html')
 
 @app.route('/favicon.ico')
 def favicon():
@@ -871,16 +2480,13 @@ def favicon():
 # --- ここから追記 ---
 @app.route('/ROS_manual/<path:path>')
 def serve_manual_files(path):
-    return send_from_directory('ROS_manual', path)
+    return send_static_asset('ROS_manual', path)
 # --- ここまで追記 ---
 
 @app.route('/<path:path>')
 def serve_static_file(path):
-    if '..' in path: return "Not Found", 404
-    safe_path = os.path.join('.', path)
-    if os.path.exists(safe_path) and not os.path.isdir(safe_path):
-        return send_from_directory('.', path)
-    return "Not Found", 404
+    if os.path.splitext(path)[1].lower() not in STATIC_ROOT_EXTENSIONS: return "Not Found", 404
+    return send_static_asset('.', path)
 
 # --- データベース初期化コマンド ---
 @app.cli.command("init-db")
@@ -890,6 +2496,191 @@ def init_db_command():
     migrate_db()
     print("Initialized and migrated the database.")
 
+@app.cli.command("rollup-backfill")
+@click.option('--start-date', help='再集計の開始日 (YYYY-MM-DD、UTC)。省略時は全期間')
+@click.option('--end-date', help='再集計の終了日 (YYYY-MM-DD、UTC)')
+def rollup_backfill_command(start_date, end_date):
+    """支払済みの注文から売上分析用の集計テーブルを作り直します。"""
+    if bool(start_date) != bool(end_date):
+        raise click.UsageError("--start-date and --end-date must be given together.")
+    with app.app_context():
+        db = get_db()
+        cursor = db.cursor(cursor_factory=RealDictCursor)
+        rebuild_rollups(cursor, start_date, end_date)
+        db.commit()
+    print("Rebuilt sales rollups.")
+
+@app.cli.command("check-totals")
+@click.option('--include-paid', is_flag=True, help='会計済みの注文も確認する')
+@click.option('--fix', is_flag=True, help='不一致の合計金額を明細から計算し直して保存する')
+def check_totals_command(include_paid, fix):
+    """注文ごとに保存されている合計金額 (orders.total_price) が明細の合計と一致しているか確認します。"""
+    with app.app_context():
+        db = get_db()
+        cursor = db.cursor(cursor_factory=RealDictCursor)
+        cursor.execute(f"""
+            SELECT o.id, o.table_id, o.status, o.total_price, COALESCE(SUM(oi.price * oi.quantity), 0) AS items_total
+            FROM orders o LEFT JOIN order_items oi ON oi.order_id = o.id
+            {'' if include_paid else "WHERE o.status = 'active'"}
+            GROUP BY o.id HAVING ABS(COALESCE(o.total_price, 0) - COALESCE(SUM(oi.price * oi.quantity), 0)) > %s
+            ORDER BY o.id
+        """, (TOTAL_PRICE_TOLERANCE,))
+        mismatches = cursor.fetchall()
+        for row in mismatches:
+            print(f"NG: order {row['id']} (table {row['table_id']}, {row['status']}): stored {row['total_price']}, items {row['items_total']}")
+        if mismatches and fix:
+            execute_values(cursor, "UPDATE orders o SET total_price = v.total FROM (VALUES %s) AS v(id, total) WHERE o.id = v.id",
+                           [(row['id'], row['items_total']) for row in mismatches], template="(%s, %s::real)")
+            for row in mismatches:
+                if row['status'] == 'active':
+                    record_order_change(cursor, row['id'])
+            db.commit()
+            print(f"Fixed {len(mismatches)} order total(s).")
+            if any(row['status'] == 'paid' for row in mismatches):
+                print("Paid orders were changed; run rollup-backfill to update the sales rollups.")
+    if mismatches and not fix:
+        raise click.ClickException(f"{len(mismatches)} order total(s) do not match their items.")
+    if not mismatches:
+        print("All order totals match their items.")
+
+@app.cli.command("change-log-prune")
+def change_log_prune_command():
+    """保持期間 (24時間) を過ぎた変更履歴を削除します。"""
+    with app.app_context():
+        db = get_db()
+        cursor = db.cursor()
+        deleted = prune_change_log(cursor)
+        db.commit()
+    print(f"Deleted {deleted} change log row(s).")
+
+@app.cli.command("image-backfill")
+@click.option('--force', is_flag=True, help='派生画像が既にある場合も作り直す')
+def image_backfill_command(force):
+    """images/ フォルダの既存画像からサイズ別の派生画像 (WebP/JPEG) を作成します。"""
+    created, failed = 0, 0
+    with app.app_context():
+        for filename in sorted(os.listdir(app.config['IMAGES_FOLDER'])):
+            source = os.path.join(app.config['IMAGES_FOLDER'], filename)
+            if not os.path.isfile(source) or os.path.splitext(filename)[1].lower() not in IMAGE_EXTENSIONS: continue
+            manifest_path = os.path.join(_image_variant_dir(filename), 'manifest.json')
+            if not force and os.path.exists(manifest_path) and os.path.getmtime(manifest_path) >= os.path.getmtime(source): continue
+            try:
+                generate_image_variants(filename)
+                created += 1
+            except Exception as e:
+                failed += 1
+                print(f"Failed: {filename}: {e}")
+        # get_productsのキャッシュに新しいURLを反映させる
+        db = get_db()
+        bump_menu_version(db.cursor())
+        db.commit()
+    print(f"Generated image variants for {created} file(s), {failed} failure(s).")
+
+@app.cli.command("image-worker")
+@click.option('--once', is_flag=True, help='待機中のジョブを処理したら終了する')
+def image_worker_command(once):
+    """画像処理ジョブを処理するワーカーを起動します (IMAGE_WORKER_MODE=external の場合に使用)。"""
+    if once:
+        with app.app_context():
+            print(f"Processed {process_image_jobs(get_db())} image job(s).")
+        return
+    _ensure_event_listener()
+    print("Image worker started.")
+    _image_worker_wakeup.set()
+    _image_worker_loop()
+
+@app.cli.command("db-upgrade")
+def db_upgrade_command():
+    """未適用のマイグレーションを順番に実行します。"""
+    migrate_db()
+    print("Database is up to date.")
+
+# 主要な画面・APIが実行するクエリ。db-check-plansでシーケンシャルスキャンにならないことを確認する
+HOT_PATH_QUERIES = [
+    ("table session", "SELECT id FROM table_sessions WHERE table_id = %s AND access_token = %s AND status = 'active'", (1, 'seed-1')),
+    ("active orders", "SELECT * FROM orders WHERE status = 'active' ORDER BY created_at ASC", ()),
+    ("active order by table", "SELECT id FROM orders WHERE table_id = %s AND status = 'active'", (10001,)),
+    ("order items", "SELECT * FROM order_items WHERE order_id = ANY(%s) ORDER BY order_id, id", ([1, 2, 3],)),
+    ("order history", "SELECT o.id as order_id, o.created_at, o.total_price as order_total, oi.item_name, oi.quantity, oi.price, oi.item_status FROM orders o JOIN order_items oi ON o.id = oi.order_id WHERE o.table_id = %s AND o.status = 'active' ORDER BY o.created_at ASC, oi.id ASC", (10001,)),
+    # receive_orderの書き込み (ON CONFLICTは一意インデックスが無いとエラーになるので、EXPLAINできればインデックスも使われている)
+    ("active order upsert", "INSERT INTO orders (table_id, total_price, status, created_at) VALUES (%s, 0, 'active', %s) ON CONFLICT (table_id) WHERE status = 'active' DO NOTHING RETURNING id", (10001, 1700000000)),
+    ("product prices", "SELECT name, price FROM products WHERE name = ANY(%s) AND is_sold_out = 0", (['seed-product-1', 'seed-product-2'],)),
+    ("cooking item upsert", "INSERT INTO order_items (order_id, item_name, quantity, price, item_status) VALUES (%s, %s, %s, %s, 'cooking') ON CONFLICT (order_id, item_name) WHERE item_status = 'cooking' DO UPDATE SET quantity = order_items.quantity + EXCLUDED.quantity RETURNING item_name, price", (1, 'seed-item-1', 1, 500)),
+    ("order total", "UPDATE orders SET total_price = total_price + %s WHERE id = %s", (500, 1)),
+    ("paid orders", "SELECT * FROM orders WHERE status = 'paid' AND paid_at BETWEEN %s AND %s", (1700000000, 1700003600)),
+    ("session start", "SELECT created_at FROM table_sessions WHERE table_id = %s AND created_at < %s ORDER BY created_at DESC LIMIT 1", (1, 1700100000)),
+    ("changes since", "SELECT DISTINCT table_id, order_id FROM change_log WHERE xid >= %s", (2 ** 40,)),
+]
+
+def _seq_scanned_relations(plan):
+    relations = [plan['Relation Name']] if plan.get('Node Type') == 'Seq Scan' else []
+    for child in plan.get('Plans', []):
+        relations += _seq_scanned_relations(child)
+    return relations
+
+@app.cli.command("db-check-plans")
+def db_check_plans_command():
+    """ダミーデータを投入してEXPLAINを実行し、主要クエリがシーケンシャルスキャンにならないか確認します (データはロールバックされます)。"""
+    with app.app_context():
+        db = get_db()
+        cursor = db.cursor(cursor_factory=RealDictCursor)
+        try:
+            cursor.execute("INSERT INTO orders (table_id, total_price, status, created_at, paid_at) SELECT g % 40 + 1, 1000, 'paid', 1700000000 + g * 60, 1700000000 + g * 60 + 3600 FROM generate_series(1, 50000) g")
+            cursor.execute("INSERT INTO orders (table_id, total_price, status, created_at) SELECT 10000 + g, 1000, 'active', 1700000000 + g FROM generate_series(1, 40) g")
+            cursor.execute("INSERT INTO order_items (order_id, item_name, quantity, price, item_status, ready_at) SELECT o.id, 'seed-item-' || n, 1, 500, CASE WHEN o.status = 'active' THEN 'cooking' ELSE 'served' END, o.created_at + 600 FROM orders o CROSS JOIN generate_series(1, 3) n")
+            cursor.execute("INSERT INTO table_sessions (table_id, access_token, status, created_at) SELECT g % 40 + 1, 'seed-' || g, 'expired', 1700000000 + g * 60 FROM generate_series(1, 50000) g")
+            cursor.execute("INSERT INTO change_log (table_id, order_id, created_at) SELECT g % 40 + 1, g, 1700000000 + g FROM generate_series(1, 50000) g")
+            cursor.execute("INSERT INTO products (name, price) SELECT 'seed-product-' || g, 500 FROM generate_series(1, 5000) g")
+            for table in ['orders', 'order_items', 'table_sessions', 'change_log', 'products']:
+                cursor.execute(f"ANALYZE {table}")
+            failures = []
+            for name, sql, params in HOT_PATH_QUERIES:
+                cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+                relations = _seq_scanned_relations(cursor.fetchone()['QUERY PLAN'][0]['Plan'])
+                print(f"{'NG' if relations else 'OK'}: {name}" + (f" (Seq Scan on {', '.join(relations)})" if relations else ""))
+                if relations:
+                    failures.append(name)
+        finally:
+            db.rollback()
+        if failures:
+            raise click.ClickException(f"{len(failures)} hot-path queries fall back to a sequential scan.")
+
+# 未会計の注文一覧を作る処理。注文の件数に関わらずクエリ数が一定であること (N+1にならないこと) をdb-check-queriesで確認する
+ACTIVE_ORDER_BUILDERS = [
+    ("table summary", build_table_summary),
+    ("active orders", fetch_active_orders),
+]
+
+@app.cli.command("db-check-queries")
+@click.option('--tables', default='1,10,40', help='試す未会計テーブル数 (カンマ区切り)')
+def db_check_queries_command(tables):
+    """ダミーの未会計注文を増やしながら注文一覧を作り、クエリ数が変わらないか確認します (データはロールバックされます)。"""
+    table_counts = sorted(int(n) for n in tables.split(','))
+    with app.app_context():
+        db = get_db()
+        cursor = db.cursor(cursor_factory=RealDictCursor)
+        counts = {name: {} for name, _ in ACTIVE_ORDER_BUILDERS}
+        try:
+            seeded = 0
+            for table_count in table_counts:
+                cursor.execute("INSERT INTO orders (table_id, total_price, status, created_at) SELECT 20000 + g, 1500, 'active', 1700000000 + g FROM generate_series(%s, %s) g", (seeded + 1, table_count))
+                cursor.execute("INSERT INTO order_items (order_id, item_name, quantity, price, item_status) SELECT o.id, 'seed-item-' || n, 1, 500, 'cooking' FROM orders o CROSS JOIN generate_series(1, 3) n WHERE o.table_id > 20000 + %s AND o.status = 'active'", (seeded,))
+                seeded = table_count
+                for name, build in ACTIVE_ORDER_BUILDERS:
+                    g.db_queries = 0
+                    build(cursor)
+                    counts[name][table_count] = g.db_queries
+        finally:
+            db.rollback()
+        failures = []
+        for name, by_count in counts.items():
+            constant = len(set(by_count.values())) == 1
+            print(f"{'OK' if constant else 'NG'}: {name} ({', '.join(f'{n} tables: {q} queries' for n, q in by_count.items())})")
+            if not constant:
+                failures.append(name)
+        if failures:
+            raise click.ClickException(f"{len(failures)} builders run more queries as open tables grow.")
+
 # --- 実行 ---
 # --- 実行 ---
 if __name__ == '__main__':
@@ -0,0 +1,211 @@
+# --- asgi.py (長時間接続向けの非同期サーバーモード) ---
+# gunicornの同期ワーカーでは、SSEやロングポーリングの接続1本がワーカー(スレッド)を1つ占有してしまう。
+# このモードでは待ち時間の長いエンドポイントをイベントループ上で直接扱い、
+# それ以外のリクエスト (管理画面のExcel・画像処理などを含む) は従来どおりFlaskアプリをスレッドプールで実行する。
+# 待機中の接続はDB接続を持たない (通知は app.py のLISTEN専用接続から受け取る)。
+#
+# 起動例:
+#   gunicorn -w 2 -k uvicorn.workers.UvicornWorker asgi:application
+#   uvicorn asgi:application --host 0.0.0.0 --port $PORT
+import asyncio
+import json
+import os
+import re
+from urllib.parse import parse_qs, urlencode
+
+from a2wsgi import WSGIMiddleware
+
+from app import (
+    app, ALLOWED_ORIGINS, DB_POOL_MAX, EVENT_HEARTBEAT_SECONDS, EVENT_QUEUE_SIZE, LONG_POLL_FALLBACK_SECONDS, LONG_POLL_MAX_SECONDS,
+    format_event, is_call_event, is_event_listener_connected, subscribe_events, table_history_event_filter, unsubscribe_events,
+    verify_stream_token,
+)
+
+app.config['ASYNC_SERVING'] = True
+
+# Flaskのビューを実行するスレッド数 (DB接続プールより多くしても接続待ちになるだけ)
+ASGI_THREADS = int(os.environ.get("ASGI_THREADS", DB_POOL_MAX))
+
+wsgi_application = WSGIMiddleware(app, workers=ASGI_THREADS)
+
+
+class LoopSubscriber:
+    """LISTENスレッドから届いた通知を、イベントループ側のasyncio.Queueへ受け渡します。"""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=EVENT_QUEUE_SIZE)
+
+    def put_nowait(self, payload):
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._put, payload)
+
+    def _put(self, payload):
+        try:
+            self.queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            pass
+
+
+# --- レスポンスヘルパー ---
+def _cors_headers(scope):
+    origin = dict(scope['headers']).get(b'origin', b'').decode('latin-1')
+    if origin and ALLOWED_ORIGINS in ('*', origin):
+        return [(b'access-control-allow-origin', origin.encode('latin-1')), (b'vary', b'Origin')]
+    return []
+
+async def send_json(scope, send, status, data):
+    body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+    headers = [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers + _cors_headers(scope)})
+    await send({'type': 'http.response.body', 'body': body})
+
+async def wait_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+async def cancel_pending(*futures):
+    """完了していないタスクをキャンセルし、終了するまで待ちます (未完了のまま残さない)。"""
+    pending = [future for future in futures if future is not None and not future.done()]
+    for future in pending:
+        future.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+
+def query_params(scope):
+    return {key: values[0] for key, values in parse_qs(scope['query_string'].decode('latin-1')).items()}
+
+
+async def call_flask(scope):
+    """Flaskアプリをスレッドプールで実行し、レスポンスを送信せずにASGIメッセージのリストで返します。"""
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    await wsgi_application(scope, receive, send)
+    return messages
+
+
+# --- 非同期で扱うエンドポイント ---
+async def stream_events(scope, receive, send, match):
+    """通知をSSEで配信します。接続には /api/events/token で発行した短命トークンが必要です。"""
+    if verify_stream_token(query_params(scope).get('stream_token', '')) is None:
+        await send_json(scope, send, 401, {"status": "error", "message": "Invalid or expired token"})
+        return
+    subscriber = LoopSubscriber(asyncio.get_running_loop())
+    subscribe_events(subscriber)
+    disconnected = asyncio.ensure_future(wait_disconnect(receive))
+    getter = None
+    try:
+        headers = [(b'content-type', b'text/event-stream; charset=utf-8'), (b'cache-control', b'no-cache'), (b'x-accel-buffering', b'no')]
+        await send({'type': 'http.response.start', 'status': 200, 'headers': headers + _cors_headers(scope)})
+        chunk = "retry: 3000\n\n"
+        while not disconnected.done():
+            await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': True})
+            getter = asyncio.ensure_future(subscriber.queue.get())
+            done, _ = await asyncio.wait({getter, disconnected}, timeout=EVENT_HEARTBEAT_SECONDS, return_when=asyncio.FIRST_COMPLETED)
+            if getter in done:
+                chunk = format_event(getter.result())
+            else:
+                chunk = ": keepalive\n\n"
+                await cancel_pending(getter)
+    except OSError:
+        pass
+    finally:
+        unsubscribe_events(subscriber)
+        await cancel_pending(getter, disconnected)
+
+async def long_poll(scope, receive, send, matches):
+    """?wait=秒 のロングポーリング。Flaskアプリにはwaitを外したリクエストを渡し、
+    304 (If-None-Matchから変化なし) の間は、matches(event)を満たす通知をイベントループ上で待って再実行する。"""
+    params = parse_qs(scope['query_string'].decode('latin-1'), keep_blank_values=True)
+    if 'wait' not in params:
+        await wsgi_application(scope, receive, send)
+        return
+    try:
+        wait = min(max(float(params.pop('wait')[0]), 0), LONG_POLL_MAX_SECONDS)
+    except ValueError:
+        wait = 0
+    inner_scope = dict(scope, query_string=urlencode(params, doseq=True).encode('latin-1'))
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + wait
+    # 取得より先に購読しておき、取得直後の変更を取りこぼさない
+    subscriber = LoopSubscriber(loop)
+    subscribe_events(subscriber)
+    disconnected = asyncio.ensure_future(wait_disconnect(receive))
+    try:
+        while True:
+            messages = await call_flask(inner_scope)
+            if messages[0]['status'] != 304 or not await wait_for_event(subscriber, matches, deadline, disconnected):
+                break
+    finally:
+        unsubscribe_events(subscriber)
+        client_gone = disconnected.done()
+        await cancel_pending(disconnected)
+    if not client_gone:
+        for message in messages:
+            await send(message)
+
+async def wait_for_event(subscriber, matches, deadline, disconnected):
+    """対象の通知が届けばTrue、期限切れか切断ならFalseを返します。LISTEN接続が切れている間は一定間隔でTrueを返します。"""
+    loop = asyncio.get_running_loop()
+    while not disconnected.done():
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            return False
+        connected = is_event_listener_connected()
+        getter = asyncio.ensure_future(subscriber.queue.get())
+        try:
+            done, _ = await asyncio.wait({getter, disconnected}, timeout=remaining if connected else min(remaining, LONG_POLL_FALLBACK_SECONDS), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            # 切断や期限切れで抜けるときも、キューを待つタスクを残さない
+            await cancel_pending(getter)
+        if getter not in done:
+            if not connected and not disconnected.done():
+                return True
+            continue
+        if matches(json.loads(getter.result())):
+            return True
+    return False
+
+async def poll_calls(scope, receive, send, match):
+    await long_poll(scope, receive, send, is_call_event)
+
+async def poll_order_history(scope, receive, send, match):
+    await long_poll(scope, receive, send, table_history_event_filter(int(match[1])))
+
+# (メソッド, パスの正規表現, 非同期ハンドラ)。ここにないリクエストはすべてFlaskアプリへ渡す
+ASYNC_ROUTES = [
+    ('GET', re.compile(r'/api/events'), stream_events),
+    ('GET', re.compile(r'/api/get_calls'), poll_calls),
+    ('GET', re.compile(r'/api/get_order_history/(\d+)'), poll_order_history),
+]
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    for method, pattern, handler in ASYNC_ROUTES:
+        match = pattern.fullmatch(scope.get('path', ''))
+        if match and scope.get('method') == method:
+            await handler(scope, receive, send, match)
+            return
+    await wsgi_application(scope, receive, send)
+
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(application, host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
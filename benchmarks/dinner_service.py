@@ -0,0 +1,355 @@
+# --- dinner_service.py (ディナータイムの負荷試験) ---
+# N卓分の客のスマホ (メニュー取得・注文・注文履歴の確認・スタッフ呼び出し) と、
+# 厨房・ホール・レジの画面 (実際と同じ3秒間隔のポーリングと、提供済み・会計などの操作) を同時に動かし、
+# エンドポイントごとのスループット・p50/p99レイテンシ・1リクエストあたりのDBクエリ数を表示します。
+# DBクエリ数はサーバーが返す Server-Timing ヘッダー (db;desc="N queries") から読み取ります。
+#
+# 使い方 (捨ててよいローカルのPostgreSQLに接続したアプリを起動した状態で):
+#   python benchmarks/dinner_service.py --base-url http://127.0.0.1:5000 --tables 20 --duration 120 --json before.json
+# 既存のメニューをそのまま使います。空のDBでは --seed-menu を付けると uploads/menu.xlsx から登録します
+# (メニューのExcel取り込みと同じく、シートに無い商品・カテゴリーは削除されます)。
+#   (変更後) python benchmarks/dinner_service.py --tables 20 --duration 120 --baseline before.json
+# サーバーを起動せず、DATABASE_URL と JWT_SECRET_KEY を設定した状態でアプリをプロセス内で動かすこともできます:
+#   python benchmarks/dinner_service.py --in-process --tables 20 --duration 60 --speed 5
+# --speed を大きくすると、ポーリングや注文の間隔がその倍率で短くなります (5なら3秒ごとのポーリングが0.6秒ごと)。
+import argparse
+import gzip
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+POLL_INTERVAL = 3.0            # kitchen.js / hall.js / register.js のポーリング間隔 (SSE未接続時)
+HISTORY_INTERVAL = 10.0        # script.js の注文履歴の更新間隔
+ORDER_INTERVAL = 240.0         # 1卓あたりの平均注文間隔
+CALL_INTERVAL = 600.0          # 1卓あたりの平均呼び出し間隔
+COOKING_TIME = 300.0           # 厨房が「提供可」にするまでの時間
+SERVER_TIMING_DB = re.compile(r'db;dur=([\d.]+);desc="(\d+) queries"')
+NUMERIC_PATH_SEGMENT = re.compile(r'/\d+')
+
+
+class HttpClient:
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+
+    def request(self, method, path, body=None, headers=None):
+        req = urllib.request.Request(f"{self.base_url}{path}", data=body, headers=headers or {}, method=method)
+        try:
+            with urllib.request.urlopen(req, timeout=30) as res:
+                return res.status, res.headers.get_all('Server-Timing') or [], res.headers.get('Content-Encoding'), res.headers.get('ETag'), res.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.headers.get_all('Server-Timing') or [], e.headers.get('Content-Encoding'), None, e.read()
+
+
+class InProcessClient:
+    """アプリをimportし、FlaskのテストクライアントでHTTPサーバーを介さずに呼び出す"""
+    def __init__(self):
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        import app as app_module
+        app_module.init_db()
+        app_module.migrate_db()
+        self.app = app_module.app
+        self.local = threading.local()
+
+    def request(self, method, path, body=None, headers=None):
+        if not hasattr(self.local, 'client'):
+            self.local.client = self.app.test_client()
+        res = self.local.client.open(path, method=method, data=body, headers=headers or {})
+        return res.status_code, res.headers.getlist('Server-Timing'), res.headers.get('Content-Encoding'), res.headers.get('ETag'), res.get_data()
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+
+    def record(self, endpoint, seconds, status, db_queries):
+        with self.lock:
+            entry = self.samples.setdefault(endpoint, {'latencies': [], 'errors': 0, 'db_queries': []})
+            entry['latencies'].append(seconds)
+            if status >= 400:
+                entry['errors'] += 1
+            if db_queries is not None:
+                entry['db_queries'].append(db_queries)
+
+    def summary(self, elapsed):
+        results = {}
+        for endpoint, entry in sorted(self.samples.items()):
+            latencies = sorted(entry['latencies'])
+            results[endpoint] = {
+                'requests': len(latencies),
+                'errors': entry['errors'],
+                'rps': round(len(latencies) / elapsed, 2),
+                'p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+                'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+                'db_queries': round(sum(entry['db_queries']) / len(entry['db_queries']), 2) if entry['db_queries'] else None,
+            }
+        return results
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+class Api:
+    """エンドポイントの呼び出しと計測 (パス中の数字は <id> にまとめて集計する)"""
+    def __init__(self, client, stats):
+        self.client, self.stats = client, stats
+
+    def call(self, method, path, payload=None, token=None, headers=None, body=None, content_type=None):
+        headers = dict(headers or {}, **{'Accept-Encoding': 'gzip'})
+        if token:
+            headers['Authorization'] = f'Bearer {token}'
+        if payload is not None:
+            body = json.dumps(payload).encode('utf-8')
+            content_type = 'application/json'
+        if content_type:
+            headers['Content-Type'] = content_type
+        started = time.perf_counter()
+        status, server_timing, encoding, etag, data = self.client.request(method, path, body, headers)
+        elapsed = time.perf_counter() - started
+        match = SERVER_TIMING_DB.search(', '.join(server_timing))
+        endpoint = f"{method} {NUMERIC_PATH_SEGMENT.sub('/<id>', path.split('?')[0])}"
+        self.stats.record(endpoint, elapsed, status, int(match.group(2)) if match else None)
+        if encoding == 'gzip':
+            data = gzip.decompress(data)
+        result = json.loads(data.decode('utf-8')) if data and status != 304 else None
+        return status, result, etag
+
+
+def seed_menu(api, admin_token, menu_path):
+    """uploads/menu.xlsx (旧形式の「メニューバックアップ」シートにも対応) からメニューを登録する"""
+    import io
+    import openpyxl
+    source = openpyxl.load_workbook(menu_path, read_only=True)
+    if 'メニュー' in source.sheetnames:
+        rows = list(source['メニュー'].iter_rows(min_row=2, values_only=True))
+    else:
+        rows = list(source.worksheets[0].iter_rows(min_row=2, values_only=True))
+    rows = [tuple(row) + (None,) * 9 for row in rows if row and row[1]]
+    categories = []
+    for row in rows:
+        for name in str(row[5] or '').replace('　', ' ').split():
+            if name not in categories:
+                categories.append(name)
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.title = 'カテゴリー設定'
+    sheet.append(['表示順', 'カテゴリー名(日本語)', 'カテゴリー名(English)'])
+    for i, name in enumerate(categories, start=1):
+        sheet.append([i, name, None])
+    sheet = workbook.create_sheet('メニュー')
+    sheet.append(['商品ID', '商品名', '価格', '商品説明', '画像ファイル名', 'カテゴリー', '品切れ', '商品名(英語)', '商品説明(英語)'])
+    for row in rows:
+        sheet.append(list(row[:4]) + [row[4], row[5], 0, row[7], row[8]])
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    boundary = uuid.uuid4().hex
+    body = (f'--{boundary}\r\nContent-Disposition: form-data; name="menu_file"; filename="benchmark_menu.xlsx"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n').encode('utf-8') + buffer.getvalue() + f'\r\n--{boundary}--\r\n'.encode('utf-8')
+    status, result, _ = api.call('POST', '/api/admin/upload_menu', token=admin_token, body=body, content_type=f'multipart/form-data; boundary={boundary}')
+    if status != 200:
+        sys.exit(f"メニューの登録に失敗しました: {result}")
+
+
+def wait(stop, seconds):
+    return stop.wait(max(0.0, seconds))
+
+
+def phone(api, args, table_id, access_token, products, stop, rng):
+    """客のスマホ: メニューを開き、注文・履歴の確認・呼び出しを繰り返す"""
+    speed = args.speed
+    api.call('GET', '/api/get_opening_settings')
+    _, _, etag = api.call('GET', '/api/get_products')
+    api.call('GET', '/api/get_categories')
+    now = time.monotonic()
+    next_history = now
+    next_order = now + rng.uniform(0, ORDER_INTERVAL / 4) / speed
+    next_call = now + rng.expovariate(1 / CALL_INTERVAL) / speed
+    while not stop.is_set():
+        now = time.monotonic()
+        if now >= next_order:
+            # 注文前にメニューを開き直す (ETagが一致すれば304)
+            _, _, etag = api.call('GET', '/api/get_products', headers={'If-None-Match': etag} if etag else None)
+            items = [{'name': p['name'], 'quantity': rng.randint(1, 3)} for p in rng.sample(products, min(len(products), rng.randint(1, 4)))]
+            api.call('POST', '/api/order', {'tableId': table_id, 'accessToken': access_token, 'items': items})
+            next_order = now + rng.expovariate(1 / ORDER_INTERVAL) / speed
+            next_history = now
+        if now >= next_history:
+            api.call('GET', f'/api/get_order_history/{table_id}?token={access_token}')
+            next_history = now + HISTORY_INTERVAL / speed
+        if now >= next_call:
+            api.call('POST', '/api/call', {'tableId': table_id, 'token': access_token, 'call_type': 'normal'})
+            next_call = now + rng.expovariate(1 / CALL_INTERVAL) / speed
+        wait(stop, min(next_order, next_history, next_call) - time.monotonic())
+
+
+def merge_orders(orders_by_id, result):
+    """?since= の差分レスポンスを画面側と同じように手元の一覧へ反映する"""
+    if result is None:
+        return
+    if isinstance(result, list):
+        orders_by_id.clear()
+        orders_by_id.update({o['id']: o for o in result})
+        return
+    if result.get('full'):
+        orders_by_id.clear()
+    orders_by_id.update({o['id']: o for o in result.get('orders', [])})
+    for order_id in result.get('removed_order_ids', []):
+        orders_by_id.pop(order_id, None)
+
+
+def kitchen_screen(api, args, staff_token, stop):
+    """厨房: 3秒ごとに注文を取得し、調理時間が過ぎた品を「提供可」にする"""
+    revision, orders = 0, {}
+    while not stop.is_set():
+        _, result, _ = api.call('GET', f'/api/get_all_active_orders?since={revision}', token=staff_token)
+        merge_orders(orders, result)
+        revision = result.get('revision', revision) if isinstance(result, dict) else revision
+        now = time.time()
+        for order in list(orders.values()):
+            if now - order['created_at'] < COOKING_TIME / args.speed:
+                continue
+            for item in order.get('items', []):
+                if item['item_status'] == 'cooking':
+                    api.call('POST', f"/api/update_item_status/{item['id']}", {'status': 'ready'}, token=staff_token)
+        wait(stop, POLL_INTERVAL / args.speed)
+
+
+def hall_screen(api, args, staff_token, stop):
+    """ホール: 注文と呼び出しを3秒ごとに取得し、呼び出しへの対応と配膳を行う"""
+    revision, orders = 0, {}
+    while not stop.is_set():
+        _, result, _ = api.call('GET', f'/api/get_all_active_orders?since={revision}', token=staff_token)
+        merge_orders(orders, result)
+        revision = result.get('revision', revision) if isinstance(result, dict) else revision
+        _, calls, _ = api.call('GET', '/api/get_calls', token=staff_token)
+        for call in calls or []:
+            if call.get('table_id') in args.table_ids:
+                api.call('POST', f"/api/resolve_call/{call['table_id']}", {}, token=staff_token)
+        for order in list(orders.values()):
+            for item in order.get('items', []):
+                if item['item_status'] == 'ready':
+                    api.call('POST', f"/api/update_item_status/{item['id']}", {'status': 'served'}, token=staff_token)
+        wait(stop, POLL_INTERVAL / args.speed)
+
+
+def register_screen(api, args, staff_token, stop):
+    """レジ: テーブル一覧と会計済み注文を3秒ごとに取得する"""
+    revision = 0
+    while not stop.is_set():
+        _, result, _ = api.call('GET', f'/api/get_table_summary?since={revision}', token=staff_token)
+        revision = result.get('revision', revision) if isinstance(result, dict) else revision
+        api.call('GET', '/api/get_paid_orders', token=staff_token)
+        wait(stop, POLL_INTERVAL / args.speed)
+
+
+def print_report(summary, elapsed, baseline=None, tolerance=0.5):
+    print(f"{'endpoint':<48} {'req':>6} {'err':>4} {'req/s':>7} {'p50 ms':>8} {'p99 ms':>8} {'queries':>8}")
+    regressions = []
+    for endpoint, row in summary.items():
+        queries = '-' if row['db_queries'] is None else f"{row['db_queries']:.2f}"
+        line = f"{endpoint:<48} {row['requests']:>6} {row['errors']:>4} {row['rps']:>7.2f} {row['p50_ms']:>8.2f} {row['p99_ms']:>8.2f} {queries:>8}"
+        before = (baseline or {}).get(endpoint)
+        if before:
+            line += f"   (p99 {before['p99_ms']:.2f} → {row['p99_ms']:.2f}, queries {before['db_queries']} → {row['db_queries']})"
+            if row['db_queries'] is not None and before['db_queries'] is not None and row['db_queries'] > before['db_queries'] + 0.5:
+                regressions.append(f"{endpoint}: DBクエリ数 {before['db_queries']} → {row['db_queries']}")
+            if row['p99_ms'] > before['p99_ms'] * (1 + tolerance) and row['p99_ms'] - before['p99_ms'] > 5:
+                regressions.append(f"{endpoint}: p99 {before['p99_ms']}ms → {row['p99_ms']}ms")
+        print(line)
+    total = sum(row['requests'] for row in summary.values())
+    errors = sum(row['errors'] for row in summary.values())
+    print(f"合計: {total} リクエスト / {elapsed:.1f} 秒 = {total / elapsed:.1f} req/s, エラー {errors} 件")
+    return regressions, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ディナータイムを想定した負荷試験')
+    parser.add_argument('--base-url', default='http://127.0.0.1:5000')
+    parser.add_argument('--in-process', action='store_true', help='HTTPサーバーを使わずアプリをプロセス内で動かす')
+    parser.add_argument('--username', default='staff')
+    parser.add_argument('--password', default='your_common_password')
+    parser.add_argument('--admin-username', default='admin')
+    parser.add_argument('--admin-password', default='admin_password')
+    parser.add_argument('--menu', default=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'uploads', 'menu.xlsx'))
+    parser.add_argument('--seed-menu', action='store_true',
+                        help='--menuの内容でメニューを登録し直す (upload_menuはシートに無い商品・カテゴリーを削除するので、捨ててよいDBでのみ使うこと)')
+    parser.add_argument('--tables', type=int, default=20, help='客のテーブル数')
+    parser.add_argument('--first-table', type=int, default=900, help='試験に使うテーブル番号の開始値')
+    parser.add_argument('--kitchen', type=int, default=1, help='厨房画面の数')
+    parser.add_argument('--hall', type=int, default=1, help='ホール画面の数')
+    parser.add_argument('--register', type=int, default=1, help='レジ画面の数')
+    parser.add_argument('--duration', type=float, default=60, help='試験時間 (秒)')
+    parser.add_argument('--speed', type=float, default=1.0, help='間隔を短縮する倍率')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--json', help='結果をJSONで保存するファイル')
+    parser.add_argument('--baseline', help='比較する過去の結果 (--jsonで保存したもの)')
+    parser.add_argument('--tolerance', type=float, default=0.5, help='p99の悪化を許容する割合')
+    args = parser.parse_args()
+
+    stats = Stats()
+    api = Api(InProcessClient() if args.in_process else HttpClient(args.base_url), stats)
+    _, login, _ = api.call('POST', '/api/login', {'username': args.username, 'password': args.password})
+    staff_token = login['token']
+    # 既定では既存のメニューを読むだけにする
+    if args.seed_menu:
+        _, admin_login, _ = api.call('POST', '/api/login', {'username': args.admin_username, 'password': args.admin_password})
+        seed_menu(api, admin_login['token'], args.menu)
+    _, products, _ = api.call('GET', '/api/get_products')
+    products = [p for p in products if not p['is_sold_out']]
+    if not products:
+        sys.exit('注文可能な商品がありません (--seed-menu でメニューを登録できます)。')
+    args.table_ids = set(range(args.first_table, args.first_table + args.tables))
+    tokens = {}
+    for table_id in sorted(args.table_ids):
+        api.call('POST', f'/api/checkout_table/{table_id}', {}, token=staff_token)
+        tokens[table_id] = api.call('POST', f'/api/generate_table_token/{table_id}', {}, token=staff_token)[1]['accessToken']
+    stats.samples.clear()  # 準備のリクエストは集計に含めない
+
+    stop = threading.Event()
+    rng = random.Random(args.seed)
+    threads = [threading.Thread(target=phone, args=(api, args, t, tokens[t], products, stop, random.Random(rng.random())), daemon=True) for t in sorted(args.table_ids)]
+    threads += [threading.Thread(target=kitchen_screen, args=(api, args, staff_token, stop), daemon=True) for _ in range(args.kitchen)]
+    threads += [threading.Thread(target=hall_screen, args=(api, args, staff_token, stop), daemon=True) for _ in range(args.hall)]
+    threads += [threading.Thread(target=register_screen, args=(api, args, staff_token, stop), daemon=True) for _ in range(args.register)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    stop.wait(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join(timeout=30)
+    elapsed = time.monotonic() - started
+    summary = stats.summary(elapsed)
+
+    for table_id in sorted(args.table_ids):
+        api.call('POST', f'/api/checkout_table/{table_id}', {}, token=staff_token)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            saved = json.load(f)
+        baseline = saved['endpoints']
+        if (saved['tables'], saved['speed']) != (args.tables, args.speed):
+            print(f"注意: 比較元は --tables {saved['tables']} --speed {saved['speed']} で計測されています。")
+    regressions, errors = print_report(summary, elapsed, baseline, args.tolerance)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'tables': args.tables, 'duration': args.duration, 'speed': args.speed, 'endpoints': summary}, f, ensure_ascii=False, indent=2)
+    for regression in regressions:
+        print(f"NG: {regression}")
+    if regressions or errors:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
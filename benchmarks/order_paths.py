@@ -0,0 +1,97 @@
+# --- order_paths.py (注文まわりのクエリ数・レイテンシの回帰ベンチマーク) ---
+# 1. 未会計のテーブル数を増やしながら get_table_summary / get_all_active_orders を呼び、
+#    1リクエストあたりのDBクエリ数がテーブル数に依存しない (N+1になっていない) ことを確認します。
+# 2. カートの行数を変えて /api/order を送り、行数ごとのレイテンシとクエリ数を表示します。
+# DBクエリ数はサーバーが返す Server-Timing ヘッダーから読み取ります (dinner_service.py と共通)。
+#
+# 使い方 (捨ててよいローカルのPostgreSQLに接続したアプリを起動した状態で):
+#   python benchmarks/order_paths.py --base-url http://127.0.0.1:5000
+#   python benchmarks/order_paths.py --in-process   (DATABASE_URL と JWT_SECRET_KEY を設定した状態で)
+import argparse
+import random
+import sys
+
+from dinner_service import Api, HttpClient, InProcessClient, Stats, percentile
+
+
+def main():
+    parser = argparse.ArgumentParser(description='注文まわりのクエリ数・レイテンシの回帰ベンチマーク')
+    parser.add_argument('--base-url', default='http://127.0.0.1:5000')
+    parser.add_argument('--in-process', action='store_true', help='HTTPサーバーを使わずアプリをプロセス内で動かす')
+    parser.add_argument('--username', default='staff')
+    parser.add_argument('--password', default='your_common_password')
+    parser.add_argument('--first-table', type=int, default=900, help='試験に使うテーブル番号の開始値')
+    parser.add_argument('--table-counts', default='5,20,40', help='未会計テーブル数 (カンマ区切り)')
+    parser.add_argument('--cart-sizes', default='1,5,10,20', help='カートの行数 (カンマ区切り)')
+    parser.add_argument('--repeat', type=int, default=20, help='各条件での呼び出し回数')
+    args = parser.parse_args()
+
+    stats = Stats()
+    api = Api(InProcessClient() if args.in_process else HttpClient(args.base_url), stats)
+    staff_token = api.call('POST', '/api/login', {'username': args.username, 'password': args.password})[1]['token']
+    products = [p for p in api.call('GET', '/api/get_products')[1] if not p['is_sold_out']]
+    if not products:
+        sys.exit('注文可能な商品がありません。')
+    rng = random.Random(42)
+    table_counts = [int(n) for n in args.table_counts.split(',')]
+    cart_sizes = [int(n) for n in args.cart_sizes.split(',')]
+    table_ids = list(range(args.first_table, args.first_table + max(table_counts)))
+    failures = []
+
+    def measure(label, method, path, payload=None, token=None):
+        stats.samples.clear()
+        for _ in range(args.repeat):
+            status = api.call(method, path, payload, token=token)[0]
+            if status >= 400:
+                sys.exit(f"{label}: HTTP {status}")
+        entry = next(iter(stats.samples.values()))
+        latencies = sorted(entry['latencies'])
+        queries = sorted(set(entry['db_queries']))
+        return percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000, queries
+
+    for table_id in table_ids:
+        api.call('POST', f'/api/checkout_table/{table_id}', {}, token=staff_token)
+    print("1. 未会計テーブル数とクエリ数")
+    print(f"{'endpoint':<32} {'tables':>6} {'p50 ms':>8} {'p99 ms':>8} {'queries':>8}")
+    opened, query_counts = 0, {}
+    for count in table_counts:
+        while opened < count:
+            table_id = table_ids[opened]
+            token = api.call('POST', f'/api/generate_table_token/{table_id}', {}, token=staff_token)[1]['accessToken']
+            items = [{'name': p['name'], 'quantity': 1} for p in rng.sample(products, min(len(products), 3))]
+            api.call('POST', '/api/order', {'tableId': table_id, 'accessToken': token, 'items': items})
+            opened += 1
+        for path in ('/api/get_table_summary', '/api/get_all_active_orders'):
+            p50, p99, queries = measure(path, 'GET', path, token=staff_token)
+            query_counts.setdefault(path, set()).update(queries)
+            print(f"{path:<32} {count:>6} {p50:>8.2f} {p99:>8.2f} {'/'.join(map(str, queries)):>8}")
+    for path, queries in query_counts.items():
+        if len(queries) > 1:
+            failures.append(f"{path}: テーブル数によってクエリ数が変わります ({sorted(queries)})")
+
+    print("\n2. カートの行数と注文のレイテンシ")
+    print(f"{'lines':>6} {'p50 ms':>8} {'p99 ms':>8} {'queries':>8}")
+    table_id = table_ids[0]
+    token = api.call('POST', f'/api/generate_table_token/{table_id}', {}, token=staff_token)[1]['accessToken']
+    # 最初の1件は注文の新規作成になるため、追記の経路だけを計測するよう先に1件送っておく
+    api.call('POST', '/api/order', {'tableId': table_id, 'accessToken': token, 'items': [{'name': products[0]['name'], 'quantity': 1}]})
+    order_queries = set()
+    for size in cart_sizes:
+        items = [{'name': products[i % len(products)]['name'], 'quantity': 1} for i in range(size)]
+        p50, p99, queries = measure('/api/order', 'POST', '/api/order', {'tableId': table_id, 'accessToken': token, 'items': items})
+        order_queries.update(queries)
+        print(f"{size:>6} {p50:>8.2f} {p99:>8.2f} {'/'.join(map(str, queries)):>8}")
+    if len(order_queries) > 1:
+        failures.append(f"/api/order: カートの行数によってクエリ数が変わります ({sorted(order_queries)})")
+
+    for table_id in table_ids:
+        api.call('POST', f'/api/checkout_table/{table_id}', {}, token=staff_token)
+    for failure in failures:
+        print(f"NG: {failure}")
+    if failures:
+        sys.exit(1)
+    print("OK: クエリ数はテーブル数・カートの行数に依存しません。")
+
+
+if __name__ == '__main__':
+    main()
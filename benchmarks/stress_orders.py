@@ -0,0 +1,105 @@
+# --- stress_orders.py (同時注文のストレステスト) ---
+# 1つのテーブルに対して複数のスマホから同時に注文が届いた状況を再現し、
+# 注文が1件にまとまっているか・数量と合計金額が正しいかを検証します。
+#
+# 使い方 (ローカルのPostgreSQLに接続したアプリを起動した状態で):
+#   python benchmarks/stress_orders.py --base-url http://127.0.0.1:5000 --tables 5 --orders 200
+import argparse
+import json
+import random
+import sys
+import urllib.error
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+
+def call_api(base_url, path, payload=None, token=None):
+    headers = {'Content-Type': 'application/json'}
+    if token:
+        headers['Authorization'] = f'Bearer {token}'
+    data = json.dumps(payload).encode('utf-8') if payload is not None else None
+    req = urllib.request.Request(f"{base_url}/api{path}", data=data, headers=headers, method='POST' if data is not None else 'GET')
+    with urllib.request.urlopen(req, timeout=30) as res:
+        return json.loads(res.read().decode('utf-8'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='同時注文のストレステスト')
+    parser.add_argument('--base-url', default='http://127.0.0.1:5000')
+    parser.add_argument('--username', default='staff')
+    parser.add_argument('--password', default='your_common_password')
+    parser.add_argument('--tables', type=int, default=5, help='テーブル数')
+    parser.add_argument('--orders', type=int, default=200, help='テーブルごとの注文数')
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--first-table', type=int, default=900, help='検証に使うテーブル番号の開始値')
+    args = parser.parse_args()
+
+    staff_token = call_api(args.base_url, '/login', {'username': args.username, 'password': args.password})['token']
+    products = [p for p in call_api(args.base_url, '/get_products') if not p['is_sold_out']]
+    if not products:
+        sys.exit('注文可能な商品がありません。')
+    table_ids = list(range(args.first_table, args.first_table + args.tables))
+    for table_id in table_ids:
+        call_api(args.base_url, f'/checkout_table/{table_id}', {}, staff_token)
+    access_tokens = {t: call_api(args.base_url, f'/generate_table_token/{t}', {}, staff_token)['accessToken'] for t in table_ids}
+
+    # 送信するカートを事前に作り、期待値 (商品ごとの数量・合計金額) を計算しておく
+    rng = random.Random(42)
+    carts, expected = [], {t: {'quantities': {}, 'total': 0} for t in table_ids}
+    for table_id in table_ids:
+        for _ in range(args.orders):
+            items = [{'name': p['name'], 'quantity': rng.randint(1, 3)} for p in rng.sample(products, min(len(products), rng.randint(1, 5)))]
+            carts.append((table_id, items))
+            for item in items:
+                price = next(p['price'] for p in products if p['name'] == item['name'])
+                expected[table_id]['quantities'][item['name']] = expected[table_id]['quantities'].get(item['name'], 0) + item['quantity']
+                expected[table_id]['total'] += price * item['quantity']
+    rng.shuffle(carts)
+
+    def submit(cart):
+        table_id, items = cart
+        try:
+            return call_api(args.base_url, '/order', {'tableId': table_id, 'accessToken': access_tokens[table_id], 'items': items})['status']
+        except urllib.error.HTTPError as e:
+            # 4xx/5xxでもワーカーを止めず、ステータスごとに失敗として数える
+            return f"HTTP {e.code}"
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(submit, carts))
+    failure_counts = Counter(r for r in results if r != 'success')
+    failures = sum(failure_counts.values())
+
+    summary = {t['table_id']: t for t in call_api(args.base_url, '/get_table_summary', token=staff_token)}
+    errors = []
+    for table_id in table_ids:
+        table = summary.get(table_id)
+        if not table:
+            errors.append(f"テーブル {table_id}: 注文が見つかりません")
+            continue
+        if len(table['orders']) != 1:
+            errors.append(f"テーブル {table_id}: 未会計の注文が {len(table['orders'])} 件あります")
+        quantities = {}
+        for order in table['orders']:
+            for item in order['items']:
+                quantities[item['item_name']] = quantities.get(item['item_name'], 0) + item['quantity']
+        if quantities != expected[table_id]['quantities']:
+            errors.append(f"テーブル {table_id}: 数量が一致しません")
+        if round(table['grand_total']) != round(expected[table_id]['total']):
+            errors.append(f"テーブル {table_id}: 合計 {table['grand_total']} (期待値 {expected[table_id]['total']})")
+        call_api(args.base_url, f'/checkout_table/{table_id}', {}, staff_token)
+
+    print(f"送信: {len(carts)} 件 / 失敗: {failures} 件 ({failures / len(carts):.1%})")
+    for status, count in sorted(failure_counts.items()):
+        print(f"  {status}: {count} 件")
+    if failures:
+        print("注: 失敗した注文があるため、数量・合計金額は期待値と一致しません。")
+    for error in errors:
+        print(f"NG: {error}")
+    if failures or errors:
+        sys.exit(1)
+    print("OK: すべてのテーブルで注文・数量・合計金額が一致しました。")
+
+
+if __name__ == '__main__':
+    main()
@@ -114,20 +114,82 @@ document.addEventListener('DOMContentLoaded', () => {
         return res;
     }
 
+    // 差分取得: 前回のrevision以降に変更された注文だけを受け取り、手元の一覧に反映する
+    let revision = 0;
+    const ordersById = new Map();
+
+    async function fetchActiveOrders() {
+        const response = await authenticatedFetch(`${API_BASE_URL}/get_all_active_orders?since=${revision}`);
+        if (!response || !response.ok) return null;
+        const delta = await response.json();
+        if (delta.full || delta.revision >= revision) {
+            if (delta.full) ordersById.clear();
+            delta.orders.forEach(order => ordersById.set(order.id, order));
+            delta.removed_order_ids.forEach(id => ordersById.delete(id));
+            revision = delta.revision;
+        }
+        return [...ordersById.values()].sort((a, b) => a.created_at - b.created_at);
+    }
+
+    // 呼び出し一覧: サーバーがロングポーリングに対応していれば (asgi.pyで起動している場合)、
+    // 変化があるまで待つ要求を繰り返して保持しておく。対応していなければ画面の更新のたびに取得する
+    const CALLS_RETRY_DELAY_MS = 3000;
+    let watchedCalls = null;
+
+    async function fetchCalls() {
+        if (watchedCalls) return watchedCalls;
+        const res = await authenticatedFetch(`${API_BASE_URL}/get_calls`);
+        if (!res || !res.ok) return null;
+        return res.json();
+    }
+
+    async function watchCalls() {
+        let waitSeconds = 0;
+        try {
+            const res = await fetch(`${API_BASE_URL}/server_features`);
+            if (res.ok) waitSeconds = (await res.json()).longPollMaxSeconds || 0;
+        } catch (error) {
+            console.error("サーバー機能の取得に失敗:", error);
+        }
+        if (!waitSeconds) return;
+        let etag = null;
+        while (true) {
+            try {
+                const res = await authenticatedFetch(`${API_BASE_URL}/get_calls?wait=${waitSeconds}`, {
+                    headers: etag ? { 'If-None-Match': etag } : {},
+                    cache: 'no-store'
+                });
+                if (!res) return;
+                if (res.status === 304) continue;
+                if (res.ok) {
+                    watchedCalls = await res.json();
+                    etag = res.headers.get('ETag');
+                    refreshHallView();
+                    if (etag) continue;
+                } else {
+                    watchedCalls = null;
+                    etag = null;
+                }
+            } catch (error) {
+                console.error("呼び出し一覧の取得中にエラー:", error);
+                watchedCalls = null;
+                etag = null;
+            }
+            await new Promise(resolve => setTimeout(resolve, CALLS_RETRY_DELAY_MS));
+        }
+    }
+
     async function refreshHallView() {
         try {
-            const [ordersRes, callsRes] = await Promise.all([
-                authenticatedFetch(`${API_BASE_URL}/get_all_active_orders`),
-                authenticatedFetch(`${API_BASE_URL}/get_calls`)
+            const [orders, calls] = await Promise.all([
+                fetchActiveOrders(),
+                fetchCalls()
             ]);
-            if (!ordersRes || !callsRes || !ordersRes.ok || !callsRes.ok) {
+            if (!orders || !calls) {
                 console.error("APIからのデータ取得に失敗しました。");
                 return;
             }
 
-            const orders = await ordersRes.json();
-            const calls = await callsRes.json(); 
-
             const normalCalls = calls.filter(c => c.call_type === 'normal');
             const checkoutCallingTableIds = new Set(
                 calls.filter(c => c.call_type === 'checkout').map(c => c.table_id)
@@ -360,6 +422,8 @@ document.addEventListener('DOMContentLoaded', () => {
 
     // 初期化と定期更新
     setupEventListeners();
-    setInterval(refreshHallView, 3000); 
+    // リアルタイム更新 (realtime.js)。プッシュ配信がない間は3秒ごとのポーリングで動作
+    startLiveUpdates({ apiBaseUrl: API_BASE_URL, authHeaders, refresh: refreshHallView, eventTypes: ['order_item_added', 'item_status_changed', 'item_quantity_changed', 'item_cancelled', 'table_checked_out', 'call_raised', 'call_resolved'] });
     refreshHallView();
+    watchCalls();
 });
\ No newline at end of file
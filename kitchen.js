@@ -44,11 +44,27 @@ document.addEventListener('DOMContentLoaded', () => {
         return res;
     }
 
+    // 差分取得: 前回のrevision以降に変更された注文だけを受け取り、手元の一覧に反映する
+    let revision = 0;
+    const ordersById = new Map();
+
+    async function fetchActiveOrders() {
+        const response = await authenticatedFetch(`${API_BASE_URL}/get_all_active_orders?since=${revision}`);
+        if (!response || !response.ok) return null;
+        const delta = await response.json();
+        if (delta.full || delta.revision >= revision) {
+            if (delta.full) ordersById.clear();
+            delta.orders.forEach(order => ordersById.set(order.id, order));
+            delta.removed_order_ids.forEach(id => ordersById.delete(id));
+            revision = delta.revision;
+        }
+        return [...ordersById.values()].sort((a, b) => a.created_at - b.created_at);
+    }
+
     async function refreshKitchenView() {
         try {
-            const response = await authenticatedFetch(`${API_BASE_URL}/get_all_active_orders`);
-            if (!response || !response.ok) return;
-            const orders = await response.json();
+            const orders = await fetchActiveOrders();
+            if (!orders) return;
             
             const currentlyDisplayed = new Set([...kitchenDisplay.querySelectorAll('.item-card')].map(c => c.dataset.itemId));
             const incomingItems = new Set();
@@ -114,6 +130,7 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     });
 
-    setInterval(refreshKitchenView, 3000);
+    // --- リアルタイム更新 (realtime.js)。プッシュ配信がない間は3秒ごとのポーリングで動作 ---
+    startLiveUpdates({ apiBaseUrl: API_BASE_URL, authHeaders, refresh: refreshKitchenView, eventTypes: ['order_item_added', 'item_status_changed', 'item_quantity_changed', 'item_cancelled', 'table_checked_out'] });
     refreshKitchenView();
 });
\ No newline at end of file
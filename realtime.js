@@ -0,0 +1,47 @@
+// --- realtime.js (スタッフ画面共通のリアルタイム更新) ---
+// サーバーがプッシュ配信に対応している場合 (asgi.pyで起動している場合) だけSSEで更新を受け取る。
+// 対応していない・接続できない間は、従来どおり3秒ごとのポーリングで画面を更新する。
+function startLiveUpdates({ apiBaseUrl, authHeaders, refresh, eventTypes }) {
+    const POLL_INTERVAL_MS = 3000;
+    const FALLBACK_POLL_INTERVAL_MS = 30000;
+    const RECONNECT_DELAY_MS = 3000;
+    let pollTimer = null;
+    let refreshScheduled = false;
+
+    function startPolling(intervalMs) {
+        if (pollTimer) clearInterval(pollTimer);
+        pollTimer = setInterval(refresh, intervalMs);
+    }
+
+    function scheduleRefresh() {
+        if (refreshScheduled) return;
+        refreshScheduled = true;
+        setTimeout(() => { refreshScheduled = false; refresh(); }, 200);
+    }
+
+    // 接続用トークンは短命なので、切断されたら取り直してから再接続する
+    async function connect() {
+        if (!window.EventSource) return;
+        let data;
+        try {
+            const res = await fetch(`${apiBaseUrl}/events/token`, { method: 'POST', headers: authHeaders });
+            if (!res.ok) return;
+            data = await res.json();
+        } catch (error) {
+            setTimeout(connect, RECONNECT_DELAY_MS);
+            return;
+        }
+        if (!data.push) return;
+        const source = new EventSource(`${apiBaseUrl}/events?stream_token=${encodeURIComponent(data.streamToken)}`);
+        source.onopen = () => { startPolling(FALLBACK_POLL_INTERVAL_MS); scheduleRefresh(); };
+        source.onerror = () => {
+            source.close();
+            startPolling(POLL_INTERVAL_MS);
+            setTimeout(connect, RECONNECT_DELAY_MS);
+        };
+        eventTypes.forEach(type => source.addEventListener(type, scheduleRefresh));
+    }
+
+    startPolling(POLL_INTERVAL_MS);
+    connect();
+}
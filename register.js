@@ -71,16 +71,32 @@ document.addEventListener('DOMContentLoaded', () => {
         return res;
     }
 
+    // 差分取得: 前回のrevision以降に変更されたテーブルだけを受け取り、手元の一覧に反映する
+    let revision = 0;
+    const tablesById = new Map();
+
+    async function fetchTableSummary() {
+        const response = await authenticatedFetch(`${API_BASE_URL}/get_table_summary?since=${revision}`);
+        if (!response || !response.ok) return null;
+        const delta = await response.json();
+        if (delta.full || delta.revision >= revision) {
+            if (delta.full) tablesById.clear();
+            delta.tables.forEach(table => tablesById.set(table.table_id, table));
+            delta.removed_table_ids.forEach(id => tablesById.delete(id));
+            revision = delta.revision;
+        }
+        return [...tablesById.values()].sort((a, b) => a.table_id - b.table_id);
+    }
+
     async function refreshRegisterView() {
         try {
-            const [tablesRes, paidOrdersRes] = await Promise.all([
-                authenticatedFetch(`${API_BASE_URL}/get_table_summary`),
+            const [tables, paidOrdersRes] = await Promise.all([
+                fetchTableSummary(),
                 authenticatedFetch(`${API_BASE_URL}/get_paid_orders`)
             ]);
 
-            if (!tablesRes || !paidOrdersRes || !tablesRes.ok || !paidOrdersRes.ok) return;
+            if (!tables || !paidOrdersRes || !paidOrdersRes.ok) return;
             
-            const tables = await tablesRes.json();
             const paidOrders = await paidOrdersRes.json();
             
             const checkoutCallingTableIds = new Set(
@@ -309,6 +325,7 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     });
 
-    setInterval(refreshRegisterView, 3000);
+    // --- リアルタイム更新 (realtime.js)。プッシュ配信がない間は3秒ごとのポーリングで動作 ---
+    startLiveUpdates({ apiBaseUrl: API_BASE_URL, authHeaders, refresh: refreshRegisterView, eventTypes: ['order_item_added', 'item_status_changed', 'item_quantity_changed', 'item_cancelled', 'table_checked_out', 'call_raised', 'call_resolved'] });
     refreshRegisterView();
 });
\ No newline at end of file
@@ -77,7 +77,7 @@ document.addEventListener('DOMContentLoaded', () => {
 
                 const slide1 = document.createElement('div');
                 slide1.className = 'opening-element slide';
-                slide1.style.backgroundImage = `url(${imageUrl1})`;
+                openingBackground(slide1, imageUrl1, settings.opening_image_variants);
 
                 overlay.appendChild(logoWrapper);
                 overlay.appendChild(slide1);
@@ -86,7 +86,7 @@ document.addEventListener('DOMContentLoaded', () => {
                 if (imageUrl2) {
                     const slide2 = document.createElement('div');
                     slide2.className = 'opening-element slide';
-                    slide2.style.backgroundImage = `url(${imageUrl2})`;
+                    openingBackground(slide2, imageUrl2, settings.opening_image_variants_2);
                     overlay.appendChild(slide2);
                 }
                 document.body.prepend(overlay);
@@ -157,6 +157,49 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    // 注文履歴は、サーバーが対応していれば変更を待つロングポーリングで、そうでなければ10秒ごとの取得で更新する
+    // (失敗時やETagが読めない場合も10秒ごとの取得と同じ間隔)
+    const HISTORY_POLL_INTERVAL_MS = 10000;
+
+    async function fetchLongPollSeconds() {
+        try {
+            const res = await fetch(`${API_BASE_URL}/server_features`);
+            if (res.ok) return (await res.json()).longPollMaxSeconds || 0;
+        } catch (error) {
+            console.error("サーバー機能の取得に失敗:", error);
+        }
+        return 0;
+    }
+
+    async function watchOrderHistory() {
+        const waitSeconds = await fetchLongPollSeconds();
+        if (!waitSeconds) {
+            setInterval(refreshOrderHistory, HISTORY_POLL_INTERVAL_MS);
+            return;
+        }
+        let etag = null;
+        while (true) {
+            try {
+                const res = await fetch(`${API_BASE_URL}/get_order_history/${currentTableId}?token=${currentAccessToken}&wait=${waitSeconds}`, {
+                    headers: etag ? { 'If-None-Match': etag } : {},
+                    cache: 'no-store'
+                });
+                if (res.status === 304) continue;
+                if (res.ok) {
+                    orderHistory = await res.json();
+                    etag = res.headers.get('ETag');
+                    if (etag) continue;
+                } else {
+                    orderHistory = { items: [], total_price: 0 };
+                    etag = null;
+                }
+            } catch (error) {
+                console.error("注文履歴の取得中にエラー:", error);
+            }
+            await new Promise(resolve => setTimeout(resolve, HISTORY_POLL_INTERVAL_MS));
+        }
+    }
+
     function updateCartAndTotals() {
         if (!cartItemsList || !cartTotalPriceElement || !cartItemCountBadge) return;
         cartItemsList.innerHTML = '';
@@ -244,6 +287,24 @@ document.addEventListener('DOMContentLoaded', () => {
         products.forEach(product => menuContainer.appendChild(createMenuItemElement(product)));
     }
 
+    // サイズ別の派生画像があれば、画面幅に合ったWebP(非対応端末はJPEG)を読み込ませる
+    const MENU_IMAGE_SIZES = '(max-width: 768px) 80px, 120px';
+    function productImageHtml(product, imagePath, name) {
+        const variants = product.image_variants;
+        const fallback = `onerror="this.src='/images/no-image.jpg';"`;
+        if (!variants) return `<img src="${imagePath}" alt="${name}" ${fallback}>`;
+        return `<picture><source type="image/webp" srcset="${variants.srcset.webp}" sizes="${MENU_IMAGE_SIZES}"><img src="${variants.sizes.card.jpg}" srcset="${variants.srcset.jpg}" sizes="${MENU_IMAGE_SIZES}" alt="${name}" loading="lazy" ${fallback}></picture>`;
+    }
+
+    function openingBackground(element, url, variants) {
+        element.style.backgroundImage = `url(${url})`;
+        if (!variants) return;
+        const full = variants.sizes.full;
+        element.style.backgroundImage = `url(${full.jpg})`;
+        // image-set()に対応していないブラウザでは代入が無視され、上のJPEGが使われる
+        element.style.backgroundImage = `image-set(url("${full.webp}") type("image/webp"), url("${full.jpg}") type("image/jpeg"))`;
+    }
+
     function createMenuItemElement(product) {
         const div = document.createElement('div');
         div.className = 'menu-item';
@@ -257,7 +318,7 @@ document.addEventListener('DOMContentLoaded', () => {
         const priceText = `${translations[lang].price_label}: ${product.price.toLocaleString()}${translations[lang].yen}`;
         const addToCartText = translations[lang].add_to_cart;
         const imagePath = product.image_path ? `/images/${product.image_path}` : '/images/no-image.jpg';
-        div.innerHTML = `<img src="${imagePath}" alt="${name}" onerror="this.src='/images/no-image.jpg';"><div class="info"><h3>${name}</h3><p>${priceText}</p><p>${description || ''}</p></div><div class="actions"><div class="quantity-selector"><button class="quantity-btn minus-btn" type="button">-</button><input type="number" class="quantity-input" value="1" min="1"><button class="quantity-btn plus-btn" type="button">+</button></div><button class="add-to-cart-btn" type="button">${addToCartText}</button></div>`;
+        div.innerHTML = `${productImageHtml(product, imagePath, name)}<div class="info"><h3>${name}</h3><p>${priceText}</p><p>${description || ''}</p></div><div class="actions"><div class="quantity-selector"><button class="quantity-btn minus-btn" type="button">-</button><input type="number" class="quantity-input" value="1" min="1"><button class="quantity-btn plus-btn" type="button">+</button></div><button class="add-to-cart-btn" type="button">${addToCartText}</button></div>`;
         return div;
     }
 
@@ -451,7 +512,7 @@ document.addEventListener('DOMContentLoaded', () => {
             await initializeMenu();
             await refreshOrderHistory();
             updateUILanguage(); 
-            setInterval(refreshOrderHistory, 10000); 
+            watchOrderHistory();
         }
     }
 